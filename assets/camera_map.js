@@ -0,0 +1,46 @@
+// Year filtering of the camera map, in the browser.
+// The points are sent once by the camera-points store, sorted by installation
+// year: the cameras installed by the end of a year are a prefix of the arrays,
+// shown without copying them.
+(function () {
+    const ARRAYS = {f4: Float32Array, f8: Float64Array, i4: Int32Array, u4: Uint32Array};
+    const decoded = new WeakMap();
+
+    // Plotly typed array ({dtype, bdata}) or plain array to a typed array
+    function decode(values) {
+        if (!values || values.bdata === undefined) {
+            return Float64Array.from(values || []);
+        }
+        const binary = atob(values.bdata);
+        const bytes = new Uint8Array(binary.length);
+        for (let i = 0; i < binary.length; i++) {
+            bytes[i] = binary.charCodeAt(i);
+        }
+        return new ARRAYS[values.dtype](bytes.buffer);
+    }
+
+    function points(data) {
+        if (!decoded.has(data)) {
+            decoded.set(data, {lat: decode(data.lat), lon: decode(data.lon)});
+        }
+        return decoded.get(data);
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        camera_map: {
+            filter_year: function (year, data, figure) {
+                if (!data || !figure) {
+                    return window.dash_clientside.no_update;
+                }
+                const {lat, lon} = points(data);
+                const index = data.years.indexOf(year);
+                const end = index < 0 ? lat.length : data.ends[index];
+                const trace = Object.assign({}, figure.data[0], {
+                    lat: lat.subarray(0, end),
+                    lon: lon.subarray(0, end),
+                });
+                return Object.assign({}, figure, {data: [trace]});
+            },
+        },
+    });
+})();
@@ -1,20 +1,60 @@
-"""Main file."""
+"""Main file.
+
+Usage::
+
+    python main.py [ingest | serve | warm-cache | bench]
+
+Without a command, the data is ingested then the dashboard is served. Each
+command only imports the modules it needs, and reports how long they took.
+"""
+from __future__ import annotations
+
+from argparse import ArgumentParser
+from importlib import import_module
+from importlib.util import find_spec
 from os import environ
+from statistics import median, quantiles
+from time import perf_counter
+from typing import TYPE_CHECKING
 
-from dash import Dash
 from dotenv import load_dotenv
-from shodan import Shodan
 
-from src.pages.map_page.callbacks import register_callbacks
-from src.pages.map_page.layout import create_layout
-from src.utils.get_data import get_data
+if TYPE_CHECKING:
+    from types import ModuleType
+
+    from shodan import Shodan
 
 
-def main() -> None:
+def timed_import(name: str) -> ModuleType:
+    """Import a module and print how long it took."""
+    start = perf_counter()
+    module = import_module(name)
+    print(f"[import] {name}: {(perf_counter() - start) * 1000:.0f} ms")
+    return module
+
+
+def main(argv: list[str] | None = None) -> None:
     """Point d'entrée principal de l'application."""
-    shodan_clients = initialize_shodan()
-    get_data(shodan_clients)
-    launch_app()
+    parser = ArgumentParser(description="Crime and camera dashboard of France.")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("ingest", help="fetch and clean every dataset")
+    serve = commands.add_parser("serve", help="serve the dashboard")
+    serve.add_argument("--port", type=int, default=8050)
+    serve.add_argument("--no-debug", dest="debug", action="store_false")
+    commands.add_parser("warm-cache", help="build every map figure ahead")
+    bench = commands.add_parser("bench", help="time the dashboard callbacks")
+    bench.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    if args.command in {None, "ingest"}:
+        ingest()
+    if args.command in {None, "serve"}:
+        launch_app(port=getattr(args, "port", 8050), debug=getattr(args, "debug", True))
+    elif args.command == "warm-cache":
+        warm_cache()
+    elif args.command == "bench":
+        run_bench(args.repeat)
 
 
 class ShodanInitializationError(Exception):
@@ -23,33 +63,139 @@ class ShodanInitializationError(Exception):
 
 def initialize_shodan() -> list[Shodan]:
     """Initialise les clients Shodan."""
-    load_dotenv()
     raw_keys = environ.get("SHODAN_API_KEY")
     if not raw_keys:
         error_msg = "Verify the .env file."
         raise ShodanInitializationError(Exception(error_msg))
 
+    shodan = timed_import("shodan")
+    http_cache = timed_import("src.utils.http_cache")
     keys = raw_keys.split(",")
-    return [Shodan(key) for key in keys]
+    clients = [shodan.Shodan(key) for key in keys]
+    for client in clients:
+        http_cache.install_cache(client._session)  # noqa: SLF001
+        if http_cache.cache_mode() == "replay":
+            # Nothing upstream to protect, replay at disk speed
+            client.api_rate_limit = 0
+    return clients
+
+
+def ingest() -> None:
+    """Fetch and clean every dataset."""
+    shodan_clients = initialize_shodan()
+    timed_import("src.utils.get_data").get_data(shodan_clients)
 
 
-def launch_app() -> None:
+def launch_app(port: int = 8050, *, debug: bool = True) -> None:
     """Lance l'application Dash avec le layout personnalisé."""
+    dash = timed_import("dash")
+    figure_encoding = timed_import("src.utils.figure_encoding")
+    layout = timed_import("src.pages.map_page.layout")
+    callbacks = timed_import("src.pages.map_page.callbacks")
+    metrics = timed_import("src.utils.metrics")
+    export = timed_import("src.utils.export")
+    profiling = timed_import("src.utils.profiling")
+
     external_scripts = [
         "https://cdn.tailwindcss.com",
     ]
 
-    app = Dash(
+    print(f"Figures serialized with {figure_encoding.configure_json_engine()}")
+    # gzip or brotli, as accepted by the browser, when flask-compress is installed
+    compress = find_spec("flask_compress") is not None
+    if not compress:
+        print("flask-compress is not installed, responses are not compressed")
+
+    app = dash.Dash(
         __name__,
         external_scripts=external_scripts,
+        compress=compress,
     )
     app.scripts.config.serve_locally = True
 
-    app.layout = create_layout()
-
-    register_callbacks(app)
-
-    app.run_server(debug=True)
+    app.layout = layout.create_layout()
+
+    callbacks.register_callbacks(app)
+    metrics.register_metrics(app.server)
+    export.register_export(app.server)
+    profiling.register_profiling(app.server)
+
+    app.run_server(port=port, debug=debug)
+
+
+def warm_cache() -> None:
+    """Build the map figure of every year and view in the figure cache."""
+    callbacks = timed_import("src.pages.map_page.callbacks")
+    figure_cache = timed_import("src.utils.figure_cache")
+    print(f"Removed {figure_cache.prune_figures()} stale figure sets")
+    update_map = figure_cache.cached_figure(callbacks.update_map_callback, year_arg=0)
+    start = perf_counter()
+    count = 0
+    for year in range(callbacks.START_YEAR, callbacks.END_YEAR + 1):
+        for view_type in callbacks.VIEW_TYPES:
+            update_map([year, year], view_type, [], None)
+            count += 1
+    print(f"{count} figures cached in {perf_counter() - start:.1f}s")
+
+
+def run_bench(repeat: int) -> None:
+    """Time every dashboard callback over its possible inputs.
+
+    :param repeat int: calls per input
+    """
+    callbacks = timed_import("src.pages.map_page.callbacks")
+    figure_cache = timed_import("src.utils.figure_cache")
+    years = range(callbacks.START_YEAR, callbacks.END_YEAR + 1)
+    views = callbacks.VIEW_TYPES
+    maps = [([year, year], view, [], None) for year in years for view in views]
+    ranges = [([years[0], year], view, [], None) for year in years for view in views]
+    cases = {
+        "update_map": (callbacks.update_map_callback, maps),
+        "update_map (range)": (callbacks.update_map_callback, ranges),
+        "update_map (cached)": (
+            figure_cache.cached_figure(callbacks.update_map_callback, year_arg=0),
+            maps,
+        ),
+        "update_statistics": (
+            callbacks.update_statistics_callback,
+            [([year, year], []) for year in years],
+        ),
+        "update_comparison_chart": (
+            callbacks.update_comparison_chart_callback,
+            [(None,)],
+        ),
+        "update_camera_evolution": (
+            callbacks.update_camera_evolution_callback,
+            [(None,)],
+        ),
+        "update_crime_evolution": (
+            callbacks.update_crime_evolution_callback,
+            [(None,)],
+        ),
+        "update_correlation_chart": (
+            callbacks.update_correlation_chart_callback,
+            [(view,) for view in views],
+        ),
+        "update_area_correlation": (
+            callbacks.update_area_correlation_callback,
+            [(view,) for view in views],
+        ),
+    }
+    print(f"{'callback':<26}{'calls':>6}{'median':>10}{'p95':>10}{'max':>10}  (ms)")
+    for name, (callback, inputs) in cases.items():
+        timings = []
+        for _ in range(repeat):
+            for args in inputs:
+                start = perf_counter()
+                callback(*args)
+                timings.append((perf_counter() - start) * 1000)
+        p95 = timings[0]
+        if len(timings) > 1:
+            p95 = quantiles(timings, n=20, method="inclusive")[-1]
+        print(
+            f"{name:<26}{len(timings):>6}{median(timings):>10.1f}"
+            f"{p95:>10.1f}{max(timings):>10.1f}",
+        )
 
 
 if __name__ == "__main__":
@@ -5,11 +5,26 @@ and preparing geographical data for visualization across different French region
 Contains callback registrations for interactive map updates and data filtering.
 """
 
-import geopandas as gpd
+from math import log2
+
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-from dash import Input, Output
+from dash import ClientsideFunction, Input, Output, State, ctx, no_update
+
+from src.utils.datasets import (
+    load_analytics,
+    load_cameras,
+    load_commune_keys,
+    load_commune_partition,
+    load_crime_store,
+    load_crimes,
+    load_geojson,
+    load_geometry,
+    load_shodan_counts,
+)
+from src.utils.figure_cache import cached_figure
+from src.utils.metrics import instrument_callback
 
 REGION_CODES = {
     "84": "ARA",  # Auvergne-Rhône-Alpes
@@ -29,55 +44,46 @@ REGION_CODES = {
 
 START_YEAR = 2016
 END_YEAR = 2023
-
-def load_data(
-    selected_year: int,
-) -> tuple[gpd.GeoDataFrame, pd.DataFrame, pd.DataFrame]:
-    geojson_file = "data/cleaned/french_communes.geojson"
-    geo_data = gpd.read_file(geojson_file)
-
-    crime_data = pd.read_csv("data/cleaned/crimes_france_2.csv")
-    year_crime_data = crime_data[crime_data["Year"] == selected_year]
-
-    city_dept_mapping = pd.DataFrame({
-        "City": geo_data["libgeo"],
-        "dep": geo_data["dep"],
-        "reg": geo_data["reg"],
-    }).drop_duplicates()
-
-    return geo_data, year_crime_data, city_dept_mapping
+VIEW_TYPES = ("communes", "departements", "regions")
+GROUP_COLUMNS = {"communes": "City", "departements": "dep", "regions": "reg"}
+FRANCE_CENTER = {"lat": 46.603354, "lon": 2.888334}
+FRANCE_ZOOM = 4.5
+LAG_COLORS = {0: "#636EFA", 1: "#EF553B", 2: "#00CC96"}
 
 
 def compute_crime_summary(
-    year_crime_data: pd.DataFrame,
-    city_dept_mapping: pd.DataFrame,
+    year_range: list[int],
     view_type: str,
-) -> any:
-    crime_data_with_regions = year_crime_data.merge(
-        city_dept_mapping,
-        on="City",
-        how="left",
+    classes: list[str] | None = None,
+    cities: list[str] | None = None,
+) -> pd.DataFrame:
+    """Agréger les crimes de la période par commune, département ou région.
+
+    Crime_Rate est un taux annuel : les cas de la période sont rapportés à son
+    nombre d'années, comme la population, qui est la moyenne de la période.
+    """
+    store = load_crime_store()
+    group_by_col = GROUP_COLUMNS[view_type]
+    mapping = None
+    if view_type != "communes":
+        mapping = load_commune_keys().set_index("libgeo")[group_by_col]
+    crime_summary = store.aggregate(tuple(year_range), classes, mapping, cities).rename(
+        columns={"Key": group_by_col},
     )
-
-    group_by_col = "reg" if view_type == "regions" else "dep"
-    crime_summary = crime_data_with_regions.groupby(group_by_col).agg({
-        "Cases": "sum",
-        "POP": "sum",
-    }).reset_index()
-
-    crime_summary["Crime_Rate"] = (crime_summary["Cases"] / crime_summary["POP"]) * 100
+    population = crime_summary["POP"].where(crime_summary["POP"] > 0)
+    years = max(store.year_count(tuple(year_range)), 1)
+    crime_summary["Crime_Rate"] = (crime_summary["Cases"] / years / population) * 100
     return crime_summary
 
 
 def prepare_geo_data(
-    geo_data: gpd.GeoDataFrame,
+    geo_data: pd.DataFrame,
     crime_summary: pd.DataFrame,
     view_type: str,
-) -> gpd.GeoDataFrame:
+) -> pd.DataFrame:
     """Préparer les données géographiques pour la visualisation."""
     group_by_col = "reg" if view_type == "regions" else "dep"
-    current_geo_data = geo_data.dissolve(by=group_by_col, aggfunc="first").reset_index()
-    current_geo_data = current_geo_data.merge(
+    current_geo_data = geo_data.merge(
         crime_summary,
         on=group_by_col,
         how="left",
@@ -104,34 +110,83 @@ def prepare_geo_data(
     return current_geo_data, hover_name, hover_data
 
 
+def period_title(year_range: list[int]) -> str:
+    first, last = year_range
+    if first == last:
+        return f"Données pour l'année {first}"
+    return f"Données de {first} à {last}"
+
+
+def merge_commune_data(
+    geo_data: pd.DataFrame,
+    crime_summary: pd.DataFrame,
+) -> pd.DataFrame:
+    current_geo_data = geo_data.merge(
+        crime_summary,
+        how="left",
+        left_on="libgeo",
+        right_on="City",
+    )
+    current_geo_data["Crime_Rate"] = current_geo_data["Crime_Rate"].fillna(0)
+    current_geo_data["Cases"] = current_geo_data["Cases"].fillna(0)
+    current_geo_data["POP"] = current_geo_data["POP"].fillna(0)
+    return current_geo_data
+
+
+def drill_down_view(bounds: tuple[float, ...]) -> tuple[dict, float]:
+    """Centre et zoom de la carte couvrant les limites d'une zone."""
+    min_x, min_y, max_x, max_y = bounds
+    span = max(max_x - min_x, (max_y - min_y) * 1.5, 0.01)
+    zoom = min(max(log2(360 / span) - 0.5, FRANCE_ZOOM), 11)
+    return {"lat": (min_y + max_y) / 2, "lon": (min_x + max_x) / 2}, zoom
+
+
+def area_label(drill_area: dict) -> str:
+    value = drill_area["value"]
+    if drill_area["column"] == "reg":
+        return f"région {REGION_CODES.get(value, value)}"
+    return f"département {value}"
+
+
 def update_map_callback(
-    selected_year: int,
+    year_range: list[int],
     view_type: str,
+    classes: list[str] | None = None,
+    drill_area: dict | None = None,
 ) -> go.Figure:
-    geo_data, year_crime_data, city_dept_mapping = load_data(selected_year)
-
-    if view_type == "communes":
-        crime_summary = year_crime_data.groupby(["City"])[["Cases", "POP"]].mean().reset_index()  # noqa: E501
-        crime_summary["Crime_Rate"] = (crime_summary["Cases"] / crime_summary["POP"]) * 100  # noqa: E501
-        current_geo_data = geo_data.merge(
-            crime_summary,
-            how="left",
-            left_on="libgeo",
-            right_on="City",
+    center, zoom = FRANCE_CENTER, FRANCE_ZOOM
+    title = period_title(year_range)
+    hover_name = "libgeo"
+    hover_data = {
+        "Crime_Rate": ":.3f",
+        "Cases": True,
+        "POP": True,
+    }
+
+    if drill_area:
+        # Only the communes of the clicked area are read and sent
+        geo_data, geojson, bounds = load_commune_partition(
+            drill_area["column"],
+            drill_area["value"],
         )
-        current_geo_data["Crime_Rate"] = current_geo_data["Crime_Rate"].fillna(0)
-        current_geo_data["Cases"] = current_geo_data["Cases"].fillna(0)
-        current_geo_data["POP"] = current_geo_data["POP"].fillna(0)
-
-        hover_name = "libgeo"
-        hover_data = {
-            "Crime_Rate": ":.3f",
-            "Cases": True,
-            "POP": True,
-        }
+        crime_summary = compute_crime_summary(
+            year_range,
+            "communes",
+            classes,
+            cities=geo_data["libgeo"].tolist(),
+        )
+        current_geo_data = merge_commune_data(geo_data, crime_summary)
+        if bounds:
+            center, zoom = drill_down_view(bounds)
+        title = f"{title} - {area_label(drill_area)}"
     else:
-        crime_summary = compute_crime_summary(year_crime_data, city_dept_mapping, view_type)  # noqa: E501
-        current_geo_data, hover_name, hover_data = prepare_geo_data(geo_data, crime_summary, view_type)  # noqa: E501
+        geometry = load_geometry(view_type)
+        geojson = load_geojson(view_type)
+        crime_summary = compute_crime_summary(year_range, view_type, classes)
+        if view_type == "communes":
+            current_geo_data = merge_commune_data(geometry.attributes, crime_summary)
+        else:
+            current_geo_data, hover_name, hover_data = prepare_geo_data(geometry.attributes, crime_summary, view_type)  # noqa: E501
 
     crime_rates = current_geo_data["Crime_Rate"].dropna()
     if len(crime_rates) > 0:
@@ -143,7 +198,7 @@ def update_map_callback(
 
     fig = px.choropleth_mapbox(
         current_geo_data,
-        geojson=current_geo_data.geometry,
+        geojson=geojson,
         locations=current_geo_data.index,
         color="Crime_Rate",
         color_continuous_scale=["#00ff00", "#ffff00", "#ff0000"],
@@ -151,7 +206,7 @@ def update_map_callback(
         hover_name=hover_name,
         hover_data=hover_data,
         labels={
-            "Crime_Rate": "Taux de criminalité (%)",
+            "Crime_Rate": "Taux annuel de criminalité (%)",
             "Cases": "Nombre de cas",
             "POP": "Population",
             "dep": "Département",
@@ -159,46 +214,35 @@ def update_map_callback(
             "reg_code": "Code Région",
         },
         mapbox_style="open-street-map",
-        zoom=4.5,
-        center={"lat": 46.603354, "lon": 2.888334},
+        zoom=zoom,
+        center=center,
         opacity=0.6,
     )
 
     fig.update_layout(
         margin={"r": 0, "t": 30, "l": 0, "b": 0},
-        title=f"Données pour l'année {selected_year}",
+        title=title,
         title_x=0.5,
     )
 
     return fig
 
 
-def update_statistics_callback(selected_year: int) -> tuple[str, str, str, str]:
-    geo_data, year_crime_data, _ = load_data(selected_year)
-
-    city_region_mapping = pd.DataFrame({
-        "City": geo_data["libgeo"],
-        "reg": geo_data["reg"],
-    }).drop_duplicates()
-
-    crime_data_with_regions = year_crime_data.merge(
-        city_region_mapping,
-        on="City",
-        how="left",
-    )
+def update_statistics_callback(
+    year_range: list[int],
+    classes: list[str] | None = None,
+) -> tuple[str, str, str, str]:
+    city_stats = compute_crime_summary(year_range, "communes", classes)
 
-    total_crimes = int(year_crime_data["Cases"].sum())
+    total_crimes = int(city_stats["Cases"].sum())
 
-    total_cases = year_crime_data["Cases"].sum()
-    total_pop = year_crime_data["POP"].sum()
+    # Annual, like Crime_Rate
+    years = max(load_crime_store().year_count(tuple(year_range)), 1)
+    total_cases = city_stats["Cases"].sum() / years
+    total_pop = city_stats["POP"].sum()
     avg_rate = (total_cases / total_pop) * 100 if total_pop > 0 else 0
 
-    region_stats = crime_data_with_regions.groupby("reg").agg({
-        "Cases": "sum",
-        "POP": "sum",
-    }).reset_index()
-
-    region_stats["Crime_Rate"] = (region_stats["Cases"] / region_stats["POP"]) * 100
+    region_stats = compute_crime_summary(year_range, "regions", classes)
 
     worst_region_idx = region_stats["Crime_Rate"].idxmax()
     worst_region = region_stats.loc[worst_region_idx]
@@ -214,12 +258,11 @@ def update_statistics_callback(selected_year: int) -> tuple[str, str, str, str]:
 
 
 def update_comparison_chart_callback(_: any) -> go.Figure:
-    crime_data = pd.read_csv("data/cleaned/crimes_france_2.csv")
+    crime_data = load_crimes()
     yearly_crimes = crime_data.groupby("Year")["Cases"].sum().reset_index()
     yearly_crimes = yearly_crimes[(yearly_crimes["Year"] >= START_YEAR) & (yearly_crimes["Year"] <= END_YEAR)]  # noqa: E501
 
-    camera_data = pd.read_csv("data/cleaned/osm_cleaned.csv", names=["Lat", "Long-", "Timestamp"])  # noqa: E501
-    camera_data["Timestamp"] = pd.to_datetime(camera_data["Timestamp"], errors="coerce")
+    camera_data = load_cameras()
     camera_data["Year"] = camera_data["Timestamp"].dt.year
 
     no_date_cameras = camera_data["Timestamp"].isna().sum()
@@ -267,8 +310,7 @@ def update_comparison_chart_callback(_: any) -> go.Figure:
 
 def update_camera_evolution_callback(_: any) -> go.Figure:
     try:
-        camera_data = pd.read_csv("data/cleaned/osm_cleaned.csv", names=["Lat", "Long-", "Timestamp"])  # noqa: E501
-        camera_data["Timestamp"] = pd.to_datetime(camera_data["Timestamp"], errors="coerce")  # noqa: E501
+        camera_data = load_cameras()
         camera_data["Year"] = camera_data["Timestamp"].dt.year
 
         no_date_cameras = camera_data["Timestamp"].isna().sum()
@@ -311,6 +353,21 @@ def update_camera_evolution_callback(_: any) -> go.Figure:
             marker_line_width=1.5,
             opacity=0.8,
         )
+
+        # SHODAN_MODE=facets: Shodan cameras are only known as yearly counts
+        shodan_counts = load_shodan_counts()
+        in_range = shodan_counts["Year"].between(START_YEAR, END_YEAR)
+        shodan_counts = shodan_counts[in_range]
+        if len(shodan_counts):
+            fig.update_traces(name="OSM (installées)")
+            fig.add_trace(go.Bar(
+                x=shodan_counts["Year"],
+                y=shodan_counts["Cameras"],
+                name="Shodan (vues dans l'année)",
+                marker_color="#636EFA",
+                opacity=0.8,
+            ))
+            fig.update_layout(showlegend=True, barmode="group")
     except (pd.errors.EmptyDataError, pd.errors.DatabaseError, ValueError, KeyError) as e:  # noqa: E501
         print(f"Error in update_camera_evolution - Data processing failed: {e!s}")
         return go.Figure()
@@ -320,7 +377,7 @@ def update_camera_evolution_callback(_: any) -> go.Figure:
 
 def update_crime_evolution_callback(_: any) -> go.Figure:
     try:
-        crime_data = pd.read_csv("data/cleaned/crimes_france_2.csv")
+        crime_data = load_crimes()
         yearly_crimes = crime_data.groupby("Year")["Cases"].sum().reset_index()
         yearly_crimes = yearly_crimes[yearly_crimes["Year"].between(START_YEAR, END_YEAR)]  # noqa: E501
 
@@ -353,33 +410,161 @@ def update_crime_evolution_callback(_: any) -> go.Figure:
         return fig
 
 
+def analytics_level(view_type: str) -> str:
+    """Return the analytics level closest to a map view, regions having none."""
+    return "communes" if view_type == "communes" else "departements"
+
+
+def update_correlation_chart_callback(view_type: str) -> go.Figure:
+    try:
+        level = analytics_level(view_type)
+        data = load_analytics("cross_section")
+        data = data[data["Level"] == level]
+
+        fig = go.Figure()
+        for lag, lag_data in data.groupby("Lag"):
+            color = LAG_COLORS.get(lag, "gray")
+            label = "même année" if lag == 0 else f"crimes {lag} an(s) après"
+            fig.add_trace(go.Scatter(
+                x=lag_data["Year"],
+                y=lag_data["Correlation"],
+                error_y={
+                    "type": "data",
+                    "symmetric": False,
+                    "array": lag_data["Correlation_High"] - lag_data["Correlation"],
+                    "arrayminus": lag_data["Correlation"] - lag_data["Correlation_Low"],
+                },
+                name=label,
+                line={"color": color, "width": 2},
+                mode="lines+markers",
+            ))
+
+        fig.add_hline(y=0, line_dash="dot", line_color="gray")
+        fig.update_layout(
+            title=f"Corrélation densité de caméras / taux de crimes ({level})",
+            xaxis_title="Année des caméras",
+            yaxis_title="Corrélation de Pearson (IC 95 %)",
+            template="plotly_white",
+            hovermode="x unified",
+        )
+    except (ValueError, KeyError, pd.errors.EmptyDataError) as e:
+        print(f"Error in update_correlation_chart - Invalid or empty data: {e}")
+        return go.Figure()
+    else:
+        return fig
+
+
+def update_area_correlation_callback(view_type: str) -> go.Figure:
+    try:
+        level = analytics_level(view_type)
+        data = load_analytics("areas")
+        data = data[data["Level"] == level].dropna(subset=["Correlation"])
+
+        fig = px.histogram(
+            data,
+            x="Correlation",
+            nbins=40,
+            title=f"Corrélation au fil des années, par zone ({level})",
+            labels={"Correlation": "Corrélation de Pearson", "count": "Zones"},
+            color_discrete_sequence=["#AB63FA"],
+        )
+
+        fig.update_layout(
+            showlegend=False,
+            margin={"r": 20, "t": 40, "l": 20, "b": 20},
+            plot_bgcolor="rgba(0,0,0,0)",
+            paper_bgcolor="rgba(0,0,0,0)",
+        )
+    except (ValueError, KeyError, pd.errors.EmptyDataError) as e:
+        print(f"Error in update_area_correlation - Invalid or empty data: {e}")
+        return go.Figure()
+    else:
+        return fig
+
+
+def update_drill_area_callback(
+    click_data: dict | None,
+    view_type: str,
+    _reset: int | None,
+    drill_area: dict | None,
+) -> dict | None:
+    """Zone affichée commune par commune, après un clic sur la carte."""
+    if ctx.triggered_id != "france-map-crime":
+        return None
+    if drill_area or view_type == "communes" or not click_data:
+        return no_update
+    location = click_data["points"][0].get("location")
+    if location is None:
+        return no_update
+    column = GROUP_COLUMNS[view_type]
+    attributes = load_geometry(view_type).attributes
+    return {"column": column, "value": str(attributes[column].iloc[int(location)])}
+
+
 def register_callbacks(app: any) -> None:
     """Register all callbacks for the map page."""
+    # Picking a year selects it alone in the range, without a server round trip
+    app.clientside_callback(
+        "function(year) { return [year, year]; }",
+        Output("year-range", "value"),
+        Input("year-radio", "value"),
+    )
+
+    # Cameras installed by the selected year, filtered in the browser
+    app.clientside_callback(
+        ClientsideFunction(namespace="camera_map", function_name="filter_year"),
+        Output("france-map-camera", "figure"),
+        Input("year-radio", "value"),
+        State("camera-points", "data"),
+        State("france-map-camera", "figure"),
+    )
+
+    app.callback(
+        Output("drill-area", "data"),
+        [Input("france-map-crime", "clickData"),
+         Input("view-type-radio", "value"),
+         Input("drill-reset", "n_clicks")],
+        State("drill-area", "data"),
+    )(instrument_callback(update_drill_area_callback))
+
     app.callback(
         Output("france-map-crime", "figure"),
-        [Input("year-radio", "value"),
-         Input("view-type-radio", "value")],
-    )(update_map_callback)
+        [Input("year-range", "value"),
+         Input("view-type-radio", "value"),
+         Input("class-filter", "value"),
+         Input("drill-area", "data")],
+    )(instrument_callback(cached_figure(update_map_callback, year_arg=0)))
 
     app.callback(
         [Output("total-crimes", "children"),
          Output("avg-crime-rate", "children"),
          Output("worst-region", "children"),
          Output("worst-region-rate", "children")],
-        [Input("year-radio", "value")],
-    )(update_statistics_callback)
+        [Input("year-range", "value"),
+         Input("class-filter", "value")],
+    )(instrument_callback(update_statistics_callback))
 
     app.callback(
         Output("comparison-chart", "figure"),
         Input("year-radio", "value"),
-    )(update_comparison_chart_callback)
+    )(instrument_callback(update_comparison_chart_callback))
 
     app.callback(
         Output("camera-evolution-chart", "figure"),
         [Input("year-radio", "value")],
-    )(update_camera_evolution_callback)
+    )(instrument_callback(update_camera_evolution_callback))
 
     app.callback(
         Output("crime-evolution-chart", "figure"),
         [Input("year-radio", "value")],
-    )(update_crime_evolution_callback)
+    )(instrument_callback(update_crime_evolution_callback))
+
+    app.callback(
+        Output("correlation-chart", "figure"),
+        Input("view-type-radio", "value"),
+    )(instrument_callback(update_correlation_chart_callback))
+
+    app.callback(
+        Output("area-correlation-chart", "figure"),
+        Input("view-type-radio", "value"),
+    )(instrument_callback(update_area_correlation_callback))
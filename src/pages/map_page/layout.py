@@ -4,84 +4,94 @@ It provides functions to create and manage the visual layout of the geographic
 data visualization, including crime statistics across French communes.
 """
 
-import geopandas as gpd
+import numpy as np
 import pandas as pd
-import plotly.express as px
+import plotly.graph_objects as go
 from dash import dcc, html
 
+from src.pages.map_page.callbacks import update_map_callback
+from src.utils.datasets import (
+    load_cameras,
+    load_crime_store,
+    load_crimes,
+    load_geometry,
+    load_shodan_counts,
+    report_memory,
+)
+from src.utils.figure_encoding import encode_figure, typed_array
+from src.utils.partitions import memory_budget
 
-def create_layout() -> html.Div:
-    geojson_file = "data/cleaned/french_communes.geojson"
-    geo_data = gpd.read_file(geojson_file)
 
-    crime_data_file = "data/cleaned/crimes_france_2.csv"
-    crime_data = pd.read_csv(crime_data_file)
+def camera_points(cameras: pd.DataFrame, years: list[int]) -> dict:
+    """Return the cameras sorted by installation year, with the year buckets.
 
-    years = sorted(crime_data["Year"].unique())
+    Undated cameras come first, as they are shown every year; the cameras
+    installed by the end of years[i] are then the first ends[i] points.
 
-    crime_summary = crime_data[crime_data["Year"] == years[0]].groupby(["City"])[["Cases", "POP"]].mean().reset_index()  # noqa: E501
-    crime_summary["Crime_Rate"] = (crime_summary["Cases"] / crime_summary["POP"]) * 100
-    geo_data = geo_data.merge(
-        crime_summary,
-        how="left",
-        left_on="libgeo",
-        right_on="City",
-    )
-    geo_data["Crime_Rate"] = geo_data["Crime_Rate"].fillna(0)
-    geo_data["Cases"] = geo_data["Cases"].fillna(0)
-    geo_data["POP"] = geo_data["POP"].fillna(0)
+    :param cameras DataFrame: cameras with Lat, Long- and Timestamp
+    :param years list[int]: years of the year selector
+    """
+    installed = cameras["Timestamp"].dt.year.fillna(-np.inf).to_numpy()
+    order = np.argsort(installed, kind="stable")
+    return {
+        "lat": typed_array(cameras["Lat"].to_numpy()[order]),
+        "lon": typed_array(cameras["Long-"].to_numpy()[order]),
+        "years": [int(year) for year in years],
+        "ends": np.searchsorted(installed[order], years, side="right").tolist(),
+    }
 
-    min_value = geo_data["Crime_Rate"].quantile(0.1)
-    max_value = geo_data["Crime_Rate"].quantile(0.9)
 
-    map_fig_crime = px.choropleth_mapbox(
-        geo_data,
-        geojson=geo_data.geometry,
-        locations=geo_data.index,
-        color="Crime_Rate",
-        color_continuous_scale=["#00ff00", "#ffff00", "#ff0000"],
-        range_color=(min_value, max_value),
-        hover_name="libgeo",
-        hover_data={"Crime_Rate": ":.3f","Cases": True,"POP": True,"dep": True},
-        labels={
-            "Crime_Rate": "Taux de criminalité (%)",
-            "Cases": "Nombre de cas",
-            "POP": "Population",
-            "dep": "Département",
-        },
-        mapbox_style="open-street-map",
-        zoom=5,
-        center={"lat": 46.603354, "lon": 1.888334},
-        opacity=0.6,
-    ).update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0}, uirevision=True)
+def create_layout() -> html.Div:
+    crime_data = load_crimes()
+    report_memory("crimes", crime_data)
+
+    years = sorted(crime_data["Year"].unique())
+    class_options = [{"label": c, "value": c} for c in load_crime_store().classes]
 
-    crime_data = pd.read_csv("data/cleaned/crimes_france_2.csv")
+    # On small machines, the communes are only shown by drilling down
+    initial_view = "departements" if memory_budget() else "communes"
+    report_memory("communes", load_geometry("communes").attributes)
+    map_fig_crime = update_map_callback(
+        [years[0], years[0]],
+        initial_view,
+        [],
+    ).update_layout(uirevision=True)
 
     total_population = 68170000
 
-    camera_locations = pd.read_csv("data/cleaned/osm_cleaned.csv", names=["Lat", "Long-", "Timestamp"])  # noqa: E501
-    camera_locations["Timestamp"] = pd.to_datetime(camera_locations["Timestamp"], errors="coerce")  # noqa: E501
+    camera_locations = load_cameras()
+    report_memory("cameras", camera_locations)
     camera_locations = camera_locations.dropna(subset=["Lat", "Long-"])
     total_cameras = len(camera_locations)
+    # With SHODAN_MODE=facets, the map only holds the OSM cameras
+    shodan_counts = load_shodan_counts()
+    cameras_scope = "en France"
+    if len(shodan_counts):
+        last = shodan_counts.iloc[shodan_counts["Year"].idxmax()]
+        cameras_scope = (
+            f"en France, OSM uniquement (Shodan en mode agrégé : "
+            f"{int(last['Cameras'])} caméras vues en {int(last['Year'])})"
+        )
 
-    camera_locations["hover_name"] = "Camera"
-
-    map_fig_camera = px.scatter_mapbox(
-        camera_locations,
-        lat="Lat",
-        lon="Long-",
-        hover_name="hover_name",
-        hover_data={
-            "Lat": ":.4f",
-            "Long-": ":.4f",
+    # Points are sent once, in camera_points; camera_map.js shows those of a year
+    map_fig_camera = go.Figure(
+        go.Scattermapbox(
+            lat=[],
+            lon=[],
+            mode="markers",
+            marker={"color": "blue", "opacity": 0.8},
+            hovertemplate="<b>Camera</b><br><br>Lat=%{lat:.4f}<br>Long-=%{lon:.4f}<extra></extra>",
+        ),
+    )
+    map_fig_camera.update_layout(
+        mapbox={
+            "style": "open-street-map",
+            "zoom": 5,
+            "center": {"lat": 46.603354, "lon": 1.888334},
         },
-        mapbox_style="open-street-map",
-        zoom=5,
-        center={"lat": 46.603354, "lon": 1.888334},
-        opacity=0.8,
-        color_discrete_sequence=["blue"],
+        margin={"r": 0, "t": 0, "l": 0, "b": 0},
+        uirevision=True,
     )
-    map_fig_camera.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0})
 
     try:
         camera_coverage = round((total_cameras * 100000) / total_population, 2)
@@ -91,12 +101,20 @@ def create_layout() -> html.Div:
         camera_coverage = 0
 
     return html.Div(
-        className="grid grid-rows-[50px_600px_50px_600px_600px_600px] gap-4 grid-cols-6 relative overflow-hidden p-4",  # noqa: E501
+        className="grid grid-rows-[50px_600px_50px_600px_600px_600px_600px] gap-4 grid-cols-6 relative overflow-hidden p-4",  # noqa: E501
         children=[
             html.H1(
                 "Crimes et Caméras en France",
                 className="text-3xl font-bold text-center col-span-5",
             ),
+            html.Button(
+                "Retour à la France",
+                id="drill-reset",
+                className="col-start-6 col-end-7 bg-white rounded-md shadow-md px-4",
+            ),
+            # Département or region shown commune by commune, after a click
+            dcc.Store(id="drill-area"),
+            dcc.Store(id="camera-points", data=camera_points(camera_locations, years)),
             html.Div(
                 children=[
                     dcc.Loading(
@@ -104,7 +122,7 @@ def create_layout() -> html.Div:
                         type="circle",
                         children=dcc.Graph(
                             id="france-map-crime",
-                            figure=map_fig_crime,
+                            figure=encode_figure(map_fig_crime),
                             className="w-full h-full rounded-md shadow-md overflow-hidden z-1",  # noqa: E501
                         ),
                         className="w-full h-full flex items-center",
@@ -137,7 +155,7 @@ def create_layout() -> html.Div:
                                         children=[
                                             html.H3("Taux Moyen", className="text-lg font-semibold mb-2"),  # noqa: E501
                                             html.P(id="avg-crime-rate", className="text-3xl font-bold"),  # noqa: E501
-                                            html.P("pour 100 habitants", className="text-sm opacity-75"),  # noqa: E501
+                                            html.P("pour 100 habitants par an", className="text-sm opacity-75"),  # noqa: E501
                                         ],
                                     ),
                                     html.Div(
@@ -162,10 +180,27 @@ def create_layout() -> html.Div:
                     {"label": "Départements", "value": "departements"},
                     {"label": "Régions", "value": "regions"},
                 ],
-                value="communes",
+                value=initial_view,
                 inline=True,
                 className="row-start-3 row-end-4 col-start-3 col-end-5 z-1 flex items-center justify-end gap-2",  # noqa: E501
             ),
+            dcc.RangeSlider(
+                id="year-range",
+                min=years[0],
+                max=years[-1],
+                step=1,
+                marks={int(year): str(year) for year in years},
+                value=[years[0], years[0]],
+                className="row-start-3 row-end-4 col-start-5 col-end-7 z-1",
+            ),
+            dcc.Dropdown(
+                id="class-filter",
+                options=class_options,
+                value=[],
+                multi=True,
+                placeholder="Toutes les infractions",
+                className="row-start-3 row-end-4 col-start-2 col-end-3 z-10",
+            ),
             dcc.RadioItems(
                 id="year-radio",
                 options=[{"label": str(year), "value": year} for year in years],
@@ -190,7 +225,7 @@ def create_layout() -> html.Div:
                                         children=[
                                             html.H3("Total Caméras", className="text-lg font-semibold mb-2"),  # noqa: E501
                                             html.P(total_cameras, id="total-cameras", className="text-3xl font-bold"),  # noqa: E501
-                                            html.P("en France", className="text-sm opacity-75"),  # noqa: E501
+                                            html.P(cameras_scope, id="cameras-scope", className="text-sm opacity-75"),  # noqa: E501
                                         ],
                                     ),
                                     html.Div(
@@ -215,7 +250,7 @@ def create_layout() -> html.Div:
                         type="circle",
                         children=dcc.Graph(
                             id="france-map-camera",
-                            figure=map_fig_camera,
+                            figure=encode_figure(map_fig_camera),
                             className="h-full w-full rounded-md shadow-md overflow-hidden z-1",  # noqa: E501
                         ),
                         className="h-full w-full",
@@ -253,6 +288,26 @@ def create_layout() -> html.Div:
                 ],
                 className="col-span-3 h-full bg-white rounded-lg shadow-md p-4",
             ),
+            html.Div(
+                children=[
+                    html.H2("Corrélation caméras / crimes par année", className="text-xl font-bold mb-4"),  # noqa: E501
+                    dcc.Graph(
+                        id="correlation-chart",
+                        className="h-[500px]",
+                    ),
+                ],
+                className="col-span-3 h-full bg-white rounded-lg shadow-md p-4",
+            ),
+            html.Div(
+                children=[
+                    html.H2("Corrélation caméras / crimes par zone", className="text-xl font-bold mb-4"),  # noqa: E501
+                    dcc.Graph(
+                        id="area-correlation-chart",
+                        className="h-[500px]",
+                    ),
+                ],
+                className="col-span-3 h-full bg-white rounded-lg shadow-md p-4",
+            ),
             html.Div(
                 children=[
                     html.Img(
@@ -0,0 +1,338 @@
+"""Statistics relating the camera density to the crime rate.
+
+Camera density (cameras per 10,000 inhabitants, undated cameras being counted
+from the first year) and crime rate (cases per 1,000 inhabitants) are laid out
+as aligned year x area matrices, for communes and départements. Two sets of
+statistics are computed with matrix operations:
+
+- across areas, for every year and lag (cameras of year y against crimes of
+  year y + lag): Pearson correlation and OLS slope, with bootstrap confidence
+  intervals over the areas, the resamples running in parallel threads;
+- across years, for every area: correlation, slope and lag-1 correlation.
+
+precompute_analytics runs at the end of the ingestion and writes the results
+to data/cleaned/analytics. The area statistics span every year, so they are
+computed again whenever a year of crimes or the cameras change, and skipped
+otherwise.
+"""
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps
+from os import cpu_count, environ
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+from pandas import DataFrame, Series, concat, read_csv, to_datetime
+
+from src.utils.crime_store import STORE_PATH, CrimeStore, sum_by_code
+from src.utils.crime_years import YEARS_PATH, fingerprint, year_state
+from src.utils.geometry_store import GEOMETRY_PATH, GeometryStore
+from src.utils.run_report import report_io
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+
+CLEANED_PATH = Path("./", "data", "cleaned")
+ANALYTICS_PATH = CLEANED_PATH / "analytics"
+CAMERA_COMMUNES = "camera_communes.csv"  # commune of each row of the cameras
+LAGS = (0, 1, 2)  # years between the cameras and the crimes
+BOOTSTRAP_SAMPLES = 1000
+CONFIDENCE = 0.95
+SEED = 2024
+CHUNK_CELLS = 8_000_000  # resample weights held at once by a worker
+LEVELS = {"communes": None, "departements": "dep"}
+
+
+def correlate(x: np.ndarray, y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Return the Pearson correlation and the OLS slope of y on x.
+
+    Both are computed along the last axis, NaN where x or y is constant.
+
+    :param x ndarray: explanatory values, e.g. camera densities
+    :param y ndarray: explained values of the same shape, e.g. crime rates
+    """
+    dx = x - x.mean(axis=-1, keepdims=True)
+    dy = y - y.mean(axis=-1, keepdims=True)
+    cov = (dx * dy).mean(axis=-1)
+    var_x = (dx * dx).mean(axis=-1)
+    var_y = (dy * dy).mean(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return cov / np.sqrt(var_x * var_y), cov / var_x
+
+
+def lagged(
+    density: np.ndarray,
+    rate: np.ndarray,
+    lag: int,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Pair the densities of each year with the rates lag years later."""
+    return density[: len(density) - lag], rate[lag:]
+
+
+def _bootstrap_chunk(
+    density: np.ndarray,
+    rate: np.ndarray,
+    samples: int,
+    seed: np.random.SeedSequence,
+) -> dict[int, tuple[np.ndarray, np.ndarray]]:
+    rng = np.random.default_rng(seed)
+    areas = density.shape[1]
+    # A resample is a weight per area: how many times it was drawn
+    weights = np.stack([
+        np.bincount(rng.integers(0, areas, areas), minlength=areas)
+        for _ in range(samples)
+    ]) / areas
+    # Weighted moments of every resample at once, as (samples, years) products
+    mean_x, mean_y = weights @ density.T, weights @ rate.T
+    mean_xx, mean_yy = weights @ (density**2).T, weights @ (rate**2).T
+    results = {}
+    for lag in LAGS:
+        if lag >= len(density):
+            continue
+        x, y = lagged(density, rate, lag)
+        mx, my = mean_x[:, : len(x)], mean_y[:, lag:]
+        cov = weights @ (x * y).T - mx * my
+        var_x = mean_xx[:, : len(x)] - mx**2
+        var_y = mean_yy[:, lag:] - my**2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            results[lag] = ((cov / np.sqrt(var_x * var_y)).T, (cov / var_x).T)
+    return results
+
+
+def cross_section(
+    density: np.ndarray,
+    rate: np.ndarray,
+    years: Sequence[int],
+    samples: int = BOOTSTRAP_SAMPLES,
+) -> DataFrame:
+    """Correlate density and rate across areas, for every year and lag.
+
+    Confidence intervals come from resampling the areas. Resamples are
+    weight vectors, so their moments are matrix products; chunks of resamples
+    run in parallel threads, numpy releasing the GIL.
+
+    :param density ndarray: year x area camera densities
+    :param rate ndarray: year x area crime rates
+    :param years Sequence[int]: years of the rows
+    :param samples int: number of bootstrap resamples
+    """
+    # Centering each year keeps the moments accurate and changes no statistic
+    density = density - density.mean(axis=1, keepdims=True)
+    rate = rate - rate.mean(axis=1, keepdims=True)
+    chunk = max(1, CHUNK_CELLS // max(density.shape[1], 1))
+    sizes = [min(chunk, samples - start) for start in range(0, samples, chunk)]
+    seeds = np.random.SeedSequence(SEED).spawn(len(sizes))
+    workers = int(environ.get("ANALYTICS_WORKERS", min(4, cpu_count() or 1)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        chunks = list(
+            pool.map(
+                lambda args: _bootstrap_chunk(density, rate, *args),
+                zip(sizes, seeds, strict=True),
+            ),
+        )
+    alpha = (1 - CONFIDENCE) / 2 * 100
+    frames = []
+    for lag in LAGS:
+        if lag >= len(density):
+            continue
+        corr, slope = correlate(*lagged(density, rate, lag))
+        boot_corr = np.concatenate([c[lag][0] for c in chunks], axis=-1)
+        boot_slope = np.concatenate([c[lag][1] for c in chunks], axis=-1)
+        corr_ci = np.nanpercentile(boot_corr, [alpha, 100 - alpha], axis=-1)
+        slope_ci = np.nanpercentile(boot_slope, [alpha, 100 - alpha], axis=-1)
+        frames.append(
+            DataFrame({
+                "Lag": lag,
+                "Year": years[: len(years) - lag],
+                "Areas": density.shape[1],
+                "Correlation": corr,
+                "Correlation_Low": corr_ci[0],
+                "Correlation_High": corr_ci[1],
+                "Slope": slope,
+                "Slope_Low": slope_ci[0],
+                "Slope_High": slope_ci[1],
+            }),
+        )
+    return concat(frames, ignore_index=True)
+
+
+def area_series(density: np.ndarray, rate: np.ndarray, keys: np.ndarray) -> DataFrame:
+    """Correlate density and rate across years, for every area.
+
+    :param density ndarray: year x area camera densities
+    :param rate ndarray: year x area crime rates
+    :param keys ndarray: names of the areas
+    """
+    corr, slope = correlate(density.T, rate.T)
+    lag_corr = np.full(len(keys), np.nan)
+    if len(density) > 1:
+        lag_corr, _ = correlate(*(m.T for m in lagged(density, rate, 1)))
+    return DataFrame({
+        "Key": keys,
+        "Correlation": corr,
+        "Slope": slope,
+        "Lag1_Correlation": lag_corr,
+    })
+
+
+def camera_matrix(
+    camera_years: np.ndarray,
+    codes: np.ndarray,
+    years: Sequence[int],
+    size: int,
+) -> np.ndarray:
+    """Count the cameras installed by the end of each year, by area.
+
+    :param camera_years ndarray: installation year of the cameras, NaN if unknown
+    :param codes ndarray: area code of the cameras, -1 outside every area
+    :param years Sequence[int]: years of the rows
+    :param size int: number of areas
+    """
+    # Undated cameras, or dated before the first year, count from the first year
+    rows = np.searchsorted(years, np.nan_to_num(camera_years, nan=0), side="left")
+    keep = (codes >= 0) & (rows < len(years))
+    counts = np.zeros((len(years), size))
+    np.add.at(counts, (rows[keep], codes[keep]), 1)
+    return counts.cumsum(axis=0)
+
+
+def locate_cameras(cameras: DataFrame, communes: GeometryStore) -> np.ndarray:
+    """Return the name of the commune of each camera, None outside France.
+
+    Cameras are joined to the communes a département at a time, so that only
+    the outlines of one are built at once.
+
+    :param cameras DataFrame: Latitude and Longitude of the cameras
+    :param communes GeometryStore: outlines of the communes, with libgeo and dep
+    """
+    # Not imported with the module, which the ingestion imports
+    import geopandas as gpd  # noqa: PLC0415
+
+    cities = np.full(len(cameras), None, dtype=object)
+    longitudes = cameras["Longitude"].to_numpy()
+    latitudes = cameras["Latitude"].to_numpy()
+    for dep in communes.attributes["dep"].unique():
+        rows = communes.partition("dep", dep)
+        min_x, min_y, max_x, max_y = communes.bounds(rows)
+        inside = np.flatnonzero(
+            (longitudes >= min_x) & (longitudes <= max_x)
+            & (latitudes >= min_y) & (latitudes <= max_y),
+        )
+        if not len(inside):
+            continue
+        points = gpd.GeoDataFrame(
+            geometry=gpd.points_from_xy(longitudes[inside], latitudes[inside]),
+            index=inside,
+            crs="EPSG:4326",
+        )
+        outlines = gpd.GeoDataFrame(
+            {"libgeo": communes.attributes["libgeo"].iloc[rows].to_numpy()},
+            geometry=communes.geoseries(rows).to_numpy(),
+            crs="EPSG:4326",
+        )
+        joined = gpd.sjoin(points, outlines, predicate="within")
+        joined = joined[~joined.index.duplicated()]
+        cities[joined.index] = joined["libgeo"].to_numpy()
+    return cities
+
+
+def analytics_inputs(
+    cameras_path: Path,
+    communes_path: Path,
+    store_path: Path,
+) -> str:
+    """Return a description of the inputs of the statistics.
+
+    Files are described by their content, as the ingestion rewrites them, and
+    the crimes by the source fingerprint of their years, or by the crime
+    store itself when they were cleaned without yearly partitions.
+
+    :param cameras_path Path: cameras table
+    :param communes_path Path: geometry store of the communes
+    :param store_path Path: crime store
+    """
+    years = year_state(YEARS_PATH)
+    paths = [cameras_path, communes_path / "attributes.csv"]
+    if not years:
+        paths.append(store_path / "cases_cum.npy")
+    files = {str(path): fingerprint([path]) for path in paths if path.exists()}
+    return dumps({"files": files, "years": years}, indent=2)
+
+
+def precompute_analytics(
+    cameras_path: Path = CLEANED_PATH / "cameras_unified.csv",
+    communes_path: Path = GEOMETRY_PATH / "communes",
+    store_path: Path = STORE_PATH,
+    output: Path = ANALYTICS_PATH,
+) -> None:
+    """Compute every statistic and write cross_section.csv and areas.csv.
+
+    The commune of every row of the cameras table, empty outside France, is
+    written to camera_communes.csv for the exports by area.
+
+    :param cameras_path Path: cameras table, with Latitude, Longitude, Timestamp
+    :param communes_path Path: geometry store of the communes
+    :param store_path Path: crime store
+    :param output Path: directory of the results
+    """
+    if not cameras_path.exists():
+        cameras_path = CLEANED_PATH / "osm_cleaned.csv"
+    inputs = analytics_inputs(cameras_path, communes_path, store_path)
+    inputs_path = output / "inputs.json"
+    outputs = [output / name for name in ("cross_section.csv", "areas.csv")]
+    outputs.append(output / CAMERA_COMMUNES)
+    if (
+        all(path.exists() for path in outputs)
+        and inputs_path.exists()
+        and inputs_path.read_text() == inputs
+    ):
+        print("Analytics: crimes and cameras unchanged, statistics kept")
+        return
+    rows = read_csv(cameras_path, usecols=["Latitude", "Longitude", "Timestamp"])
+    cameras = rows.dropna(subset=["Latitude", "Longitude"])
+    communes = GeometryStore.open(communes_path)
+    store = CrimeStore.open(store_path)
+    years = store.years
+
+    camera_cities = locate_cameras(cameras, communes)
+    city_codes = {city: code for code, city in enumerate(store.cities)}
+    codes = np.array([city_codes.get(city, -1) for city in camera_cities])
+    camera_years = to_datetime(cameras["Timestamp"], errors="coerce").dt.year
+    city_cameras = camera_matrix(
+        camera_years.to_numpy(dtype=float),
+        codes,
+        years,
+        len(store.cities),
+    )
+
+    cross_sections, areas = [], []
+    for level, column in LEVELS.items():
+        mapping = None
+        level_cameras = city_cameras
+        if column:
+            mapping = communes.attributes.set_index("libgeo")[column]
+            group_codes, labels = store.group_codes(mapping)
+            level_cameras = sum_by_code(city_cameras, group_codes, len(labels))
+        cases, pop, keys = store.yearly(mapping)
+        # Areas whose population is known every year
+        valid = (pop > 0).all(axis=0)
+        density = level_cameras[:, valid] / pop[:, valid] * 10_000
+        rate = cases[:, valid] / pop[:, valid] * 1_000
+        cross_sections.append(
+            cross_section(density, rate, years).assign(Level=level),
+        )
+        areas.append(area_series(density, rate, keys[valid]).assign(Level=level))
+
+    output.mkdir(parents=True, exist_ok=True)
+    DataFrame(
+        {"City": Series(camera_cities, index=cameras.index).reindex(rows.index)},
+    ).to_csv(output / CAMERA_COMMUNES, index=False)
+    concat(cross_sections, ignore_index=True).to_csv(
+        output / "cross_section.csv",
+        index=False,
+    )
+    concat(areas, ignore_index=True).to_csv(output / "areas.csv", index=False)
+    inputs_path.write_text(inputs)
+    report_io(rows_in=len(cameras), rows_out=sum(len(a) for a in areas))
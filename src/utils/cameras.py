@@ -0,0 +1,211 @@
+"""Reconciliation of the camera sources (OSM and Shodan) into one table.
+
+A camera of a lower-priority source lying within a distance threshold of a
+camera already kept is a duplicate of it. Matching is one-to-one, nearest
+pairs first: a kept camera absorbs at most one camera of each other source.
+Neighbours are found with a spatial hash: points are bucketed in square cells
+of the threshold size, so only the 3x3 surrounding cells have to be searched,
+with sorted cell keys and numpy.searchsorted.
+"""
+from __future__ import annotations
+
+from pathlib import Path
+
+import numpy as np
+from pandas import DataFrame, concat, read_csv
+
+from src.utils.run_report import report_io
+
+CLEANED_PATH = Path("./", "data", "cleaned")
+UNIFIED_PATH = CLEANED_PATH / "cameras_unified.csv"
+DEDUP_DISTANCE = 30.0  # metres
+# OSM positions are surveyed, Shodan ones come from IP geolocation
+SOURCE_PRIORITY = ("osm", "shodan")
+EARTH_RADIUS = 6_371_000.0  # metres
+UNIFIED_COLUMNS = [
+    "Latitude",
+    "Longitude",
+    "Timestamp",
+    "Source",
+    "Source_ID",
+    "Also_In",
+]
+
+
+def project(lat: np.ndarray, lon: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Project coordinates to metres with a local equirectangular projection.
+
+    :param lat ndarray: latitudes in degrees
+    :param lon ndarray: longitudes in degrees
+    """
+    lat_rad = np.radians(lat)
+    return EARTH_RADIUS * np.radians(lon) * np.cos(lat_rad), EARTH_RADIUS * lat_rad
+
+
+def _cell_keys(cx: np.ndarray, cy: np.ndarray) -> np.ndarray:
+    return (cx.astype(np.int64) << 32) + (cy.astype(np.int64) & 0xFFFFFFFF)
+
+
+def pairs_within(
+    ref_xy: tuple[np.ndarray, np.ndarray],
+    query_xy: tuple[np.ndarray, np.ndarray],
+    threshold: float,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return the pairs of query and reference points closer than threshold.
+
+    Returns the query indices, reference indices and squared distances.
+
+    :param ref_xy tuple: projected x and y of the reference points
+    :param query_xy tuple: projected x and y of the query points
+    :param threshold float: maximum distance, in metres
+    """
+    ref_x, ref_y = ref_xy
+    query_x, query_y = query_xy
+    parts = []
+    if len(ref_x) and len(query_x):
+        keys = _cell_keys(np.floor(ref_x / threshold), np.floor(ref_y / threshold))
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        qcx = np.floor(query_x / threshold)
+        qcy = np.floor(query_y / threshold)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                qkeys = _cell_keys(qcx + dx, qcy + dy)
+                left = np.searchsorted(keys, qkeys, side="left")
+                counts = np.searchsorted(keys, qkeys, side="right") - left
+                total = int(counts.sum())
+                if not total:
+                    continue
+                query_idx = np.repeat(np.arange(len(query_x)), counts)
+                offsets = np.arange(total) - np.repeat(
+                    np.cumsum(counts) - counts,
+                    counts,
+                )
+                cand = order[np.repeat(left, counts) + offsets]
+                d2 = (ref_x[cand] - query_x[query_idx]) ** 2 + (
+                    ref_y[cand] - query_y[query_idx]
+                ) ** 2
+                near = d2 <= threshold**2
+                parts.append((query_idx[near], cand[near], d2[near]))
+    if not parts:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0)
+    query_idx, ref_idx, d2 = (np.concatenate(p) for p in zip(*parts, strict=True))
+    return query_idx, ref_idx, d2
+
+
+def match_within(
+    ref_xy: tuple[np.ndarray, np.ndarray],
+    query_xy: tuple[np.ndarray, np.ndarray],
+    threshold: float,
+) -> np.ndarray:
+    """Pair query points one-to-one with reference points within threshold.
+
+    Returns the reference point matched to each query point, -1 if none.
+    Pairs are taken greedily, nearest first, so that a reference point is
+    matched to at most one query point: cameras stacked on a city-level
+    geolocation are not all merged into the one camera found there.
+
+    :param ref_xy tuple: projected x and y of the reference points
+    :param query_xy tuple: projected x and y of the query points
+    :param threshold float: maximum distance, in metres
+    """
+    query_idx, ref_idx, d2 = pairs_within(ref_xy, query_xy, threshold)
+    match = np.full(len(query_xy[0]), -1, dtype=np.int64)
+    # Nearest first, ties broken by query then reference index
+    order = np.lexsort((ref_idx, query_idx, d2))
+    query_idx, ref_idx = query_idx[order], ref_idx[order]
+    while len(query_idx):
+        # The first pair of a point links it to its nearest free partner; the
+        # pairs first for both of their points are those greedy matching takes
+        _, query_first = np.unique(query_idx, return_index=True)
+        _, ref_first = np.unique(ref_idx, return_index=True)
+        taken = np.intersect1d(query_first, ref_first)
+        match[query_idx[taken]] = ref_idx[taken]
+        free = (match[query_idx] < 0) & ~np.isin(ref_idx, ref_idx[taken])
+        query_idx, ref_idx = query_idx[free], ref_idx[free]
+    return match
+
+
+def unify_cameras(
+    sources: dict[str, DataFrame],
+    threshold: float = DEDUP_DISTANCE,
+    priority: tuple[str, ...] = SOURCE_PRIORITY,
+) -> DataFrame:
+    """Merge camera tables, keeping each camera once.
+
+    Each table needs Latitude, Longitude, Timestamp and Source_ID columns.
+    Sources are merged in priority order; the row kept for a duplicate lists
+    the other sources it was seen in, in Also_In.
+
+    :param sources dict: camera tables by source name
+    :param threshold float: distance under which two cameras are the same
+    :param priority tuple: source names, highest priority first
+    """
+    names = [name for name in priority if name in sources]
+    names += [name for name in sources if name not in names]
+    unified = DataFrame(columns=UNIFIED_COLUMNS)
+    kept_x = np.zeros(0)
+    kept_y = np.zeros(0)
+    for name in names:
+        df = sources[name].dropna(subset=["Latitude", "Longitude"])
+        df = df.assign(Source=name, Also_In="")[UNIFIED_COLUMNS]
+        x, y = project(
+            df["Latitude"].to_numpy(dtype=float),
+            df["Longitude"].to_numpy(dtype=float),
+        )
+        match = match_within((kept_x, kept_y), (x, y), threshold)
+        matched = match[match >= 0]
+        if len(matched):
+            also_in = unified["Also_In"].to_numpy(dtype=object)
+            also_in[matched] = [f"{v}|{name}" if v else name for v in also_in[matched]]
+            unified["Also_In"] = also_in
+        fresh = match < 0
+        parts = [part for part in (unified, df[fresh]) if len(part)]
+        unified = concat(parts, ignore_index=True) if parts else unified
+        kept_x = np.concatenate([kept_x, x[fresh]])
+        kept_y = np.concatenate([kept_y, y[fresh]])
+    return unified
+
+
+def read_osm_cameras(path: Path = CLEANED_PATH / "osm_cleaned.csv") -> DataFrame:
+    """Read the cleaned OSM cameras as a unify_cameras source."""
+    osm = read_csv(path)
+    return osm.rename(columns={"OSM_ID": "Source_ID"})
+
+
+def read_shodan_cameras(
+    path: Path = CLEANED_PATH / "shodan_camera_fr.csv",
+) -> DataFrame:
+    """Read the cleaned Shodan banners as a unify_cameras source, one row per IP."""
+    shodan = read_csv(path).drop_duplicates(subset="IP")
+    # Banner dates are kept at the month, like the OSM installation dates
+    shodan["Timestamp"] = shodan["Timestamp"].astype("string").str[:7]
+    return shodan.rename(columns={"IP": "Source_ID"})
+
+
+def unify_camera_files(
+    threshold: float = DEDUP_DISTANCE,
+    priority: tuple[str, ...] = SOURCE_PRIORITY,
+    output: Path = UNIFIED_PATH,
+) -> DataFrame:
+    """Build the unified camera table from the cleaned sources that exist.
+
+    :param threshold float: distance under which two cameras are the same
+    :param priority tuple: source names, highest priority first
+    :param output Path: where the unified table is written
+    """
+    readers = {"osm": read_osm_cameras, "shodan": read_shodan_cameras}
+    sources = {}
+    for name, reader in readers.items():
+        try:
+            sources[name] = reader()
+        except (FileNotFoundError, KeyError) as e:
+            print(f"Camera source {name} unavailable: {e!r}")
+    unified = unify_cameras(sources, threshold, priority)
+    unified.to_csv(output, index=False)
+    report_io(
+        rows_in=sum(len(df) for df in sources.values()),
+        rows_out=len(unified),
+    )
+    return unified
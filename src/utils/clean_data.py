@@ -1,53 +1,80 @@
 """clean_data module provides functions to clean the data needed for the dashboard."""
 from __future__ import annotations
 
+from array import array
 from json import JSONDecodeError, loads
 from pathlib import Path
 from re import compile as recompile
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
-from pandas import DataFrame, read_csv, to_numeric
+import numpy as np
+from pandas import DataFrame, concat, read_csv, to_numeric
 
+from src.utils.crime_store import write_crime_store
+from src.utils.crime_years import (
+    changed_years,
+    concat_years,
+    drop_years,
+    fingerprint,
+    iter_years,
+    split_years,
+    write_year,
+    write_year_state,
+    year_state,
+)
+from src.utils.geometry_store import write_geometry_store
+from src.utils.partitions import iter_partitions, memory_budget
+from src.utils.run_report import report_io
 from src.utils.utils import move_geojson_file
 
+if TYPE_CHECKING:
+    from collections.abc import Iterable
 
-def clean_data(file: Path, french_cities: Path) -> None:
+
+def clean_data(file: Path, french_cities: Path | None = None) -> None:
     """Clean the base CSV/GeoJSON data.
 
     :param Path file: File to clean
-    :param Path french_cities: File used to cross-reference cities with file.
+    :param Path french_cities: File used to cross-reference cities with file,
+        needed by the crimes CSV only.
     """
     match file.suffix:
         case ".csv":
             clean_csv_data(file, french_cities)
         case ".geojson":
             move_geojson_file(file)
+            write_geometry_store(Path("./", "data", "cleaned", file.name))
 
-def clean_csv_data(file: Path, french_cities: Path) -> None:
-    """Clean the crimes csv.
+# DataTypes for the crimes CSV
+CRIMES_DTYPE = {
+    "CODGEO_2024": str,
+    "annee": int,
+    "classe": str,
+    "unité.de.compte": str,
+    "valeur.publiée": str,
+    "tauxpourmille": object,
+    "faits": float,
+    "complementinfoval": str,
+    "complementinfotaux": str,
+    "POP": int,
+    "millPOP": int,
+    "LOG": object,
+    "millLOG": int,
+}
+RAW_ROW_BYTES = 700  # memory of a loaded row of the crimes CSV
 
-    :param Path file: File to clean
-    :param Path french_cities: File used to cross-reference cities with file.
-    """
-    # DataTypes for CSV
-    dtype = {
-        "CODGEO_2024": str,
-        "annee": int,
-        "classe": str,
-        "unité.de.compte": str,
-        "valeur.publiée": str,
-        "tauxpourmille": object,
-        "faits": float,
-        "complementinfoval": str,
-        "complementinfotaux": str,
-        "POP": int,
-        "millPOP": int,
-        "LOG": object,
-        "millLOG": int,
-    }
 
-    # Reads the csv
-    crimes_df = read_csv(file, delimiter=";", decimal=",", dtype=dtype)
+def aggregate_crimes(
+    crimes_df: DataFrame,
+) -> tuple[DataFrame, DataFrame, DataFrame]:
+    """Clean raw crime rows and aggregate them by commune and year.
+
+    Returns the totals, the population and the cases by class, by commune
+    and year. Communes are never split between calls, so that the results of
+    several partitions can be concatenated.
+
+    :param crimes_df DataFrame: rows of the crimes CSV
+    """
     # Convert year to int and prepend "20"
     crimes_df["annee"] = crimes_df["annee"].apply(lambda x: int(f"20{x:02d}"))
     # Handle geographical codes
@@ -78,45 +105,244 @@ def clean_csv_data(file: Path, french_cities: Path) -> None:
     cat_cols = ["classe", "unité.de.compte", "valeur.publiée"]
     crimes_df[cat_cols] = crimes_df[cat_cols].astype("category")
     crimes_df = crimes_df.drop(["complementinfoval", "complementinfotaux"], axis=1)
+    # The population is repeated on every class of a commune
+    population_df = (
+        crimes_df.groupby(["CODGEO_2024", "annee"])["POP"].max().reset_index()
+    )
+    classes_df = (
+        crimes_df.groupby(["CODGEO_2024", "annee", "classe"], observed=True)["faits"]
+        .sum()
+        .reset_index()
+    )
     crimes_df = (
         crimes_df.groupby(["CODGEO_2024", "annee"]).sum(numeric_only=True).reset_index()
     )
+    return crimes_df, population_df, classes_df
+
+
+def clean_year(
+    partitions: list[Path],
+    french_cities_df: DataFrame,
+) -> dict[str, DataFrame]:
+    """Clean the raw crimes of a year, one partition at a time.
+
+    Returns the totals by commune (crimes), the cases by class (facts) and the
+    population (population) of the year.
+
+    :param partitions list[Path]: raw partitions of the year
+    :param french_cities_df DataFrame: COM and NCCENR of the French cities
+    """
+    city_names = french_cities_df.drop_duplicates("COM").set_index("COM")["NCCENR"]
+    crimes, facts, populations = [], [], []
+    for partition in iter_partitions(partitions, dtype=CRIMES_DTYPE):
+        report_io(rows_in=len(partition))
+        crimes_df, population_df, classes_df = aggregate_crimes(partition)
+        facts.append(
+            DataFrame({
+                "City": classes_df["CODGEO_2024"].map(city_names),
+                "Year": classes_df["annee"].astype("int16"),
+                "Class": classes_df["classe"].astype(str),
+                "Cases": classes_df["faits"].astype("float32"),
+            }),
+        )
+        populations.append(
+            DataFrame({
+                "City": population_df["CODGEO_2024"].map(city_names),
+                "Year": population_df["annee"],
+                "POP": population_df["POP"],
+            }),
+        )
+
+        # Merge dataframes to replace CODGEO_2024 with NCCENR
+        merged_df = crimes_df.merge(
+            french_cities_df,
+            left_on="CODGEO_2024",
+            right_on="COM",
+            how="left",
+        )
+        merged_df["CODGEO_2024"] = merged_df["NCCENR"]
 
+        # Drop various unused columns
+        merged_df = merged_df.drop(
+            columns=["COM", "NCCENR", "millPOP", "LOG", "millLOG", "tauxpourmille"],
+        )
+        crimes.append(
+            merged_df.rename(
+                columns={"CODGEO_2024": "City", "annee": "Year", "faits": "Cases"},
+            ),
+        )
+    return {
+        "crimes": concat(crimes, ignore_index=True),
+        "facts": concat(facts, ignore_index=True),
+        "population": concat(populations, ignore_index=True),
+    }
+
+
+def clean_csv_data(file: Path, french_cities: Path) -> None:
+    """Clean the crimes csv, only the years whose rows changed.
+
+    The raw rows are split by year (and département under MEMORY_BUDGET_MB),
+    each year being cleaned again only when its rows or the French cities
+    changed since the previous ingestion. The cleaned table and the crime
+    store are then assembled from the yearly partitions, one year at a time.
+
+    :param Path file: File to clean
+    :param Path french_cities: File used to cross-reference cities with file.
+    """
     # Load French cities data
     communes_cols = ["COM", "NCCENR"]
-    french_cities_df = read_csv(french_cities, usecols=communes_cols)
-
-    # Merge dataframes to replace CODGEO_2024 with NCCENR
-    merged_df = crimes_df.merge(
-        french_cities_df,
-        left_on="CODGEO_2024",
-        right_on="COM",
-        how="left",
-    )
-    merged_df["CODGEO_2024"] = merged_df["NCCENR"]
+    french_cities_df = read_csv(french_cities, usecols=communes_cols, dtype=str)
 
-    # Drop various unused columns
-    merged_df = merged_df.drop(
-        columns=["COM", "NCCENR", "millPOP", "LOG", "millLOG", "tauxpourmille"],
+    partitions = split_years(
+        file,
+        file.parent / "partitions",
+        memory_budget(),
+        RAW_ROW_BYTES,
+        delimiter=";",
+        decimal=",",
+        dtype=CRIMES_DTYPE,
     )
-    merged_df = merged_df.rename(
-        columns={"CODGEO_2024": "City", "annee": "Year", "faits": "Cases"},
+    fingerprints = {
+        year: fingerprint([*paths, french_cities])
+        for year, paths in partitions.items()
+    }
+    changed = changed_years(fingerprints)
+    print(f"Crimes: cleaning {len(changed)} of {len(partitions)} years {changed}")
+    for year in changed:
+        write_year(year, clean_year(partitions[year], french_cities_df))
+    drop_years(sorted(set(map(int, year_state())) - set(fingerprints)))
+    write_year_state({str(year): digest for year, digest in fingerprints.items()})
+    for paths in partitions.values():
+        for path in paths:
+            path.unlink()
+
+    # Saves the whole table and the store, assembled from the yearly partitions
+    cleaned_file = Path("./", "data", "cleaned", file.parts[-1])
+    concat_years("crimes", cleaned_file)
+    facts = write_crime_store(
+        lambda: zip(iter_years("facts"), iter_years("population"), strict=True),
     )
+    report_io(rows_out=facts)
+
+class CameraCollector:
+    """Accumulate OSM surveillance elements into compact arrays.
+
+    Every node (tagged or from the `>; out skel qt;` output) goes into a
+    node-id -> coordinates index, tagged nodes and ways are the cameras and the
+    node references of ways are kept flat with per-way offsets, so that way
+    centroids are computed at once in to_frame.
+    """
+
+    def __init__(self) -> None:
+        """Create an empty collector."""
+        self.node_ids = array("q")
+        self.node_lats = array("d")
+        self.node_lons = array("d")
+        self.way_refs = array("q")
+        self.way_offsets = array("q", [0])
+        self.cameras: dict[str, str | None] = {}
+        self.way_cameras: list[str] = []
+        self.elements = 0
+
+    def add(self, element: dict[str, Any]) -> None:
+        """Add one Overpass element.
+
+        :param element dict: a node or a way, duplicates are ignored
+        """
+        self.elements += 1
+        kind, osm_id = element.get("type"), element.get("id")
+        if kind == "node":
+            self.node_ids.append(osm_id)
+            self.node_lats.append(element["lat"])
+            self.node_lons.append(element["lon"])
+        key = f"{kind}/{osm_id}"
+        if "tags" not in element or key in self.cameras:
+            return
+        if kind == "way" and element.get("nodes"):
+            self.way_refs.extend(element["nodes"])
+            self.way_offsets.append(len(self.way_refs))
+            self.way_cameras.append(key)
+        elif kind != "node":
+            return
+        self.cameras[key] = extract_date(element["tags"])
+
+    def _node_index(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return the sorted unique node ids and their coordinates."""
+        ids, first = np.unique(
+            np.frombuffer(self.node_ids, dtype=np.int64),
+            return_index=True,
+        )
+        lats = np.frombuffer(self.node_lats, dtype=np.float64)[first]
+        lons = np.frombuffer(self.node_lons, dtype=np.float64)[first]
+        return ids, lats, lons
+
+    @staticmethod
+    def _lookup(
+        index: tuple[np.ndarray, np.ndarray, np.ndarray],
+        refs: np.ndarray,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return whether each node reference is known, and its coordinates."""
+        ids, lats, lons = index
+        if not len(ids):
+            missing = np.full(len(refs), np.nan)
+            return np.zeros(len(refs), dtype=bool), missing, missing
+        pos = np.searchsorted(ids, refs).clip(max=len(ids) - 1)
+        found = ids[pos] == refs
+        return (
+            found,
+            np.where(found, lats[pos], np.nan),
+            np.where(found, lons[pos], np.nan),
+        )
+
+    def _way_centroids(
+        self,
+        index: tuple[np.ndarray, np.ndarray, np.ndarray],
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Return the mean coordinates of the nodes of each way."""
+        refs = np.frombuffer(self.way_refs, dtype=np.int64)
+        if not len(refs):
+            return np.zeros(0), np.zeros(0)
+        offsets = np.frombuffer(self.way_offsets, dtype=np.int64)
+        starts, ends = offsets[:-1], offsets[1:]
+        found, lats, lons = self._lookup(index, refs)
+        weight = found.astype(np.float64)
+        # The closing node of a closed way repeats its first node
+        closed = (ends - starts > 1) & (refs[ends - 1] == refs[starts])
+        weight[ends[closed] - 1] = 0
+        counts = np.add.reduceat(weight, starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            way_lats = np.add.reduceat(np.where(weight > 0, lats, 0), starts) / counts
+            way_lons = np.add.reduceat(np.where(weight > 0, lons, 0), starts) / counts
+        return way_lats, way_lons
+
+    def to_frame(self) -> DataFrame:
+        """Return one row per camera with its coordinates."""
+        node_keys = [key for key in self.cameras if key.startswith("node/")]
+        node_refs = np.array([int(key[5:]) for key in node_keys], dtype=np.int64)
+        index = self._node_index()
+        _, node_lats, node_lons = self._lookup(index, node_refs)
+        way_lats, way_lons = self._way_centroids(index)
+        keys = node_keys + self.way_cameras
+        return DataFrame({
+            "Latitude": np.concatenate([node_lats, way_lats]),
+            "Longitude": np.concatenate([node_lons, way_lons]),
+            "Timestamp": [self.cameras[key] for key in keys],
+            "OSM_ID": keys,
+        })
 
-    # Saves the resulting DataFrame
-    merged_df.to_csv(Path("./", "data", "cleaned", file.parts[-1]), index=False)
 
-def clean_osm_data(data: dict[Any, Any]) -> None:
+def clean_osm_data(data: Iterable[dict[Any, Any]]) -> None:
     """Clean OpenStreetMap data.
 
-    :param dict[any:any] data: Data retrieved from Overpass Turbo (OSM API)
+    :param Iterable[dict] data: Elements retrieved from Overpass Turbo (OSM API),
+        consumed one at a time
     """
-    osm_df = DataFrame(data)
-    osm_df["tags"] = osm_df["tags"].apply(extract_date)
-    osm_df = osm_df.drop(columns=["type", "id", "nodes"])
-    osm_df = osm_df.rename(
-        columns={"lat": "Latitude", "lon": "Longitude", "tags": "Timestamp"})
+    collector = CameraCollector()
+    for element in data:
+        collector.add(element)
+    osm_df = collector.to_frame()
     osm_df.to_csv(Path("./", "data", "cleaned", "osm_cleaned.csv"), index=False)
+    report_io(rows_in=collector.elements, rows_out=len(osm_df))
 
 
 def extract_date(tag: dict | str = "") -> str | None:
@@ -156,6 +382,7 @@ def clean_shodan_result(shodan_result: dict, *, fallback: bool = False) -> list:
         return [
             {
                 "IP": shodan_result.get("ip_str"),
+                "Port": shodan_result.get("port"),
                 "City": shodan_result.get("location", {}).get("city"),
                 "Region": shodan_result.get("location", {}).get("region_code"),
                 "Longitude": shodan_result.get("location", {}).get("longitude"),
@@ -169,6 +396,7 @@ def clean_shodan_result(shodan_result: dict, *, fallback: bool = False) -> list:
     for match in shodan_result.get("matches", []):
         cleaned_result = {
             "IP": match.get("ip_str"),
+            "Port": match.get("port"),
             "City": match.get("location", {}).get("city"),
             "Region": match.get("location", {}).get("region_code"),
             "Longitude": match.get("location", {}).get("longitude"),
@@ -0,0 +1,344 @@
+"""Columnar store of the crimes by commune, year and crime class.
+
+clean_csv_data writes one .npy file per column in data/cleaned/crimes. The
+commune and the crime class are dictionary-encoded, their labels being kept
+in dictionaries.json, so that a fact takes 11 bytes. The population is stored
+once per commune and year, next to the facts.
+
+The store also holds prefix sums over the years, as dense class x year x
+commune matrices: the cases of communes over the years [a, b] are
+cum[:, b + 1] - cum[:, a], whatever the width of the range. Arrays are
+memory-mapped.
+"""
+from __future__ import annotations
+
+from json import dumps, loads
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from pandas import DataFrame, factorize
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Collection, Iterable, Iterator
+
+    from pandas import Series
+
+STORE_PATH = Path("./", "data", "cleaned", "crimes")
+ALL_CLASSES = "Ensemble des infractions"  # class of stores without classes
+FACT_COLUMNS = {"city": "int32", "year": "int16", "classe": "int8", "cases": "float32"}
+POP_COLUMNS = {"pop_city": "int32", "pop_year": "int16", "pop": "float32"}
+# Prefix sums: cases by class, the population and the years it is known
+CUMULATIVE_COLUMNS = ("cases_cum", "pop_cum", "pop_seen_cum")
+
+
+def _allocate(_name: str, shape: tuple[int, ...], dtype: str) -> np.ndarray:
+    return np.zeros(shape, dtype=dtype)
+
+
+def _known_rows(
+    parts: Iterable[tuple[DataFrame, DataFrame]],
+) -> Iterator[tuple[DataFrame, DataFrame]]:
+    """Drop the facts and population rows without a city or a class."""
+    for facts, population in parts:
+        yield (
+            facts.dropna(subset=["City", "Class"]),
+            population.dropna(subset=["City"]),
+        )
+
+
+def build_columns(
+    parts: Callable[[], Iterable[tuple[DataFrame, DataFrame]]],
+    allocate: Callable[[str, tuple[int, ...], str], np.ndarray] = _allocate,
+) -> tuple[dict[str, np.ndarray], dict]:
+    """Encode the crimes into store columns and dictionaries.
+
+    The parts are read twice, once for the dictionaries and once to fill the
+    columns, so that only one part (e.g. a year) is in memory at a time.
+
+    :param parts Callable: returns the facts (City, Year, Class and Cases, one
+        row per class) and population (City, Year and POP, one row per commune)
+        of each part
+    :param allocate Callable: returns a zeroed column from its name, shape and
+        dtype, in memory by default
+    """
+    cities, classes, years = set(), set(), set()
+    fact_count = pop_count = 0
+    for facts, population in _known_rows(parts()):
+        cities.update(facts["City"], population["City"])
+        classes.update(facts["Class"])
+        years.update(facts["Year"], population["Year"])
+        fact_count += len(facts)
+        pop_count += len(population)
+    dictionaries = {
+        "cities": sorted(cities),
+        "classes": sorted(classes),
+        "years": sorted(int(year) for year in years),
+    }
+    city_codes = {city: code for code, city in enumerate(dictionaries["cities"])}
+    class_codes = {
+        classe: code for code, classe in enumerate(dictionaries["classes"])
+    }
+    year_axis = np.asarray(dictionaries["years"])
+
+    columns = {
+        name: allocate(name, (pop_count if name in POP_COLUMNS else fact_count,), dtype)
+        for name, dtype in (FACT_COLUMNS | POP_COLUMNS).items()
+    }
+    # Row 0 of the year axis is the empty prefix
+    shape = (len(year_axis) + 1, len(cities))
+    cases = np.zeros((len(classes), *shape))
+    pop = allocate("pop_cum", shape, "float64")  # large cities exceed 2**24
+    pop_seen = allocate("pop_seen_cum", shape, "int16")
+    fact_start = pop_start = 0
+    for facts, population in _known_rows(parts()):
+        values = {
+            "city": facts["City"].map(city_codes),
+            "year": facts["Year"],
+            "classe": facts["Class"].map(class_codes),
+            "cases": facts["Cases"].fillna(0),
+            "pop_city": population["City"].map(city_codes),
+            "pop_year": population["Year"],
+            "pop": population["POP"].fillna(0),
+        }
+        part = {
+            name: v.to_numpy(dtype=columns[name].dtype) for name, v in values.items()
+        }
+        fact_end, pop_end = fact_start + len(facts), pop_start + len(population)
+        for name, v in part.items():
+            if name in POP_COLUMNS:
+                columns[name][pop_start:pop_end] = v
+            else:
+                columns[name][fact_start:fact_end] = v
+        fact_start, pop_start = fact_end, pop_end
+        np.add.at(
+            cases,
+            (
+                part["classe"],
+                np.searchsorted(year_axis, part["year"]) + 1,
+                part["city"],
+            ),
+            part["cases"],
+        )
+        pop_index = (np.searchsorted(year_axis, part["pop_year"]) + 1, part["pop_city"])
+        np.add.at(pop, pop_index, part["pop"])
+        np.add.at(pop_seen, pop_index, part["pop"] > 0)
+    np.cumsum(cases, axis=1, out=cases)
+    columns["cases_cum"] = allocate("cases_cum", cases.shape, "float32")
+    columns["cases_cum"][...] = cases
+    columns["pop_cum"] = np.cumsum(pop, axis=0, out=pop)
+    columns["pop_seen_cum"] = np.cumsum(pop_seen, axis=0, out=pop_seen)
+    return columns, dictionaries
+
+
+def write_crime_store(
+    parts: Callable[[], Iterable[tuple[DataFrame, DataFrame]]],
+    directory: Path = STORE_PATH,
+) -> int:
+    """Write the crime store, one part at a time, and return its fact count.
+
+    Columns are written through memory-mapped files, so that neither the facts
+    nor the store are held in memory.
+
+    :param parts Callable: returns the facts and population of each part, see
+        build_columns
+    :param directory Path: directory of the store
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+
+    def allocate(name: str, shape: tuple[int, ...], dtype: str) -> np.ndarray:
+        path = directory / f"{name}.npy"
+        return open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+    columns, dictionaries = build_columns(parts, allocate)
+    for values in columns.values():
+        values.flush()
+    # Written last, its modification time versions the store
+    (directory / "dictionaries.json").write_text(
+        dumps(dictionaries, ensure_ascii=False),
+    )
+    return len(columns["city"])
+
+
+def sum_by_code(matrix: np.ndarray, codes: np.ndarray, size: int) -> np.ndarray:
+    """Sum the last axis of matrix by code, ignoring negative codes."""
+    known = codes >= 0
+    rows = np.asarray(matrix, dtype="float64").reshape(-1, matrix.shape[-1])
+    summed = np.zeros((len(rows), size))
+    for i, row in enumerate(rows):
+        summed[i] = np.bincount(codes[known], row[known], minlength=size)
+    return summed.reshape(*matrix.shape[:-1], size)
+
+
+class CrimeStore:
+    """Read side of the crime store."""
+
+    def __init__(self, columns: dict[str, np.ndarray], dictionaries: dict) -> None:
+        """Wrap the columns of a store.
+
+        :param columns dict: arrays named as in FACT_COLUMNS, POP_COLUMNS and
+            CUMULATIVE_COLUMNS
+        :param dictionaries dict: labels of the cities, classes and years
+        """
+        for name, values in columns.items():
+            setattr(self, name, values)
+        self.cities: list[str] = dictionaries["cities"]
+        self.classes: list[str] = dictionaries["classes"]
+        self.years: list[int] = dictionaries["years"]
+        self._group_sums: dict[str, tuple[np.ndarray, ...]] = {}
+        self._city_codes: dict[str, int] = {}
+
+    @classmethod
+    def open(cls, directory: Path = STORE_PATH) -> CrimeStore:
+        """Memory-map the store of directory.
+
+        :param directory Path: directory of the store
+        """
+        names = [*FACT_COLUMNS, *POP_COLUMNS, *CUMULATIVE_COLUMNS]
+        columns = {
+            name: np.load(directory / f"{name}.npy", mmap_mode="r") for name in names
+        }
+        return cls(columns, loads((directory / "dictionaries.json").read_text()))
+
+    @classmethod
+    def from_crimes(cls, crimes: DataFrame) -> CrimeStore:
+        """Build an in-memory store from the aggregated crimes table.
+
+        Used with datasets cleaned before the store existed; every crime is
+        then of the ALL_CLASSES class.
+
+        :param crimes DataFrame: City, Year, Cases and POP
+        """
+        crimes = crimes.assign(City=crimes["City"].astype(str), Class=ALL_CLASSES)
+        population = crimes.groupby(["City", "Year"], as_index=False)["POP"].max()
+        return cls(*build_columns(lambda: [(crimes, population)]))
+
+    def _prefix_sums(self, mapping: Series | None) -> tuple[np.ndarray, ...]:
+        """Return the prefix sums by city, or by group of mapping.
+
+        Group sums are computed once per mapping name.
+        """
+        if mapping is None:
+            return self.cases_cum, self.pop_cum, self.pop_seen_cum
+        if mapping.name not in self._group_sums:
+            codes, labels = self.group_codes(mapping)
+            # Summing cities into groups commutes with the prefix sums
+            cases_cum = sum_by_code(self.cases_cum, codes, len(labels))
+            pop_cum = sum_by_code(self.pop_cum, codes, len(labels))
+            # A group is known the years any of its cities is
+            seen = np.diff(pop_cum, axis=0, prepend=0) > 0
+            self._group_sums[mapping.name] = (
+                cases_cum,
+                pop_cum,
+                seen.cumsum(axis=0),
+                labels,
+            )
+        return self._group_sums[mapping.name][:3]
+
+    def group_codes(self, mapping: Series) -> tuple[np.ndarray, np.ndarray]:
+        """Return the group code of each city (-1 when unknown) and the labels.
+
+        :param mapping Series: group of each city, indexed by city name
+        """
+        groups = mapping[~mapping.index.duplicated()].reindex(self.cities)
+        codes, labels = factorize(groups, sort=True)
+        return codes, np.asarray(labels)
+
+    def _labels(self, mapping: Series | None) -> np.ndarray:
+        """Return the keys of the results by city, or by group of mapping."""
+        if mapping is None:
+            return np.asarray(self.cities)
+        return self._group_sums[mapping.name][3]
+
+    def yearly(
+        self,
+        mapping: Series | None = None,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return the cases and population as year x city (or group) matrices.
+
+        :param mapping Series | None: group of each city, indexed by city name
+        """
+        cases_cum, pop_cum, _ = self._prefix_sums(mapping)
+        cases = np.diff(cases_cum.sum(axis=0), axis=0)
+        return cases, np.diff(pop_cum, axis=0), self._labels(mapping)
+
+    def year_by_class(
+        self,
+        year: int,
+        mapping: Series | None = None,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return the cases of a year as a class x city (or group) matrix.
+
+        Also returns the population and the keys of the columns.
+
+        :param year int: year of the store
+        :param mapping Series | None: group of each city, indexed by city name
+        """
+        cases_cum, pop_cum, _ = self._prefix_sums(mapping)
+        row = self.years.index(year)
+        cases = cases_cum[:, row + 1] - cases_cum[:, row]
+        return cases, pop_cum[row + 1] - pop_cum[row], self._labels(mapping)
+
+    def city_positions(self, cities: Collection[str]) -> np.ndarray:
+        """Return the position of cities in the store, skipping unknown ones.
+
+        :param cities Collection[str]: city names
+        """
+        if not self._city_codes:
+            self._city_codes = {city: code for code, city in enumerate(self.cities)}
+        codes = [self._city_codes.get(city, -1) for city in cities]
+        return np.array([code for code in codes if code >= 0], dtype="int64")
+
+    def year_count(self, years: tuple[int, int]) -> int:
+        """Return the number of years of the store within a range.
+
+        :param years tuple[int, int]: first and last years, both included
+        """
+        low = int(np.searchsorted(self.years, years[0], side="left"))
+        return max(int(np.searchsorted(self.years, years[1], side="right")) - low, 0)
+
+    def aggregate(
+        self,
+        years: tuple[int, int],
+        classes: Collection[str] | None = None,
+        mapping: Series | None = None,
+        cities: Collection[str] | None = None,
+    ) -> DataFrame:
+        """Sum the cases of a range of years by city or group.
+
+        Returns Key, Cases and POP, the mean population over the years it is
+        known, for the keys with a population or cases. Cases are the total of
+        the range: divide them by year_count for annual rates.
+
+        :param years tuple[int, int]: first and last years, both included
+        :param classes Collection[str] | None: crime classes, all when empty
+        :param mapping Series | None: group of each city (e.g. its département),
+            indexed by city name; results are by city when None
+        :param cities Collection[str] | None: only read the columns of these
+            cities, results being by city
+        """
+        low = int(np.searchsorted(self.years, years[0], side="left"))
+        high = max(int(np.searchsorted(self.years, years[1], side="right")), low)
+        cases_cum, pop_cum, seen_cum = self._prefix_sums(mapping)
+        labels = self._labels(mapping)
+        columns = slice(None)
+        if cities is not None and mapping is None:
+            columns = self.city_positions(cities)
+            labels = labels[columns]
+        rows = slice(None)
+        if classes:
+            rows = [self.classes.index(c) for c in classes if c in self.classes]
+        cases = (cases_cum[:, high, columns] - cases_cum[:, low, columns])[rows]
+        cases = cases.sum(axis=0)
+        seen = seen_cum[high, columns] - seen_cum[low, columns]
+        pop = np.divide(
+            pop_cum[high, columns] - pop_cum[low, columns],
+            seen,
+            out=np.zeros(len(seen)),
+            where=seen > 0,
+        )
+        present = (cases > 0) | (pop > 0)
+        return DataFrame(
+            {"Key": labels[present], "Cases": cases[present], "POP": pop[present]},
+        )
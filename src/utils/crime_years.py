@@ -0,0 +1,164 @@
+"""Yearly partitions of the cleaned crimes, recomputed when their source changes.
+
+The raw crimes CSV is split by year (and by département when MEMORY_BUDGET_MB
+is set) and every year is fingerprinted from its source rows. Only the years
+whose fingerprint changed since the last ingestion are cleaned again; the
+cleaned tables of each year are kept in data/cleaned/crimes_years/<year>, next
+to state.json, the fingerprints they were cleaned from. The national crimes
+table and the crime store are then assembled from the yearly partitions, one
+year at a time.
+
+The fingerprints also version the cached figures of each range of years, so
+that publishing a new year only invalidates the figures showing it.
+"""
+from __future__ import annotations
+
+from hashlib import sha256
+from json import dumps, loads
+from pathlib import Path
+from shutil import rmtree
+from typing import TYPE_CHECKING
+
+from pandas import read_csv
+
+from src.utils.partitions import departement_codes, rows_per_chunk, split_csv
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+    from pandas import DataFrame
+
+YEARS_PATH = Path("./", "data", "cleaned", "crimes_years")
+YEAR_TABLES = ("crimes", "facts", "population")
+CHUNK_ROWS = 500_000  # rows read at once without a memory budget
+HASH_BLOCK = 1024 * 1024
+
+
+def year_key(chunk: DataFrame, *, by_departement: bool) -> object:
+    """Return the partition of each row: its year, and département if asked."""
+    years = (2000 + chunk["annee"]).astype(str)
+    if by_departement:
+        return years + "_" + departement_codes(chunk["CODGEO_2024"])
+    return years
+
+
+def split_years(
+    file: Path,
+    directory: Path,
+    budget: int | None,
+    row_bytes: float,
+    **read_kwargs: object,
+) -> dict[int, list[Path]]:
+    """Split the raw crimes CSV into partitions, grouped by year.
+
+    :param file Path: raw crimes CSV
+    :param directory Path: directory of the partitions
+    :param budget int | None: memory budget in bytes, None for no budget
+    :param row_bytes float: memory taken by a loaded row
+    :param read_kwargs: arguments of read_csv
+    """
+    partitions = split_csv(
+        file,
+        directory,
+        lambda chunk: year_key(chunk, by_departement=budget is not None),
+        rows_per_chunk(budget, row_bytes) if budget else CHUNK_ROWS,
+        **read_kwargs,
+    )
+    years: dict[int, list[Path]] = {}
+    for path in partitions:
+        years.setdefault(int(path.stem[:4]), []).append(path)
+    return years
+
+
+def fingerprint(paths: list[Path]) -> str:
+    """Return a digest of the content of files."""
+    digest = sha256()
+    for path in sorted(paths):
+        with path.open("rb") as f:
+            while block := f.read(HASH_BLOCK):
+                digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def year_state(directory: Path = YEARS_PATH) -> dict[str, str]:
+    """Return the fingerprint of the source of each cleaned year."""
+    path = directory / "state.json"
+    return loads(path.read_text()) if path.exists() else {}
+
+
+def write_year_state(state: dict[str, str], directory: Path = YEARS_PATH) -> None:
+    """Record the fingerprints of the cleaned years."""
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / "state.json").write_text(dumps(state, indent=2, sort_keys=True))
+
+
+def changed_years(
+    fingerprints: dict[int, str],
+    directory: Path = YEARS_PATH,
+) -> list[int]:
+    """Return the years whose source changed or which were never cleaned.
+
+    :param fingerprints dict[int, str]: fingerprint of the source of each year
+    :param directory Path: directory of the yearly partitions
+    """
+    state = year_state(directory)
+    return sorted(
+        year
+        for year, digest in fingerprints.items()
+        if state.get(str(year)) != digest or not (directory / str(year)).exists()
+    )
+
+
+def write_year(
+    year: int,
+    tables: dict[str, DataFrame],
+    directory: Path = YEARS_PATH,
+) -> None:
+    """Write the cleaned tables of a year.
+
+    :param year int: year of the partition
+    :param tables dict[str, DataFrame]: tables named as in YEAR_TABLES
+    :param directory Path: directory of the yearly partitions
+    """
+    path = directory / str(year)
+    path.mkdir(parents=True, exist_ok=True)
+    for name in YEAR_TABLES:
+        tables[name].to_csv(path / f"{name}.csv", index=False)
+
+
+def drop_years(years: list[int], directory: Path = YEARS_PATH) -> None:
+    """Remove the partitions of years no longer in the source."""
+    for year in years:
+        rmtree(directory / str(year), ignore_errors=True)
+
+
+def year_paths(name: str, directory: Path = YEARS_PATH) -> list[Path]:
+    """Return a table of every cleaned year, oldest first."""
+    years = sorted(int(year) for year in year_state(directory))
+    return [directory / str(year) / f"{name}.csv" for year in years]
+
+
+def iter_years(name: str, directory: Path = YEARS_PATH) -> Iterator[DataFrame]:
+    """Yield a table of every yearly partition, oldest first.
+
+    :param name str: table name, one of YEAR_TABLES
+    :param directory Path: directory of the yearly partitions
+    """
+    for path in year_paths(name, directory):
+        yield read_csv(path, dtype={"City": str})
+
+
+def concat_years(name: str, target: Path, directory: Path = YEARS_PATH) -> None:
+    """Write a table of every yearly partition to target, a line at a time.
+
+    :param name str: table name, one of YEAR_TABLES
+    :param target Path: CSV to write
+    :param directory Path: directory of the yearly partitions
+    """
+    with target.open("w") as out:
+        for index, path in enumerate(year_paths(name, directory)):
+            with path.open() as f:
+                header = f.readline()
+                if index == 0:
+                    out.write(header)
+                out.writelines(f)
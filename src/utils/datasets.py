@@ -0,0 +1,262 @@
+"""Loaders of the cleaned datasets used by the dashboard.
+
+Every loader returns compacted frames: low-cardinality strings become
+categories, integers are downcast to the smallest type holding their range
+and floats, coordinates included, are stored as float32. Crime counts stay
+float64: they are summed over the whole country, beyond what float32 holds
+exactly (2**24).
+"""
+from __future__ import annotations
+
+from functools import lru_cache
+from pathlib import Path
+
+import geopandas as gpd
+import pandas as pd
+from pandas.api.types import (
+    is_float_dtype,
+    is_integer_dtype,
+    is_object_dtype,
+    is_string_dtype,
+)
+
+from src.utils.analytics import ANALYTICS_PATH
+from src.utils.crime_store import STORE_PATH, CrimeStore
+from src.utils.geometry_store import (
+    GEOMETRY_PATH,
+    LEVELS,
+    GeometryStore,
+    dissolve_levels,
+    stored_levels,
+)
+from src.utils.metrics import describe, record_cache, set_gauge
+
+CLEANED_PATH = Path("./", "data", "cleaned")
+CRIMES_PATH = CLEANED_PATH / "crimes_france_2.csv"
+CAMERAS_PATH = CLEANED_PATH / "cameras_unified.csv"
+OSM_CAMERAS_PATH = CLEANED_PATH / "osm_cleaned.csv"
+SHODAN_COUNTS_PATH = CLEANED_PATH / "shodan_camera_counts.csv"
+COMMUNES_PATH = CLEANED_PATH / "french_communes.geojson"
+
+PARTITION_CACHE_SIZE = 16  # départements or regions kept by a worker
+CATEGORY_RATIO = 0.5  # strings with fewer unique values than this ratio
+MEGABYTE = 1024 * 1024
+
+describe("dataset_memory_bytes", "gauge", "Memory used by a loaded dataset column.")
+
+
+def compact_frame(
+    df: pd.DataFrame,
+    category_ratio: float = CATEGORY_RATIO,
+    exact: tuple[str, ...] = (),
+) -> pd.DataFrame:
+    """Downcast the columns of df in place and return it.
+
+    :param df DataFrame: frame to compact, geometry columns are left untouched
+    :param category_ratio float: maximum unique/rows ratio of category columns
+    :param exact tuple[str, ...]: columns left as they are
+    """
+    for col in df.columns:
+        series = df[col]
+        if isinstance(series, gpd.GeoSeries) or col in exact:
+            continue
+        if is_integer_dtype(series.dtype):
+            df[col] = pd.to_numeric(series, downcast="integer")
+        elif is_float_dtype(series.dtype):
+            df[col] = series.astype("float32")
+        elif (is_object_dtype(series.dtype) or is_string_dtype(series.dtype)) and (
+            series.nunique() <= category_ratio * len(series)
+        ):
+            df[col] = series.astype("category")
+    return df
+
+
+def report_memory(name: str, df: pd.DataFrame) -> int:
+    """Print and export the memory used by each column of df.
+
+    :param name str: name of the dataset
+    :param df DataFrame: the loaded dataset
+    """
+    usage = df.memory_usage(deep=True, index=True)
+    total = int(usage.sum())
+    print(f"[memory] {name}: {total / MEGABYTE:.1f} MB, {len(df)} rows")
+    for col, size in usage.items():
+        dtype = df[col].dtype if col in df.columns else "index"
+        print(f"[memory]   {col:<12} {size / MEGABYTE:8.2f} MB  {dtype}")
+        set_gauge("dataset_memory_bytes", int(size), dataset=name, column=str(col))
+    return total
+
+
+def load_crimes(path: Path = CRIMES_PATH) -> pd.DataFrame:
+    """Load the cleaned crimes table (City, Year, Cases, POP)."""
+    crimes = pd.read_csv(
+        path,
+        dtype={"City": "category", "Year": "int16", "Cases": "float64"},
+    )
+    return compact_frame(crimes, exact=("Cases",))
+
+
+def load_cameras(path: Path = CAMERAS_PATH) -> pd.DataFrame:
+    """Load the deduplicated cameras of every source with parsed timestamps.
+
+    Falls back to the OSM cameras alone when no unified table was built.
+    Columns are named Lat, Long- and Timestamp, as used by the figures.
+    With SHODAN_MODE=facets, the table holds no Shodan camera: their yearly
+    counts are given by load_shodan_counts.
+    """
+    if not path.exists():
+        path = OSM_CAMERAS_PATH
+    cameras = pd.read_csv(
+        path,
+        usecols=["Latitude", "Longitude", "Timestamp"],
+        dtype={"Latitude": "float32", "Longitude": "float32"},
+    ).rename(columns={"Latitude": "Lat", "Longitude": "Long-"})
+    cameras["Timestamp"] = pd.to_datetime(cameras["Timestamp"], errors="coerce")
+    return cameras
+
+
+def load_shodan_counts(path: Path = SHODAN_COUNTS_PATH) -> pd.DataFrame:
+    """Load the number of Shodan cameras seen each year (Year, Cameras).
+
+    The counts only exist when the last ingestion ran with SHODAN_MODE=facets;
+    the frame is empty otherwise.
+    """
+    if not path.exists():
+        return pd.DataFrame({"Year": [], "Cameras": []})
+    counts = pd.read_csv(path, keep_default_na=False)
+    totals = counts.loc[counts["Facet"] == "total", ["Year", "Count"]]
+    return totals.rename(columns={"Count": "Cameras"}).reset_index(drop=True)
+
+
+def load_communes(path: Path = COMMUNES_PATH) -> gpd.GeoDataFrame:
+    """Load the commune outlines with compacted attributes.
+
+    Builds shapely geometries in the calling process; figures should rather
+    use load_geometry, whose arrays are shared by the workers.
+    """
+    communes = load_geometry("communes", path)
+    return gpd.GeoDataFrame(
+        communes.attributes.copy(),
+        geometry=communes.geoseries().to_numpy(),
+        crs="EPSG:4326",
+    )
+
+
+def load_geometry(level: str, path: Path = COMMUNES_PATH) -> GeometryStore:
+    """Open the outlines of a level: communes, departements or regions.
+
+    The store is memory-mapped, and reopened only when an ingestion rewrote
+    it. Datasets cleaned before it existed get an in-memory store built from
+    the GeoJSON. Attributes are compacted.
+
+    :param level str: geographic level, a key of geometry_store.LEVELS
+    :param path Path: GeoJSON of the communes, used without a store
+    """
+    if level in stored_levels():
+        attributes = GEOMETRY_PATH / level / "attributes.csv"
+        return _open_geometry(GEOMETRY_PATH / level, attributes.stat().st_mtime_ns)
+    return _build_geometry(path, path.stat().st_mtime_ns)[level]
+
+
+@lru_cache(maxsize=len(LEVELS))
+def _open_geometry(directory: Path, _version: int) -> GeometryStore:
+    store = GeometryStore.open(directory)
+    compact_frame(store.attributes)
+    return store
+
+
+@lru_cache(maxsize=1)
+def _build_geometry(path: Path, _version: int) -> dict[str, GeometryStore]:
+    stores = {
+        level: GeometryStore.from_frame(frame)
+        for level, frame in dissolve_levels(gpd.read_file(path)).items()
+    }
+    for store in stores.values():
+        compact_frame(store.attributes)
+    return stores
+
+
+def load_geojson(level: str) -> dict:
+    """Return the GeoJSON of every outline of a level.
+
+    It is built once per store and worker, not at every render; the store is
+    reopened, and the GeoJSON built again, only when an ingestion rewrote it.
+
+    :param level str: geographic level, a key of geometry_store.LEVELS
+    """
+    return _geojson(load_geometry(level))
+
+
+@lru_cache(maxsize=len(LEVELS))
+def _geojson(geometry: GeometryStore) -> dict:
+    return geometry.geojson()
+
+
+def load_commune_partition(
+    column: str,
+    value: str,
+) -> tuple[pd.DataFrame, dict, tuple[float, ...] | None]:
+    """Load the communes of a département or region.
+
+    Returns their attributes, their GeoJSON and their bounds (None without
+    communes). Only the rows of the partition are read from the geometry
+    store; the last partitions are kept in a small cache.
+
+    :param column str: dep or reg
+    :param value str: code of the département or region
+    """
+    geometry = load_geometry("communes")
+    hits = _commune_partition.cache_info().hits
+    partition = _commune_partition(geometry, column, value)
+    record_cache("commune_partitions", hit=_commune_partition.cache_info().hits > hits)
+    return partition
+
+
+@lru_cache(maxsize=PARTITION_CACHE_SIZE)
+def _commune_partition(
+    geometry: GeometryStore,
+    column: str,
+    value: str,
+) -> tuple[pd.DataFrame, dict, tuple[float, ...] | None]:
+    rows = geometry.partition(column, value)
+    attributes = geometry.attributes.iloc[rows].reset_index(drop=True)
+    bounds = geometry.bounds(rows) if len(rows) else None
+    return attributes, geometry.geojson(rows), bounds
+
+
+def load_commune_keys(path: Path = COMMUNES_PATH) -> pd.DataFrame:
+    """Load the name, département and region of the communes, without outlines."""
+    return load_geometry("communes", path).attributes[["libgeo", "dep", "reg"]]
+
+
+def load_crime_store(directory: Path = STORE_PATH) -> CrimeStore:
+    """Open the crime store, reopened only when an ingestion rewrote it.
+
+    Datasets cleaned before the store existed get a store without classes
+    built from the crimes table.
+    """
+    dictionaries = directory / "dictionaries.json"
+    if dictionaries.exists():
+        return _open_crime_store(directory, dictionaries.stat().st_mtime_ns)
+    return _open_crime_store(CRIMES_PATH, CRIMES_PATH.stat().st_mtime_ns)
+
+
+@lru_cache(maxsize=1)
+def _open_crime_store(path: Path, _version: int) -> CrimeStore:
+    if path.is_dir():
+        return CrimeStore.open(path)
+    return CrimeStore.from_crimes(load_crimes(path))
+
+
+def load_analytics(name: str, directory: Path = ANALYTICS_PATH) -> pd.DataFrame:
+    """Load a table precomputed by the analytics stage of the ingestion.
+
+    Returns an empty frame when the datasets were cleaned before that stage
+    existed.
+
+    :param name str: table name, cross_section or areas
+    """
+    path = directory / f"{name}.csv"
+    if not path.exists():
+        return pd.DataFrame(columns=["Level", "Lag", "Year", "Key", "Correlation"])
+    return compact_frame(pd.read_csv(path, dtype={"Key": str}))
@@ -0,0 +1,279 @@
+"""Streaming export of the cleaned datasets, served on /export.
+
+Query parameters:
+
+- ``dataset``: ``crimes`` (default), cases by area, year and crime class, or
+  ``cameras``, the deduplicated cameras;
+- ``start`` and ``end``: first and last years, both included;
+- ``level``: ``communes`` (default), ``departements`` or ``regions``;
+- ``area``: keep the areas of that name or code, or within that
+  département or region, e.g. ``area=75``; cameras are kept by the commune
+  the analytics stage of the ingestion located them in;
+- ``format``: ``csv`` (default) or ``parquet``, the latter when pyarrow is
+  installed.
+
+Rows are produced in batches, one year of the memory-mapped crime store or
+one chunk of the camera table at a time, and sent as soon as they are
+encoded: an export never holds more than a batch in memory. An export
+without rows still has its CSV header or Parquet schema.
+"""
+from __future__ import annotations
+
+from importlib import import_module
+from importlib.util import find_spec
+from itertools import repeat
+from typing import TYPE_CHECKING
+
+import numpy as np
+import pandas as pd
+from flask import Response, request, stream_with_context
+
+from src.utils.analytics import ANALYTICS_PATH, CAMERA_COMMUNES
+from src.utils.datasets import (
+    CAMERAS_PATH,
+    OSM_CAMERAS_PATH,
+    load_commune_keys,
+    load_crime_store,
+)
+from src.utils.metrics import describe, inc_counter
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+    from flask import Flask
+
+LEVEL_COLUMNS = {"communes": "libgeo", "departements": "dep", "regions": "reg"}
+BATCH_ROWS = 50_000
+CAMERA_COLUMNS = ["Latitude", "Longitude", "Timestamp", "Source", "Source_ID"]
+# Typed so that every batch, empty ones included, has the same schema
+CRIME_DTYPES = {
+    "Key": "str",
+    "Year": "int64",
+    "Class": "str",
+    "Cases": "float64",
+    "POP": "float64",
+}
+CAMERA_DTYPES = {
+    "Latitude": "float64",
+    "Longitude": "float64",
+    "Timestamp": "str",
+    "Source": "str",
+    "Source_ID": "str",
+}
+MIMETYPES = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+describe("export_rows_total", "counter", "Rows streamed by /export.")
+
+
+class ExportError(ValueError):
+    """Invalid export query."""
+
+
+def area_keys(level: str, area: str | None) -> pd.DataFrame:
+    """Return the keys of a level with their département and region.
+
+    :param level str: communes, departements or regions
+    :param area str | None: keep the keys equal to area, or within it
+    """
+    column = LEVEL_COLUMNS[level]
+    keys = load_commune_keys()
+    keys = keys[list(dict.fromkeys([column, "dep", "reg"]))]
+    keys = keys.drop_duplicates(subset=column).rename(columns={column: "Key"})
+    if area:
+        keys = keys[(keys == area).any(axis=1)]
+    return keys.set_index("Key")
+
+
+def crime_batches(
+    years: range,
+    level: str,
+    area: str | None,
+) -> Iterator[pd.DataFrame]:
+    """Yield the cases of each area by year and crime class, a year at a time.
+
+    :param years range: years to export
+    :param level str: communes, departements or regions
+    :param area str | None: area filter, see area_keys
+    """
+    store = load_crime_store()
+    keys = area_keys(level, area)
+    mapping = None
+    if level != "communes":
+        mapping = load_commune_keys().set_index("libgeo")[LEVEL_COLUMNS[level]]
+    classes = np.asarray(store.classes)
+    empty = True
+    for year in years:
+        if year not in store.years:
+            continue
+        cases, pop, labels = store.year_by_class(year, mapping)
+        kept = np.flatnonzero(np.isin(labels, keys.index))
+        class_rows, key_rows = np.nonzero(cases[:, kept] > 0)
+        columns = kept[key_rows]
+        for start in range(0, len(columns), BATCH_ROWS):
+            batch = slice(start, start + BATCH_ROWS)
+            empty = False
+            yield pd.DataFrame({
+                "Key": labels[columns[batch]],
+                "Year": year,
+                "Class": classes[class_rows[batch]],
+                "Cases": cases[class_rows[batch], columns[batch]],
+                "POP": pop[columns[batch]],
+            }).astype(CRIME_DTYPES)
+    if empty:
+        yield pd.DataFrame(columns=list(CRIME_DTYPES)).astype(CRIME_DTYPES)
+
+
+def camera_batches(years: range, area: str | None) -> Iterator[pd.DataFrame]:
+    """Yield the cameras installed during years, undated ones included.
+
+    Every chunk is yielded, even when none of its cameras is kept.
+
+    :param years range: installation years to export
+    :param area str | None: keep the cameras of that commune, or within that
+        département or region
+    """
+    path = CAMERAS_PATH if CAMERAS_PATH.exists() else OSM_CAMERAS_PATH
+    header = pd.read_csv(path, nrows=0).columns
+    columns = [column for column in CAMERA_COLUMNS if column in header]
+    chunks = pd.read_csv(
+        path,
+        usecols=columns,
+        dtype={column: CAMERA_DTYPES[column] for column in columns},
+        chunksize=BATCH_ROWS,
+    )
+    cities = repeat(None)
+    if area:
+        keys = load_commune_keys()
+        inside = keys.loc[(keys == area).any(axis=1), "libgeo"]
+        # Row-aligned with the cameras table, read in the same chunks
+        cities = pd.read_csv(
+            ANALYTICS_PATH / CAMERA_COMMUNES,
+            dtype={"City": "str"},
+            chunksize=BATCH_ROWS,
+        )
+    empty = True
+    for chunk, city in zip(chunks, cities, strict=False):
+        year = pd.to_datetime(chunk["Timestamp"], errors="coerce").dt.year
+        kept = year.isna() | year.between(years.start, years.stop - 1)
+        if city is not None:
+            kept &= city["City"].isin(inside).to_numpy()
+        empty = False
+        yield chunk[kept]
+    if empty:
+        yield pd.DataFrame(columns=columns).astype(
+            {column: CAMERA_DTYPES[column] for column in columns},
+        )
+
+
+def encode_csv(batches: Iterator[pd.DataFrame]) -> Iterator[bytes]:
+    """Encode batches as one CSV, the header coming with the first batch.
+
+    The batches start with an empty one when no row matched.
+    """
+    header = True
+    for batch in batches:
+        inc_counter("export_rows_total", len(batch), format="csv")
+        yield batch.to_csv(index=False, header=header).encode()
+        header = False
+
+
+class _Pipe:
+    """Write-only file whose content is drained by the exporter."""
+
+    closed = False
+
+    def __init__(self) -> None:
+        self.parts: list[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts.clear()
+        return data
+
+
+def encode_parquet(batches: Iterator[pd.DataFrame]) -> Iterator[bytes]:
+    """Encode batches as one Parquet file, a row group per batch."""
+    pa = import_module("pyarrow")
+    pq = import_module("pyarrow.parquet")
+    pipe = _Pipe()
+    writer = None
+    for batch in batches:
+        table = pa.Table.from_pandas(batch, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(pipe, table.schema)
+        writer.write_table(table)
+        inc_counter("export_rows_total", len(batch), format="parquet")
+        yield pipe.drain()
+    if writer is not None:
+        writer.close()
+        yield pipe.drain()
+
+
+def parse_query(args: dict) -> tuple[str, range, str, str | None, str]:
+    """Validate the query parameters of /export.
+
+    :param args dict: query parameters
+    """
+    dataset = args.get("dataset", "crimes")
+    level = args.get("level", "communes")
+    export_format = args.get("format", "csv")
+    area = args.get("area") or None
+    if dataset not in {"crimes", "cameras"}:
+        error_msg = f"Unknown dataset {dataset!r}, expected crimes or cameras."
+        raise ExportError(error_msg)
+    if level not in LEVEL_COLUMNS:
+        error_msg = f"Unknown level {level!r}, expected one of {list(LEVEL_COLUMNS)}."
+        raise ExportError(error_msg)
+    if export_format not in MIMETYPES:
+        error_msg = f"Unknown format {export_format!r}, expected csv or parquet."
+        raise ExportError(error_msg)
+    if export_format == "parquet" and not find_spec("pyarrow"):
+        error_msg = "Parquet exports need pyarrow, use format=csv."
+        raise ExportError(error_msg)
+    located = ANALYTICS_PATH / CAMERA_COMMUNES
+    if dataset == "cameras" and area and not located.exists():
+        error_msg = "Cameras are located by the analytics stage, run the ingestion."
+        raise ExportError(error_msg)
+    try:
+        start = int(args.get("start", 0))
+        end = int(args.get("end", 9999))
+    except ValueError as e:
+        error_msg = f"Invalid year: {e}"
+        raise ExportError(error_msg) from e
+    return dataset, range(start, end + 1), level, area, export_format
+
+
+def export() -> Response:
+    """Stream the rows selected by the query parameters."""
+    try:
+        dataset, years, level, area, export_format = parse_query(request.args)
+    except ExportError as e:
+        return Response(f"{e}\n", status=400, mimetype="text/plain")
+    batches = (
+        crime_batches(years, level, area)
+        if dataset == "crimes"
+        else camera_batches(years, area)
+    )
+    encode = encode_csv if export_format == "csv" else encode_parquet
+    filename = f"crimes_{level}" if dataset == "crimes" else "cameras"
+    filename = f"{filename}.{export_format}"
+    return Response(
+        stream_with_context(encode(batches)),
+        mimetype=MIMETYPES[export_format],
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
+
+
+def register_export(server: Flask) -> None:
+    """Expose /export on the Flask server behind Dash.
+
+    :param server Flask: the Dash server (app.server)
+    """
+    server.add_url_rule("/export", "export", export)
@@ -0,0 +1,143 @@
+"""On-disk cache of the dashboard figures.
+
+A figure only depends on the callback inputs and on the cleaned datasets, so
+it is stored as JSON in data/cache/figures/<fingerprint>/<years>, the
+fingerprint being derived from the size and modification time of the cleaned
+files and <years> from the source fingerprints of the years of crimes the
+figure shows (see crime_years). A new ingestion therefore never serves stale
+figures, and publishing a new year of crimes keeps the figures of the
+previous years. ``python main.py warm-cache`` fills the cache before the
+dashboard is served.
+"""
+from __future__ import annotations
+
+from functools import wraps
+from hashlib import sha256
+from json import dumps, loads
+from pathlib import Path
+from shutil import rmtree
+from tempfile import NamedTemporaryFile
+from typing import TYPE_CHECKING, Any
+
+import plotly.io as pio
+
+from src.utils.crime_years import YEARS_PATH, year_state
+from src.utils.figure_encoding import encode_figure
+from src.utils.metrics import record_cache
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Collection
+
+CLEANED_PATH = Path("./", "data", "cleaned")
+FIGURE_CACHE_PATH = Path("./", "data", "cache", "figures")
+# Rewritten at every ingestion, versioned by year instead (years_fingerprint)
+CRIME_FILES = ("crimes_france_2.csv",)
+
+
+def dataset_fingerprint(
+    directory: Path = CLEANED_PATH,
+    exclude: Collection[str] = (),
+) -> str:
+    """Return a digest of the name, size and modification time of the datasets.
+
+    :param directory Path: directory holding the cleaned datasets
+    :param exclude Collection[str]: names of the datasets left out
+    """
+    stats = sorted(
+        (path.name, stat.st_size, stat.st_mtime_ns)
+        for path in directory.glob("*")
+        if path.is_file() and path.name not in exclude and (stat := path.stat())
+    )
+    return sha256(dumps(stats).encode()).hexdigest()[:16]
+
+
+def years_fingerprint(state: dict[str, str], years: range | None = None) -> str:
+    """Return a digest of the source fingerprints of years, all when None.
+
+    :param state dict[str, str]: source fingerprint of each year, see year_state
+    :param years range | None: years shown by a figure
+    """
+    digests = (
+        sorted(state.items())
+        if years is None
+        else [state.get(str(year)) for year in years]
+    )
+    return sha256(dumps(digests).encode()).hexdigest()[:16]
+
+
+def figure_directory(years: range | None = None) -> Path:
+    """Return the directory of the figures showing years, all when None.
+
+    Without yearly partitions (crimes cleaned by an older version), the crimes
+    file is part of the dataset fingerprint instead.
+
+    :param years range | None: years shown by a figure
+    """
+    state = year_state(YEARS_PATH)
+    base = dataset_fingerprint(exclude=CRIME_FILES if state else ())
+    return FIGURE_CACHE_PATH / base / years_fingerprint(state, years)
+
+
+def prune_figures(directory: Path = FIGURE_CACHE_PATH) -> int:
+    """Remove the figures built from previous datasets, return how many sets.
+
+    The sets of the current datasets whose years changed are removed as well.
+
+    :param directory Path: root of the figure cache
+    """
+    state = year_state(YEARS_PATH)
+    current = figure_directory().parent
+    known = sorted(int(year) for year in state)
+    valid = {years_fingerprint(state)} | {
+        years_fingerprint(state, range(first, last + 1))
+        for first in known
+        for last in known
+        if first <= last
+    }
+    stale = [p for p in directory.glob("*") if p.is_dir() and p != current]
+    stale += [p for p in current.glob("*") if p.name not in valid]
+    for path in stale:
+        if path.is_dir():
+            rmtree(path, ignore_errors=True)
+        else:
+            path.unlink(missing_ok=True)
+    return len(stale)
+
+
+def cached_figure(func: Callable, *, year_arg: int | None = None) -> Callable:
+    """Serve the figures of func from the disk cache, building them on a miss.
+
+    Figures are stored and returned as dicts encoded by encode_figure, which
+    Dash accepts as figures.
+
+    :param func Callable: callback returning a plotly figure
+    :param year_arg int | None: position of the [first, last] years argument
+        of func, whose figures then survive changes to the other years
+    """
+
+    @wraps(func)
+    def wrapper(*args: Any) -> Any:  # noqa: ANN401
+        key = sha256(dumps([func.__name__, args]).encode()).hexdigest()
+        years = None
+        if year_arg is not None:
+            first, last = args[year_arg]
+            years = range(first, last + 1)
+        path = figure_directory(years) / f"{key}.json"
+        if path.exists():
+            record_cache("figures", hit=True)
+            return loads(path.read_text())
+        record_cache("figures", hit=False)
+        figure = encode_figure(func(*args))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Workers, and the threads of a worker, may build the same figure
+        with NamedTemporaryFile(
+            "w",
+            dir=path.parent,
+            suffix=".part",
+            delete=False,
+        ) as tmp:
+            tmp.write(pio.to_json(figure, validate=False))
+        Path(tmp.name).replace(path)
+        return figure
+
+    return wrapper
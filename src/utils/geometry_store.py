@@ -0,0 +1,353 @@
+"""Commune outlines stored as flat arrays shared by every server worker.
+
+clean_data writes the outlines of the communes, and of the départements and
+regions they form, in data/cleaned/geometry/<level>: the coordinates and the
+ring, polygon and geometry offsets of shapely.to_ragged_array as .npy files,
+the other columns in attributes.csv. Communes are sorted by region and
+département, so that each one is a contiguous slice of the arrays.
+
+The arrays are memory-mapped read-only: the pages are loaded once by the
+operating system and shared by the workers, whatever their number. Figures
+get GeoJSON serialized straight from the arrays, which each worker builds
+once per level or drilled-down partition (see datasets.load_geojson);
+shapely geometries are only built on demand, for the rows asked for.
+
+geopandas, pyogrio and shapely are imported by the functions using them, so
+that importing the ingestion does not load them.
+"""
+from __future__ import annotations
+
+from itertools import pairwise
+from json import dumps, loads
+from pathlib import Path
+from shutil import rmtree
+from typing import TYPE_CHECKING
+
+import numpy as np
+from pandas import DataFrame, concat, read_csv
+
+from src.utils.partitions import memory_budget, rows_per_chunk
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+
+    import geopandas as gpd
+
+GEOMETRY_PATH = Path("./", "data", "cleaned", "geometry")
+OFFSET_NAMES = ("ring_offsets", "polygon_offsets", "geometry_offsets")
+LEVELS = {"communes": None, "departements": "dep", "regions": "reg"}
+SORT_COLUMNS = ["reg", "dep", "libgeo"]
+GEOJSON_DECIMALS = 5  # about one metre, shorter JSON numbers
+
+
+def _gather(offsets: np.ndarray, rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Return the positions of the parts of rows, and their new offsets."""
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    new_offsets = np.zeros(len(rows) + 1, dtype=offsets.dtype)
+    np.cumsum(lengths, out=new_offsets[1:])
+    positions = np.repeat(starts - new_offsets[:-1], lengths)
+    return positions + np.arange(new_offsets[-1]), new_offsets
+
+
+class GeometryStore:
+    """Outlines of one level, as ragged MultiPolygon arrays."""
+
+    def __init__(
+        self,
+        coords: np.ndarray,
+        offsets: Sequence[np.ndarray],
+        attributes: DataFrame,
+    ) -> None:
+        """Wrap the arrays of a store.
+
+        :param coords ndarray: x, y coordinates of every ring, one row per point
+        :param offsets Sequence[ndarray]: ring, polygon and geometry offsets
+        :param attributes DataFrame: other columns, one row per geometry
+        """
+        self.coords = coords
+        self.ring_offsets, self.polygon_offsets, self.geometry_offsets = offsets
+        self.attributes = attributes
+
+    @classmethod
+    def from_frame(cls, frame: gpd.GeoDataFrame) -> GeometryStore:
+        """Build an in-memory store from a GeoDataFrame.
+
+        :param frame GeoDataFrame: outlines of the polygons and multipolygons
+        """
+        import shapely  # noqa: PLC0415
+
+        geometry_type, coords, offsets = shapely.to_ragged_array(
+            frame.geometry.to_numpy(),
+        )
+        if geometry_type == shapely.GeometryType.POLYGON:
+            # Every polygon is a multipolygon of one part
+            offsets = (*offsets, np.arange(len(frame) + 1, dtype=offsets[-1].dtype))
+        attributes = DataFrame(frame.drop(columns=frame.geometry.name))
+        return cls(coords, offsets, attributes.reset_index(drop=True))
+
+    @classmethod
+    def open(cls, directory: Path) -> GeometryStore:
+        """Memory-map the store of directory.
+
+        :param directory Path: directory of the store
+        """
+        coords = np.load(directory / "coords.npy", mmap_mode="r")
+        offsets = [
+            np.load(directory / f"{name}.npy", mmap_mode="r") for name in OFFSET_NAMES
+        ]
+        attributes = read_csv(directory / "attributes.csv", dtype=str)
+        return cls(coords, offsets, attributes)
+
+    def save(self, directory: Path) -> None:
+        """Write the store to directory.
+
+        :param directory Path: directory of the store
+        """
+        directory.mkdir(parents=True, exist_ok=True)
+        np.save(directory / "coords.npy", self.coords)
+        for name in OFFSET_NAMES:
+            np.save(directory / f"{name}.npy", getattr(self, name))
+        # Written last, its modification time versions the store
+        self.attributes.to_csv(directory / "attributes.csv", index=False)
+
+    def __len__(self) -> int:
+        """Return the number of geometries."""
+        return len(self.geometry_offsets) - 1
+
+    @classmethod
+    def concat(cls, stores: Sequence[GeometryStore]) -> GeometryStore:
+        """Stack stores, in order, into one.
+
+        :param stores Sequence[GeometryStore]: stores to stack
+        """
+        parts: tuple[list, list, list] = ([], [], [])
+        bases = [0, 0, 0]  # points, rings and polygons of the stores before
+        for store in stores:
+            offsets = [getattr(store, name) for name in OFFSET_NAMES]
+            for part, offset, base in zip(parts, offsets, bases, strict=True):
+                part.append(np.asarray(offset[:-1]) + base)
+            bases = [
+                bases[0] + len(store.coords),
+                bases[1] + len(store.ring_offsets) - 1,
+                bases[2] + len(store.polygon_offsets) - 1,
+            ]
+        offsets = [
+            np.append(np.concatenate(part), base)
+            for part, base in zip(parts, bases, strict=True)
+        ]
+        return cls(
+            np.concatenate([store.coords for store in stores]),
+            offsets,
+            concat([store.attributes for store in stores], ignore_index=True),
+        )
+
+    def take(self, rows: np.ndarray) -> GeometryStore:
+        """Return a store of rows, in that order.
+
+        :param rows ndarray: positions of the geometries
+        """
+        coords, offsets = self._slice(rows)
+        return GeometryStore(
+            coords,
+            offsets,
+            self.attributes.iloc[rows].reset_index(drop=True),
+        )
+
+    def partition(self, column: str, value: str) -> np.ndarray:
+        """Return the rows whose column equals value, e.g. a département.
+
+        Communes being sorted by region and département, the rows of one
+        are contiguous and only their pages of the arrays are read.
+
+        :param column str: dep or reg
+        :param value str: code of the département or region
+        """
+        return np.flatnonzero((self.attributes[column] == value).to_numpy())
+
+    def bounds(self, rows: np.ndarray) -> tuple[float, float, float, float]:
+        """Return the min x, min y, max x and max y of rows.
+
+        :param rows ndarray: positions of the geometries
+        """
+        coords, _ = self._slice(rows)
+        (min_x, min_y), (max_x, max_y) = coords.min(axis=0), coords.max(axis=0)
+        return float(min_x), float(min_y), float(max_x), float(max_y)
+
+    def _slice(
+        self,
+        rows: np.ndarray | None,
+    ) -> tuple[np.ndarray, tuple[np.ndarray, ...]]:
+        """Return the coordinates and offsets of rows, all rows when None."""
+        if rows is None:
+            offsets = (self.ring_offsets, self.polygon_offsets, self.geometry_offsets)
+            return self.coords, offsets
+        polygons, geometry_offsets = _gather(self.geometry_offsets, np.asarray(rows))
+        rings, polygon_offsets = _gather(self.polygon_offsets, polygons)
+        points, ring_offsets = _gather(self.ring_offsets, rings)
+        return self.coords[points], (ring_offsets, polygon_offsets, geometry_offsets)
+
+    def geoseries(self, rows: np.ndarray | None = None) -> gpd.GeoSeries:
+        """Build the shapely geometries of rows, all rows when None.
+
+        :param rows ndarray | None: positions of the geometries
+        """
+        import geopandas as gpd  # noqa: PLC0415
+        import shapely  # noqa: PLC0415
+
+        coords, offsets = self._slice(rows)
+        geometries = shapely.from_ragged_array(
+            shapely.GeometryType.MULTIPOLYGON,
+            np.asarray(coords),
+            tuple(np.asarray(o) for o in offsets),
+        )
+        return gpd.GeoSeries(geometries, crs="EPSG:4326")
+
+    def geojson(self, rows: np.ndarray | None = None) -> dict:
+        """Serialize rows as a GeoJSON FeatureCollection, without shapely.
+
+        Features are identified by their position in rows, as the locations of
+        a choropleth built from the matching attributes. Coordinates are
+        rounded to GEOJSON_DECIMALS.
+
+        :param rows ndarray | None: positions of the geometries, all when None
+        """
+        coords, (ring_offsets, polygon_offsets, geometry_offsets) = self._slice(rows)
+        coords = np.round(coords, GEOJSON_DECIMALS)
+        rings = [
+            coords[start:end].tolist()
+            for start, end in pairwise(ring_offsets)
+        ]
+        polygons = [
+            rings[start:end]
+            for start, end in pairwise(polygon_offsets)
+        ]
+        features = [
+            {
+                "type": "Feature",
+                "id": str(i),
+                "properties": {},
+                "geometry": {
+                    "type": "MultiPolygon",
+                    "coordinates": polygons[start:end],
+                },
+            }
+            for i, (start, end) in enumerate(
+                pairwise(geometry_offsets),
+            )
+        ]
+        return {"type": "FeatureCollection", "features": features}
+
+
+def dissolve_levels(communes: gpd.GeoDataFrame) -> dict[str, gpd.GeoDataFrame]:
+    """Return the outlines of every level, communes sorted by region.
+
+    :param communes GeoDataFrame: outlines of the communes, with dep and reg
+    """
+    communes = communes.astype({"dep": str, "reg": str}).sort_values(
+        SORT_COLUMNS,
+        kind="stable",
+    )
+    frames = {}
+    for level, column in LEVELS.items():
+        frame = communes
+        if column:
+            frame = communes.dissolve(by=column, aggfunc="first").reset_index()
+        frames[level] = frame.reset_index(drop=True)
+    return frames
+
+
+def split_geometry(source: Path, directory: Path, budget: int) -> list[Path]:
+    """Split the communes GeoJSON into one store per département.
+
+    The GeoJSON is read a slice of features at a time, sized to the budget.
+    Returns the partitions, sorted by region then département.
+
+    :param source Path: cleaned GeoJSON of the communes
+    :param directory Path: directory of the partitions
+    :param budget int: memory budget in bytes
+    """
+    import geopandas as gpd  # noqa: PLC0415
+    import pyogrio  # noqa: PLC0415
+
+    features = pyogrio.read_info(source)["features"]
+    chunk = rows_per_chunk(budget, source.stat().st_size / max(features, 1) * 4)
+    if directory.exists():
+        rmtree(directory)
+    for start in range(0, features, chunk):
+        communes = gpd.read_file(source, rows=slice(start, start + chunk))
+        communes = communes.astype({"dep": str, "reg": str})
+        for dep, frame in communes.groupby("dep"):
+            path = directory / dep
+            part = GeometryStore.from_frame(frame)
+            if path.exists():
+                part = GeometryStore.concat([GeometryStore.open(path), part])
+            part.save(path)
+    keys = [
+        read_csv(path / "attributes.csv", dtype=str, nrows=1).loc[0, ["reg", "dep"]]
+        for path in directory.iterdir()
+    ]
+    return [directory / dep for _, dep in sorted(tuple(key) for key in keys)]
+
+
+def write_partitioned_geometry(
+    source: Path,
+    directory: Path,
+    budget: int,
+) -> None:
+    """Write the geometry store a département at a time.
+
+    Only one partition is loaded as shapely geometries at once, and the
+    département outlines are dissolved into regions.
+
+    :param source Path: cleaned GeoJSON of the communes
+    :param directory Path: root directory of the stores
+    :param budget int: memory budget in bytes
+    """
+    import geopandas as gpd  # noqa: PLC0415
+
+    communes, departements = [], []
+    for path in split_geometry(source, directory / "partitions", budget):
+        part = GeometryStore.open(path)
+        order = part.attributes.sort_values("libgeo", kind="stable").index
+        part = part.take(order.to_numpy())
+        communes.append(part)
+        departements.append(
+            gpd.GeoDataFrame(
+                part.attributes.iloc[[0]],
+                geometry=[part.geoseries().union_all()],
+                crs="EPSG:4326",
+            ),
+        )
+    GeometryStore.concat(communes).save(directory / "communes")
+    del communes
+    departements = concat(departements).sort_values("dep").reset_index(drop=True)
+    GeometryStore.from_frame(departements).save(directory / "departements")
+    regions = departements.dissolve(by="reg", aggfunc="first").reset_index()
+    GeometryStore.from_frame(regions).save(directory / "regions")
+
+
+def write_geometry_store(source: Path, directory: Path = GEOMETRY_PATH) -> None:
+    """Write the geometry store of every level from the communes GeoJSON.
+
+    With MEMORY_BUDGET_MB set, the GeoJSON is processed a département at a
+    time and its partitions are kept in <directory>/partitions.
+
+    :param source Path: cleaned GeoJSON of the communes
+    :param directory Path: root directory of the stores
+    """
+    import geopandas as gpd  # noqa: PLC0415
+
+    budget = memory_budget()
+    if budget is None:
+        for level, frame in dissolve_levels(gpd.read_file(source)).items():
+            GeometryStore.from_frame(frame).save(directory / level)
+    else:
+        write_partitioned_geometry(source, directory, budget)
+    (directory / "levels.json").write_text(dumps(list(LEVELS)))
+
+
+def stored_levels(directory: Path = GEOMETRY_PATH) -> list[str]:
+    """Return the levels of the store, none when it was not written."""
+    path = directory / "levels.json"
+    return loads(path.read_text()) if path.exists() else []
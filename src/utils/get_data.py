@@ -2,16 +2,24 @@
 
 from __future__ import annotations
 
-from json import JSONDecodeError
-from math import ceil
+from os import environ
 from pathlib import Path
 from typing import Callable
 
-from pandas import DataFrame
-from requests import RequestException, get, head
+from requests import RequestException
 from shodan import APIError, Shodan
 
+from src.utils.analytics import ANALYTICS_PATH, precompute_analytics
+from src.utils.cameras import DEDUP_DISTANCE, SOURCE_PRIORITY, unify_camera_files
 from src.utils.clean_data import clean_data, clean_osm_data, clean_shodan_result
+from src.utils.crime_store import STORE_PATH
+from src.utils.crime_years import YEARS_PATH
+from src.utils.geometry_store import GEOMETRY_PATH
+from src.utils.http_cache import http_session
+from src.utils.overpass import harvest_osm, iter_tile_elements
+from src.utils.pipeline import Stage, run_pipeline
+from src.utils.run_report import RunReport, report_io
+from src.utils.shodan_harvest import aggregate_shodan, harvest_shodan
 from src.utils.utils import (
     cleanup_data,
     decompress_gz,
@@ -19,6 +27,110 @@ from src.utils.utils import (
     setup_directories,
 )
 
+OVERPASS_URL = "http://overpass-api.de/api/interpreter"
+
+
+def ingestion_stages(
+    shodan_clients: list[Shodan],
+    raw_path: Path = Path("./", "data", "raw"),
+) -> list[Stage]:
+    """Return the stages of the ingestion.
+
+    :param shodan_clients list[Shodan]: List of shodan clients (one api key per client)
+    :param raw_path Path: path to save the dirty files to
+    """
+    cleaned_path = Path("./", "data", "cleaned")
+    priority = environ.get("CAMERA_PRIORITY", ",".join(SOURCE_PRIORITY))
+    osm_path = cleaned_path / "osm_cleaned.csv"
+    shodan_paths = (
+        cleaned_path / "shodan_camera_fr.csv",
+        cleaned_path / "shodan_camera_counts.csv",
+    )
+    unified_path = cleaned_path / "cameras_unified.csv"
+    return [
+        Stage(
+            "osm",
+            get_osm_data,
+            args=(environ.get("OVERPASS_URL", OVERPASS_URL),),
+            outputs=(osm_path,),
+        ),
+        Stage(
+            "shodan",
+            get_shodan_data,
+            args=(shodan_clients,),
+            outputs=shodan_paths,
+        ),
+        Stage(
+            "unify_cameras",
+            unify_camera_files,
+            args=(
+                float(environ.get("CAMERA_DEDUP_DISTANCE", DEDUP_DISTANCE)),
+                tuple(priority.split(",")),
+            ),
+            inputs=(osm_path, *shodan_paths),
+            outputs=(unified_path,),
+            pool="process",
+            cached=True,
+        ),
+        Stage(
+            "download_v_commune",
+            download_data,
+            args=(
+                "https://www.insee.fr/fr/statistiques/fichier/7766585/v_commune_2024.csv",
+                raw_path / "v_commune_2024.csv",
+            ),
+        ),
+        Stage(
+            "download_crimes",
+            download_data,
+            args=(
+                "https://static.data.gouv.fr/resources/bases-statistiques-communale-departementale-et-regionale-de-la-delinquance-enregistree-par-la-police-et-la-gendarmerie-nationales/20240718-150309/donnee-data.gouv-2023-geographie2024-produit-le2024-07-05.csv.gz",
+                raw_path / "crimes_france_2.csv.gz",
+            ),
+            kwargs={
+                "alternate_url": "https://www.data.gouv.fr/fr/datasets/r/3f51212c-f7d2-4aec-b899-06be6cdd1030",
+                "callback": decompress_gz,
+            },
+        ),
+        Stage(
+            "download_communes",
+            download_data,
+            args=(
+                "https://static.data.gouv.fr/resources/contours-des-communes-de-france-simplifie-avec-regions-et-departement-doutre-mer-rapproches/20220219-095144/a-com2022.json",
+                raw_path / "french_communes.geojson",
+            ),
+            kwargs={
+                "alternate_url": "https://www.data.gouv.fr/fr/datasets/r/fb3580f6-e875-408d-809a-ad22fc418581",
+            },
+        ),
+        Stage(
+            "clean_crimes_france_2",
+            clean_data,
+            needs=("download_crimes", "download_v_commune"),
+            outputs=(cleaned_path / "crimes_france_2.csv", STORE_PATH, YEARS_PATH),
+            pool="process",
+            cached=True,
+            env=("MEMORY_BUDGET_MB",),
+        ),
+        Stage(
+            "clean_french_communes",
+            clean_data,
+            needs=("download_communes",),
+            outputs=(cleaned_path / "french_communes.geojson", GEOMETRY_PATH),
+            pool="process",
+            cached=True,
+            env=("MEMORY_BUDGET_MB",),
+        ),
+        Stage(
+            "analytics",
+            precompute_analytics,
+            inputs=(unified_path, GEOMETRY_PATH, STORE_PATH, YEARS_PATH),
+            outputs=(ANALYTICS_PATH,),
+            pool="process",
+            cached=True,
+        ),
+    ]
+
 
 def get_data(
     shodan_clients: list[Shodan],
@@ -26,33 +138,20 @@ def get_data(
 ) -> None:
     """Set the working space, get data and clean them.
 
+    Stages run in parallel as soon as the stages they depend on are done,
+    see src/utils/pipeline.py.
+
     :param shodan_clients list[Shodan]: List of shodan clients (one api key per client)
     :param raw_path Path: path to save the dirty files to
     """
     setup_directories()
+    report = RunReport()
 
-    get_osm_data("http://overpass-api.de/api/interpreter")
-
-    get_shodan_data(shodan_clients)
-    v_commune_path: Path = download_data(
-        "https://www.insee.fr/fr/statistiques/fichier/7766585/v_commune_2024.csv",
-        raw_path / "v_commune_2024.csv",
-    )
-    crimes_france_path: Path = download_data(
-        "https://static.data.gouv.fr/resources/bases-statistiques-communale-departementale-et-regionale-de-la-delinquance-enregistree-par-la-police-et-la-gendarmerie-nationales/20240718-150309/donnee-data.gouv-2023-geographie2024-produit-le2024-07-05.csv.gz",
-        raw_path / "crimes_france_2.csv.gz",
-        alternate_url="https://www.data.gouv.fr/fr/datasets/r/3f51212c-f7d2-4aec-b899-06be6cdd1030",
-        callback=decompress_gz,
-    )
-    french_deps_path: Path = download_data(
-        "https://static.data.gouv.fr/resources/contours-des-communes-de-france-simplifie-avec-regions-et-departement-doutre-mer-rapproches/20220219-095144/a-com2022.json",
-        raw_path / "french_communes.geojson",
-        alternate_url="https://www.data.gouv.fr/fr/datasets/r/fb3580f6-e875-408d-809a-ad22fc418581",
-    )
-    files_raw = [crimes_france_path, french_deps_path]
-    for file in files_raw:
-        clean_data(file, v_commune_path)
-    cleanup_data(Path("./", "data", "raw"))
+    try:
+        run_pipeline(ingestion_stages(shodan_clients, raw_path), report)
+        cleanup_data(Path("./", "data", "raw"))
+    finally:
+        print(f"Run report written to {report.write()}")
 
 
 def download_data(
@@ -69,12 +168,14 @@ def download_data(
     :param callback Callable | None: gets called after downloading
     """
     try:
-        check = head(url)
-        with get(url if check.ok else alternate_url or "", stream=True) as r:
+        session = http_session()
+        check = session.head(url)
+        with session.get(url if check.ok else alternate_url or "", stream=True) as r:
             r.raise_for_status()
             with save_path.open(mode="wb") as f:
                 for chunk in r.iter_content(chunk_size=8192):
                     f.write(chunk)
+            report_io(bytes_in=save_path.stat().st_size)
             if callback:
                 return callback(save_path)
     except (RequestException, APIError) as e:
@@ -82,101 +183,43 @@ def download_data(
         # fallback to /data/backup/
         backup_path = Path("./", "data", "backup", save_path.name)
         if backup_path.exists():
+            report_io(bytes_in=backup_path.stat().st_size, fallback=True, error=str(e))
             return backup_path
         print(f"Backup file {backup_path} not found.")
 
     return save_path
 
 
-MAX_TRIES = 0
-RESULTS_LIMIT = 100  # Adjust this value to limit the number of results per page
+def get_shodan_data(shodan_clients: list[Shodan]) -> None:
+    """Refresh the Shodan store and export it. If empty, fallbacks to the JSON.
 
-
-def get_shodan_data(
-    shodan_clients: list[Shodan],
-    tries: int = 1,
-    start_page: int = 1,
-) -> None:
-    """Try to get data from shodan API. If failing, fallbacks to the JSON.
+    Only the days since the previous harvest are queried, unless
+    SHODAN_HARVEST is set to full. With SHODAN_MODE set to facets, only the
+    yearly counts by city, region and organization are fetched.
 
     :param shodan_clients list[Shodan]: clients to be used to get data
-    :param tries int: number of current try
-    :param start_page int: will try to get data from this page on
     """
-    if tries > MAX_TRIES:
+    cleaned_path = Path("./", "data", "cleaned")
+    if environ.get("SHODAN_MODE", "banners") == "facets":
+        counts = aggregate_shodan(shodan_clients)
+        counts.to_csv(cleaned_path / "shodan_camera_counts.csv", index=False)
+        return
+    full = environ.get("SHODAN_HARVEST", "delta") == "full"
+    store = harvest_shodan(shodan_clients, full=full)
+    if not len(store.banners):
         fallback_to_json(clean_shodan_result)
         return
-    shodan = shodan_clients[0]
-    # 10 results per page, 1 query credit per 100 results, 10 pages per api full api key
-    try:
-        shodan = shodan_clients[0]
-        count = shodan.count("camera country:fr before:2024-01-01")
-
-        # 100 results per page
-        total_pages = ceil(count["total"] / RESULTS_LIMIT)
-        cleaned_data = []
-
-        for i in range(start_page, total_pages + 1):
-            try:
-                result = shodan.search("camera country:fr before:2024-01-01", page=i)
-
-                if "matches" not in result:
-                    fallback_to_json(clean_shodan_result)
-                    break
-
-                cleaned_data.extend(clean_shodan_result(result))
-            except APIError as e:
-                if "query credits" in str(e).lower():
-                    if len(shodan_clients) > 1:
-                        shodan_clients.pop(0)
-                        get_shodan_data(shodan_clients, tries, start_page=i)
-                        return
-                    fallback_to_json(clean_shodan_result)
-                    return
-
-        # Convert cleaned data to DataFrame
-        shodan_df = DataFrame(cleaned_data)
-        shodan_df.to_csv(
-            Path("./", "data", "cleaned", "shodan_camera_fr.csv"),
-            mode="a",
-            header=False,
-        )
-    except APIError:
-        get_shodan_data(shodan_clients, tries + 1, start_page)
+    store.banners.to_csv(cleaned_path / "shodan_camera_fr.csv", index=False)
 
 
 def get_osm_data(endpoint_url: str) -> None:
-    """Get data from OpenStreetMap.
+    """Get data from OpenStreetMap, one bounding-box tile at a time.
 
     :param endpoint_url str: API url to get data from
     """
-    query = """
-    [out:json];
-    area[name="France"]->.searchArea;
-
-    // Search for nodes, ways, or relations with camera-related tags
-    (
-      node["man_made"="surveillance"](area.searchArea);
-      node["surveillance"](area.searchArea);
-      way["man_made"="surveillance"](area.searchArea);
-      way["surveillance"](area.searchArea);
-    );
-
-    // Output the results
-    out body;
-    >;
-    out skel qt;
-    """
-
-    try:
-        response = get(endpoint_url, params={"data": query})
-        response.raise_for_status()  # Raise an error for bad responses
-        data = response.json()
-
-        els = data.get("elements", [])
-
-        clean_osm_data(els)
-    except RequestException:
-        pass
-    except JSONDecodeError:
-        pass
+    tiles, complete = harvest_osm(endpoint_url)
+    if tiles:
+        clean_osm_data(iter_tile_elements(tiles))
+    if complete:
+        for tile in tiles:
+            tile.unlink()
@@ -0,0 +1,452 @@
+r"""Record/replay cache for every upstream HTTP source.
+
+The cache is enabled through the ``HTTP_CACHE`` environment variable:
+
+- ``off`` (default): requests go to the network.
+- ``record``: requests go to the network and responses are stored.
+- ``replay``: responses are served from the cache, a miss raises ConnectionError.
+- ``auto``: responses are served from the cache, misses are recorded.
+
+Only successful (2xx) responses are stored: rate limits and server errors are
+returned as they are and requested again next time. Callers drop recordings
+whose 200 body holds an error themselves, with forget_response.
+
+Bodies are stored once under their SHA-256 in ``data/http_cache/blobs``; each
+request (method, path, query without the API key, body) has an entry holding
+the status, headers and body digest. Shodan pages are distinct requests, so
+pagination is recorded as well.
+
+A stand-in server answers the Shodan search/count and Overpass endpoints from
+the cache, or with synthetic data when nothing was recorded::
+
+    python -m src.utils.http_cache serve --port 8765
+    OVERPASS_URL=http://127.0.0.1:8765/api/interpreter \
+    SHODAN_API_URL=http://127.0.0.1:8765 python main.py
+"""
+from __future__ import annotations
+
+from argparse import ArgumentParser
+from functools import lru_cache
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps, loads
+from os import environ
+from pathlib import Path
+from random import Random
+from re import search
+from shutil import copyfileobj
+from typing import TYPE_CHECKING, Any
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from requests import ConnectionError as RequestsConnectionError
+from requests import PreparedRequest, Response, Session
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+CACHE_PATH = Path("./", "data", "http_cache")
+SECRET_PARAMS = {"key"}
+# Headers describing the encoded transfer, the stored body is decoded
+DROPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+CHUNK_SIZE = 1024 * 1024
+
+
+def cache_mode() -> str:
+    """Return the cache mode set by HTTP_CACHE."""
+    mode = environ.get("HTTP_CACHE", "off").lower()
+    return mode if mode in {"record", "replay", "auto"} else "off"
+
+
+def request_key(method: str, url: str, body: bytes | str | None = None) -> str:
+    """Return the cache key of a request.
+
+    The host is left out so that the stand-in server can replay recordings
+    made against the real services, and so is the API key.
+
+    :param method str: HTTP method
+    :param url str: full URL, query string included
+    :param body bytes | str | None: request body
+    """
+    parts = urlsplit(url)
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k not in SECRET_PARAMS
+    )
+    digest = sha256(f"{method.upper()} {parts.path}?{urlencode(query)}\n".encode())
+    if body:
+        digest.update(body.encode() if isinstance(body, str) else body)
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """Content-addressed store of recorded responses."""
+
+    def __init__(self, root: Path = CACHE_PATH) -> None:
+        """Open (and create) the cache rooted at root."""
+        self.root = root
+        (root / "blobs").mkdir(parents=True, exist_ok=True)
+        (root / "entries").mkdir(parents=True, exist_ok=True)
+
+    def blob_path(self, digest: str) -> Path:
+        """Return the path of the body whose SHA-256 is digest."""
+        return self.root / "blobs" / digest[:2] / digest
+
+    def lookup(self, key: str) -> dict | None:
+        """Return the entry recorded for key, if any."""
+        path = self.root / "entries" / f"{key}.json"
+        return loads(path.read_text()) if path.exists() else None
+
+    def store(
+        self,
+        key: str,
+        meta: dict[str, Any],
+        chunks: Iterable[bytes],
+    ) -> dict:
+        """Store a response body and its metadata under key.
+
+        :param key str: request key
+        :param meta dict: method, url, status, reason and headers
+        :param chunks Iterable[bytes]: the decoded body
+        """
+        tmp = self.root / "blobs" / f".{key}.part"
+        digest = sha256()
+        size = 0
+        with tmp.open("wb") as f:
+            for chunk in chunks:
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        blob = self.blob_path(digest.hexdigest())
+        blob.parent.mkdir(exist_ok=True)
+        tmp.replace(blob)
+        entry = {**meta, "body": digest.hexdigest(), "size": size}
+        entry_tmp = self.root / "entries" / f".{key}.part"
+        entry_tmp.write_text(dumps(entry, indent=1))
+        entry_tmp.replace(self.root / "entries" / f"{key}.json")
+        return entry
+
+    def forget(self, key: str) -> None:
+        """Remove the entry of key; its body stays, as others may share it."""
+        (self.root / "entries" / f"{key}.json").unlink(missing_ok=True)
+
+
+def _strip_secrets(url: str) -> str:
+    parts = urlsplit(url)
+    query = [
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k not in SECRET_PARAMS
+    ]
+    return parts._replace(query=urlencode(query)).geturl()
+
+
+class CachingAdapter(HTTPAdapter):
+    """Transport adapter recording and replaying responses."""
+
+    def __init__(self, cache: ResponseCache, mode: str) -> None:
+        """Create the adapter.
+
+        :param cache ResponseCache: where responses are stored
+        :param mode str: "record", "replay" or "auto"
+        """
+        super().__init__()
+        self.cache = cache
+        self.mode = mode
+
+    def send(self, request: PreparedRequest, **kwargs: Any) -> Response:  # noqa: ANN401
+        """Serve request from the cache, or from the network and record it."""
+        key = request_key(request.method or "GET", request.url or "", request.body)
+        entry = self.cache.lookup(key) if self.mode != "record" else None
+        if entry is None:
+            if self.mode == "replay":
+                error_msg = f"No recording for {_strip_secrets(request.url or '')}"
+                raise RequestsConnectionError(error_msg, request=request)
+            kwargs["stream"] = True
+            response = super().send(request, **kwargs)
+            if not 200 <= response.status_code < 300:  # noqa: PLR2004
+                # Transient failures are not pinned into the cache
+                return response
+            with response:
+                headers = {
+                    k: v for k, v in response.headers.items()
+                    if k.lower() not in DROPPED_HEADERS
+                }
+                entry = self.cache.store(
+                    key,
+                    {
+                        "method": request.method,
+                        "url": _strip_secrets(request.url or ""),
+                        "status": response.status_code,
+                        "reason": response.reason,
+                        "headers": headers,
+                    },
+                    response.iter_content(CHUNK_SIZE),
+                )
+        return self._replay(request, entry)
+
+    def _replay(self, request: PreparedRequest, entry: dict) -> Response:
+        response = Response()
+        response.status_code = entry["status"]
+        response.reason = entry["reason"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = request.url or ""
+        response.request = request
+        response.connection = self
+        with self.cache.blob_path(entry["body"]).open("rb") as f:
+            # As if read from the network, iter_content then slices the body
+            response._content = f.read()  # noqa: SLF001
+        response._content_consumed = True  # noqa: SLF001
+        return response
+
+
+def install_cache(session: Session) -> Session:
+    """Mount the record/replay adapter on session if HTTP_CACHE is set.
+
+    :param session Session: session to instrument, e.g. a Shodan client's
+    """
+    mode = cache_mode()
+    if mode != "off":
+        adapter = CachingAdapter(ResponseCache(), mode)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+    return session
+
+
+def forget_response(request: PreparedRequest) -> None:
+    """Remove the recording of request, if the cache is enabled.
+
+    For answers that are successful for HTTP but hold an error, such as the
+    runtime remarks of Overpass, so that they are not replayed.
+
+    :param request PreparedRequest: the request of the response, response.request
+    """
+    if cache_mode() != "off":
+        key = request_key(request.method or "GET", request.url or "", request.body)
+        ResponseCache().forget(key)
+
+
+@lru_cache(maxsize=1)
+def http_session() -> Session:
+    """Return the shared session used to reach the upstream sources."""
+    return install_cache(Session())
+
+
+# Stand-in server
+
+FRANCE_BBOX = (41.3, -5.2, 51.1, 9.6)  # south, west, north, east
+SYNTHETIC_CITIES = [
+    ("Paris", "IDF", 48.8566, 2.3522),
+    ("Marseille", "PAC", 43.2965, 5.3698),
+    ("Lyon", "ARA", 45.7640, 4.8357),
+    ("Toulouse", "OCC", 43.6047, 1.4442),
+    ("Nantes", "PDL", 47.2184, -1.5536),
+    ("Lille", "HDF", 50.6292, 3.0573),
+    ("Rennes", "BRE", 48.1173, -1.6778),
+    ("Bordeaux", "NAQ", 44.8378, -0.5792),
+]
+SYNTHETIC_ORGS = ["Orange", "SFR", "Bouygues Telecom", "Free SAS", "OVH SAS"]
+PAGE_SIZE = 100
+
+
+def synthetic_banner(index: int) -> dict:
+    """Return a deterministic fake Shodan banner."""
+    # Seeded for reproducible fake data, not for security
+    rng = Random(index)  # noqa: S311
+    city, region, lat, lon = rng.choice(SYNTHETIC_CITIES)
+    return {
+        "ip_str": f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}",
+        "port": rng.choice([80, 554, 8080, 8000]),
+        "location": {
+            "city": city,
+            "region_code": region,
+            "latitude": lat + rng.uniform(-0.05, 0.05),
+            "longitude": lon + rng.uniform(-0.05, 0.05),
+        },
+        "timestamp": f"20{rng.randint(16, 23)}-{rng.randint(1, 12):02d}-"
+        f"{rng.randint(1, 28):02d}T12:00:00.000000",
+        "org": rng.choice(SYNTHETIC_ORGS),
+        "domains": [],
+    }
+
+
+@lru_cache(maxsize=64)
+def synthetic_matches(query: str, total: int) -> list[int]:
+    """Return the synthetic banners matching the after: and before: of query."""
+    after = search(r"after:(\S+)", query)
+    before = search(r"before:(\S+)", query)
+    low = after.group(1) if after else ""
+    high = before.group(1) if before else "9999"
+    return [
+        index
+        for index in range(total)
+        if low < synthetic_banner(index)["timestamp"][:10] < high
+    ]
+
+
+def synthetic_facets(facets: str, total: int) -> dict:
+    """Return fake facets (e.g. "city:10,org:5") spread over total banners."""
+    values = {
+        "city": [c[0] for c in SYNTHETIC_CITIES],
+        "region": [c[1] for c in SYNTHETIC_CITIES],
+        "org": SYNTHETIC_ORGS,
+    }
+    result = {}
+    for facet in filter(None, facets.split(",")):
+        name, _, size = facet.partition(":")
+        names = values.get(name, [])[: int(size or 10)]
+        result[name] = [
+            {"value": value, "count": total // (rank + 2)}
+            for rank, value in enumerate(names)
+        ]
+    return result
+
+
+def synthetic_overpass(query: str, density: float) -> dict:
+    """Return fake surveillance nodes and ways inside the bbox of query."""
+    match = search(r"\((-?[\d.]+),(-?[\d.]+),(-?[\d.]+),(-?[\d.]+)\)", query)
+    south, west, north, east = (
+        tuple(float(x) for x in match.groups()) if match else FRANCE_BBOX
+    )
+    # Seeded for reproducible fake data, not for security
+    rng = Random(f"{south},{west},{north},{east}")  # noqa: S311
+    count = int((north - south) * (east - west) * density)
+    elements = []
+    for i in range(count):
+        lat, lon = rng.uniform(south, north), rng.uniform(west, east)
+        node_id = int(abs(lat * 1e5)) * 10_000_000 + int(abs(lon * 1e5))
+        tags = {"man_made": "surveillance"}
+        if rng.random() < 0.5:  # noqa: PLR2004
+            tags["start_date"] = f"20{rng.randint(10, 23)}-{rng.randint(1, 12):02d}"
+        if i % 10:
+            elements.append(
+                {"type": "node", "id": node_id, "lat": lat, "lon": lon, "tags": tags},
+            )
+            continue
+        ring = [node_id + k for k in range(4)]
+        elements.append(
+            {"type": "way", "id": node_id, "nodes": [*ring, ring[0]], "tags": tags},
+        )
+        elements.extend(
+            {
+                "type": "node",
+                "id": ref,
+                "lat": lat + 1e-4 * (k // 2),
+                "lon": lon + 1e-4 * (k % 2),
+            }
+            for k, ref in enumerate(ring)
+        )
+    return {"version": 0.6, "generator": "stand-in", "elements": elements}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serve recordings, or synthetic Shodan and Overpass responses."""
+
+    cache: ResponseCache
+    total: int
+    density: float
+
+    def _handle(self, method: str) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else None
+        entry = self.cache.lookup(request_key(method, self.path, body))
+        if entry is not None:
+            self.send_response(entry["status"], entry["reason"])
+            for name, value in entry["headers"].items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(entry["size"]))
+            self.end_headers()
+            if method != "HEAD":
+                with self.cache.blob_path(entry["body"]).open("rb") as f:
+                    copyfileobj(f, self.wfile, CHUNK_SIZE)
+            return
+        payload = self._synthetic(body)
+        if payload is None:
+            self.send_error(404, "Not recorded")
+            return
+        data = dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if method != "HEAD":
+            self.wfile.write(data)
+
+    def _synthetic(self, body: bytes | None) -> dict | None:
+        parts = urlsplit(self.path)
+        params = dict(parse_qsl(parts.query))
+        if body:
+            params.update(parse_qsl(body.decode()))
+        matches = synthetic_matches(params.get("query", ""), self.total)
+        if parts.path == "/shodan/host/count":
+            return {
+                "total": len(matches),
+                "matches": [],
+                "facets": synthetic_facets(params.get("facets", ""), len(matches)),
+            }
+        if parts.path == "/shodan/host/search":
+            start = (int(params.get("page", 1)) - 1) * PAGE_SIZE
+            return {
+                "total": len(matches),
+                "matches": [
+                    synthetic_banner(i) for i in matches[start : start + PAGE_SIZE]
+                ],
+            }
+        if parts.path == "/api/interpreter":
+            return synthetic_overpass(params.get("data", ""), self.density)
+        return None
+
+    def do_GET(self) -> None:
+        """Answer a GET request."""
+        self._handle("GET")
+
+    def do_HEAD(self) -> None:
+        """Answer a HEAD request."""
+        self._handle("HEAD")
+
+    def do_POST(self) -> None:
+        """Answer a POST request."""
+        self._handle("POST")
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002, ANN401
+        """Silence the per-request logging."""
+
+
+def serve(host: str, port: int, total: int, density: float) -> None:
+    """Run the stand-in server until interrupted.
+
+    :param host str: interface to listen on
+    :param port int: port to listen on
+    :param total int: number of synthetic Shodan banners
+    :param density float: synthetic OSM cameras per square degree
+    """
+    handler = type(
+        "Handler",
+        (StandInHandler,),
+        {"cache": ResponseCache(), "total": total, "density": density},
+    )
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"Stand-in server listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+def main(argv: list[str] | None = None) -> None:
+    """Command line entry point."""
+    parser = ArgumentParser(description="Record/replay HTTP cache tools.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    stand_in = commands.add_parser("serve", help="run the stand-in server")
+    stand_in.add_argument("--host", default="127.0.0.1")
+    stand_in.add_argument("--port", type=int, default=8765)
+    stand_in.add_argument("--total", type=int, default=10_000)
+    stand_in.add_argument("--density", type=float, default=50.0)
+    args = parser.parse_args(argv)
+    serve(args.host, args.port, args.total, args.density)
+
+
+if __name__ == "__main__":
+    main()
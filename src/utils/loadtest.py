@@ -0,0 +1,619 @@
+"""Load test of the dashboard callbacks, on real or synthetic data.
+
+Simulated users drive the ``_dash-update-component`` endpoint of a running
+dashboard as the browser would: each user loads the page, fires the initial
+callbacks, then clicks through years, ranges, views, crime classes and
+départements, waiting a random think time between clicks. Callbacks are
+chained as in dash-renderer: the outputs of a response fire the callbacks
+they are inputs of, clientside callbacks being emulated (CLIENTSIDE).
+
+The report gives the throughput, the p50/p95/p99 latency of each callback and
+of whole clicks, and the resident memory of the server over time, scraped
+from /metrics::
+
+    python -m src.utils.loadtest generate --root /tmp/synthetic --communes 5000
+    (cd /tmp/synthetic && python /path/to/main.py serve --no-debug)
+    python -m src.utils.loadtest run --users 20 --duration 60 --max-p95 500
+
+``generate`` writes raw files shaped as the upstream ones (crimes CSV,
+French cities, commune outlines, OSM cameras) and runs the usual cleaning
+on them. ``run`` exits with status 1 when a request failed or when the p95
+latency of the callbacks exceeds --max-p95, to be used as a regression gate.
+"""
+from __future__ import annotations
+
+import os
+from argparse import ArgumentParser
+from collections import defaultdict
+from json import dumps
+from math import ceil, sqrt
+from pathlib import Path
+from random import Random
+from statistics import mean, quantiles
+from sys import exit as sys_exit
+from threading import Event, Lock, Thread
+from time import perf_counter, sleep
+
+import numpy as np
+from pandas import DataFrame
+from requests import RequestException, Session
+
+from src.utils.http_cache import FRANCE_BBOX
+
+# Synthetic data
+SYNTHETIC_YEARS = range(16, 24)
+SYNTHETIC_CLASSES = [
+    "Cambriolages de logement",
+    "Coups et blessures volontaires",
+    "Destructions et dégradations volontaires",
+    "Trafic de stupéfiants",
+    "Vols de véhicules",
+]
+SYNTHETIC_DEPARTEMENTS = 100  # a 10 x 10 grid
+DEPARTEMENTS_PER_REGION = 8
+NDIFF_SHARE = 0.05  # rows whose published value is withheld
+
+# Simulated users
+CLIENTSIDE = {  # emulated clientside callbacks: changed prop -> derived props
+    ("year-radio", "value"): lambda year: {("year-range", "value"): [year, year]},
+}
+ACTIONS = {"year": 4, "range": 1, "view": 2, "classes": 1, "drill": 1, "reset": 1}
+MAP_OUTPUT = "france-map-crime.figure"
+TIMEOUT = 120
+
+
+def synthetic_communes(communes: int, seed: int) -> DataFrame:
+    """Return a grid of square communes over France, with their areas.
+
+    :param communes int: number of communes
+    :param seed int: seed of the populations
+    """
+    south, west, north, east = FRANCE_BBOX
+    columns = ceil(sqrt(communes * (east - west) / (north - south)))
+    rows = ceil(communes / columns)
+    index = np.arange(communes)
+    row, column = index // columns, index % columns
+    # Départements are blocks of the grid, regions runs of départements
+    side = ceil(sqrt(SYNTHETIC_DEPARTEMENTS))
+    block = (row * side // rows) * side + column * side // columns
+    _, dep = np.unique(block, return_inverse=True)
+    rank = np.zeros(communes, dtype=int)
+    for code in np.unique(dep):
+        members = dep == code
+        rank[members] = np.arange(members.sum())
+    deps = np.char.zfill((dep + 1).astype(str), 2)
+    codes = np.char.add(deps, np.char.zfill(rank.astype(str), 3))
+    height, width = (north - south) / rows, (east - west) / columns
+    rng = np.random.default_rng(seed)
+    return DataFrame({
+        "codgeo": codes,
+        "libgeo": np.char.add("Commune ", codes),
+        "dep": deps,
+        "reg": (dep // DEPARTEMENTS_PER_REGION + 11).astype(str),
+        "south": south + row * height,
+        "west": west + column * width,
+        "height": height,
+        "width": width,
+        "pop": rng.lognormal(7, 1.3, communes).astype(int) + 50,
+    })
+
+
+def write_outlines(communes: DataFrame, path: Path) -> None:
+    """Write the communes as a GeoJSON of squares."""
+    features = [
+        {
+            "type": "Feature",
+            "properties": {
+                "libgeo": c.libgeo,
+                "dep": c.dep,
+                "reg": c.reg,
+                "codgeo": c.codgeo,
+            },
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [[
+                    [c.west, c.south],
+                    [c.west + c.width, c.south],
+                    [c.west + c.width, c.south + c.height],
+                    [c.west, c.south + c.height],
+                    [c.west, c.south],
+                ]],
+            },
+        }
+        for c in communes.itertuples()
+    ]
+    path.write_text(dumps({"type": "FeatureCollection", "features": features}))
+
+
+def synthetic_crimes(communes: DataFrame, seed: int) -> DataFrame:
+    """Return crime rows shaped as the data.gouv.fr CSV.
+
+    :param communes DataFrame: communes, see synthetic_communes
+    :param seed int: seed of the cases
+    """
+    rng = np.random.default_rng(seed)
+    years, classes = len(SYNTHETIC_YEARS), len(SYNTHETIC_CLASSES)
+    size = len(communes) * years * classes
+    commune = np.repeat(np.arange(len(communes)), years * classes)
+    year = np.tile(np.repeat(np.array(SYNTHETIC_YEARS), classes), len(communes))
+    pop = communes["pop"].to_numpy()[commune]
+    rate = rng.gamma(2, 2, size) / 1000
+    cases = rng.poisson(pop * rate)
+    withheld = rng.random(size) < NDIFF_SHARE
+    rate_text = np.char.replace(np.round(cases / pop * 1000, 2).astype(str), ".", ",")
+    return DataFrame({
+        "CODGEO_2024": communes["codgeo"].to_numpy()[commune],
+        "annee": year,
+        "classe": np.tile(SYNTHETIC_CLASSES, len(communes) * years),
+        "unité.de.compte": "infraction",
+        "valeur.publiée": np.where(withheld, "ndiff", "diff"),
+        "faits": np.where(withheld, "", cases.astype(str)),
+        "tauxpourmille": np.where(withheld, "", rate_text),
+        "complementinfoval": np.where(withheld, cases.astype(str), ""),
+        "complementinfotaux": np.where(withheld, rate_text, ""),
+        "POP": pop,
+        "millPOP": 2000 + year,
+        "LOG": pop // 2,
+        "millLOG": 2000 + year,
+    })
+
+
+def synthetic_cameras(communes: DataFrame, cameras: int, seed: int) -> DataFrame:
+    """Return OSM-like cameras, more numerous in populated communes.
+
+    :param communes DataFrame: communes, see synthetic_communes
+    :param cameras int: number of cameras
+    :param seed int: seed of the positions and dates
+    """
+    rng = np.random.default_rng(seed)
+    pop = communes["pop"].to_numpy()
+    commune = communes.iloc[rng.choice(len(communes), cameras, p=pop / pop.sum())]
+    dated = rng.random(cameras) < 0.5  # noqa: PLR2004
+    years = rng.integers(2010, 2024, cameras).astype(str)
+    months = np.char.zfill(rng.integers(1, 13, cameras).astype(str), 2)
+    stamps = np.char.add(np.char.add(years, "-"), months)
+    return DataFrame({
+        "Latitude": commune["south"].to_numpy()
+        + rng.random(cameras) * commune["height"].to_numpy(),
+        "Longitude": commune["west"].to_numpy()
+        + rng.random(cameras) * commune["width"].to_numpy(),
+        "Timestamp": np.where(dated, stamps, None),
+        "OSM_ID": [f"node/{i}" for i in range(cameras)],
+    })
+
+
+def generate(root: Path, communes: int, cameras: int, seed: int) -> None:
+    """Write a synthetic dataset under root/data and clean it.
+
+    :param root Path: directory to serve the dashboard from
+    :param communes int: number of communes
+    :param cameras int: number of cameras
+    :param seed int: seed of the random data
+    """
+    # Imported here only, as the cleaning needs geopandas
+    from src.utils.analytics import precompute_analytics  # noqa: PLC0415
+    from src.utils.clean_data import clean_data  # noqa: PLC0415
+    from src.utils.utils import setup_directories  # noqa: PLC0415
+
+    # The cleaning works in ./data
+    root.mkdir(parents=True, exist_ok=True)
+    os.chdir(root)
+    setup_directories()
+    raw, cleaned = Path("./", "data", "raw"), Path("./", "data", "cleaned")
+    frame = synthetic_communes(communes, seed)
+    write_outlines(frame, raw / "french_communes.geojson")
+    DataFrame({
+        "TYPECOM": "COM",
+        "COM": frame["codgeo"],
+        "REG": frame["reg"],
+        "DEP": frame["dep"],
+        "NCCENR": frame["libgeo"],
+    }).to_csv(raw / "v_commune_2024.csv", index=False)
+    synthetic_crimes(frame, seed).to_csv(
+        raw / "crimes_france_2.csv",
+        sep=";",
+        index=False,
+    )
+    synthetic_cameras(frame, cameras, seed).to_csv(
+        cleaned / "osm_cleaned.csv",
+        index=False,
+    )
+    clean_data(raw / "french_communes.geojson", raw / "v_commune_2024.csv")
+    clean_data(raw / "crimes_france_2.csv", raw / "v_commune_2024.csv")
+    precompute_analytics()
+    print(f"Synthetic dataset of {communes} communes written to {root / 'data'}")
+
+
+def layout_values(node: object, values: dict) -> dict:
+    """Collect the properties of the components of a layout, by (id, prop).
+
+    :param node object: layout, as returned by /_dash-layout
+    :param values dict: filled with the properties
+    """
+    if isinstance(node, list):
+        for child in node:
+            layout_values(child, values)
+    elif isinstance(node, dict) and "props" in node:
+        props = node["props"]
+        if isinstance(props.get("id"), str):
+            for prop, value in props.items():
+                values[(props["id"], prop)] = value
+        layout_values(props.get("children"), values)
+    return values
+
+
+class Recorder:
+    """Latencies, sizes and errors of the requests, shared by the users."""
+
+    def __init__(self) -> None:
+        """Start recording."""
+        self.start = perf_counter()
+        self.lock = Lock()
+        self.requests: list[tuple[float, str, float, int]] = []
+        self.clicks: dict[str, list[float]] = defaultdict(list)
+        self.errors: list[str] = []
+        self.memory: list[tuple[float, float]] = []
+
+    def request(self, name: str, latency: float, size: int) -> None:
+        """Record a request to a callback."""
+        with self.lock:
+            self.requests.append((perf_counter() - self.start, name, latency, size))
+
+    def click(self, action: str, latency: float) -> None:
+        """Record the requests fired by a click, as a whole."""
+        with self.lock:
+            self.clicks[action].append(latency)
+
+    def error(self, message: str) -> None:
+        """Record a failed request."""
+        with self.lock:
+            self.errors.append(message)
+
+
+class SimulatedUser:
+    """A browser session: its component values and the requests they fire."""
+
+    def __init__(
+        self,
+        url: str,
+        dependencies: list[dict],
+        values: dict,
+        recorder: Recorder,
+        seed: int,
+    ) -> None:
+        """Open a session on the dashboard.
+
+        :param url str: root URL of the dashboard
+        :param dependencies list[dict]: callbacks, from /_dash-dependencies
+        :param values dict: initial properties, see layout_values
+        :param recorder Recorder: where requests are recorded
+        :param seed int: seed of the clicks
+        """
+        self.url = url.rstrip("/")
+        self.session = Session()
+        self.recorder = recorder
+        self.rng = Random(seed)  # noqa: S311
+        self.callbacks = [d for d in dependencies if not d.get("clientside_function")]
+        watched = {
+            (item["id"], item["property"])
+            for d in self.callbacks
+            for item in d["inputs"] + d["state"]
+        }
+        self.values = {key: values.get(key) for key in watched}
+        self.options = {
+            key[0]: [option["value"] for option in value]
+            for key, value in values.items()
+            if key[1] == "options"
+        }
+        self.areas = 0
+
+    def get(self, path: str) -> None:
+        """Load a page resource, as the browser does on arrival."""
+        start = perf_counter()
+        response = self.session.get(f"{self.url}{path}", timeout=TIMEOUT)
+        self.recorder.request(path, perf_counter() - start, len(response.content))
+
+    def fire(self, changed: set) -> None:
+        """Fire the callbacks of changed properties, then those they update.
+
+        :param changed set: (id, property) pairs, None for the initial call
+        """
+        for key in list(changed or ()):
+            if key in CLIENTSIDE:
+                for derived, value in CLIENTSIDE[key](self.values[key]).items():
+                    self.values[derived] = value
+                    changed.add(derived)
+        updated = set()
+        for callback in self.callbacks:
+            inputs = {(item["id"], item["property"]) for item in callback["inputs"]}
+            if changed is None or inputs & changed:
+                updated |= self.post(callback, inputs if changed is None else changed)
+        if updated:
+            self.fire(updated)
+
+    def post(self, callback: dict, changed: set) -> set:
+        """Send a callback request, return the properties it updated."""
+        output = callback["output"]
+        if output.startswith(".."):
+            outputs = [
+                dict(zip(("id", "property"), part.split("."), strict=True))
+                for part in output.strip(".").split("...")
+            ]
+        else:
+            outputs = dict(zip(("id", "property"), output.split("."), strict=True))
+        body = {
+            "output": output,
+            "outputs": outputs,
+            "inputs": [self.item(i) for i in callback["inputs"]],
+            "state": [self.item(i) for i in callback["state"]],
+            "changedPropIds": [
+                f"{i['id']}.{i['property']}"
+                for i in callback["inputs"]
+                if (i["id"], i["property"]) in changed
+            ],
+        }
+        start = perf_counter()
+        try:
+            response = self.session.post(
+                f"{self.url}/_dash-update-component",
+                json=body,
+                timeout=TIMEOUT,
+            )
+        except RequestException as e:
+            self.recorder.error(f"{output}: {e}")
+            return set()
+        self.recorder.request(output, perf_counter() - start, len(response.content))
+        if response.status_code == 204:  # noqa: PLR2004
+            return set()
+        if not response.ok:
+            self.recorder.error(f"{output}: HTTP {response.status_code}")
+            return set()
+        updated = set()
+        for component, props in response.json().get("response", {}).items():
+            for prop, value in props.items():
+                if f"{component}.{prop}" == MAP_OUTPUT:
+                    self.areas = len(value.get("data", [{}])[0].get("locations", []))
+                if (component, prop) in self.values:
+                    self.values[(component, prop)] = value
+                    updated.add((component, prop))
+        return updated
+
+    def item(self, item: dict) -> dict:
+        """Return an input or state of a request, with its current value."""
+        key = (item["id"], item["property"])
+        return {**item, "value": self.values.get(key)}
+
+    def click(self) -> str:
+        """Change a control as a user would, return the action."""
+        action = self.rng.choices(list(ACTIONS), weights=list(ACTIONS.values()))[0]
+        view = self.values.get(("view-type-radio", "value"))
+        if action == "drill" and (view == "communes" or not self.areas):
+            action = "year"
+        match action:
+            case "year":
+                key = ("year-radio", "value")
+                value = self.rng.choice(self.options["year-radio"])
+            case "range":
+                key = ("year-range", "value")
+                value = sorted(self.rng.sample(self.options["year-radio"], 2))
+            case "view":
+                key = ("view-type-radio", "value")
+                value = self.rng.choice(self.options["view-type-radio"])
+            case "classes":
+                key = ("class-filter", "value")
+                classes = self.options["class-filter"]
+                count = self.rng.randint(0, min(2, len(classes)))
+                value = self.rng.sample(classes, count)
+            case "drill":
+                key = ("france-map-crime", "clickData")
+                value = {"points": [{"location": str(self.rng.randrange(self.areas))}]}
+            case _:
+                key = ("drill-reset", "n_clicks")
+                value = (self.values.get(key) or 0) + 1
+        self.values[key] = value
+        start = perf_counter()
+        self.fire({key})
+        self.recorder.click(action, perf_counter() - start)
+        return action
+
+    def run(self, stop: Event, think: float) -> None:
+        """Load the page, then click until stop is set.
+
+        :param stop Event: set at the end of the test
+        :param think float: mean seconds between two clicks
+        """
+        try:
+            for path in ("/", "/_dash-layout", "/_dash-dependencies"):
+                self.get(path)
+            self.fire(None)
+            while not stop.wait(self.rng.expovariate(1 / think) if think else 0):
+                self.click()
+        except RequestException as e:
+            self.recorder.error(str(e))
+
+
+def sample_memory(url: str, recorder: Recorder, stop: Event, interval: float) -> None:
+    """Scrape the resident memory of the server until stop is set."""
+    session = Session()
+    while True:
+        try:
+            text = session.get(f"{url.rstrip('/')}/metrics", timeout=TIMEOUT).text
+        except RequestException:
+            text = ""
+        for line in text.splitlines():
+            if line.startswith("process_resident_memory_bytes"):
+                elapsed = perf_counter() - recorder.start
+                recorder.memory.append((elapsed, float(line.split()[-1]) / 2**20))
+        if stop.wait(interval):
+            return
+
+
+def percentiles(latencies: list[float]) -> tuple[float, float, float]:
+    """Return the p50, p95 and p99 of latencies, in milliseconds."""
+    if len(latencies) < 2:  # noqa: PLR2004
+        return (latencies[0] * 1000,) * 3 if latencies else (0.0, 0.0, 0.0)
+    cuts = quantiles(latencies, n=100, method="inclusive")
+    return cuts[49] * 1000, cuts[94] * 1000, cuts[98] * 1000
+
+
+def summarize(recorder: Recorder, duration: float, interval: float) -> dict:
+    """Return the report of a load test.
+
+    :param recorder Recorder: measurements
+    :param duration float: seconds the users ran
+    :param interval float: seconds per row of the timeline
+    """
+    callbacks = defaultdict(list)
+    for _, name, latency, size in recorder.requests:
+        callbacks[name].append((latency, size))
+    requests = [r for r in recorder.requests if not r[1].startswith("/")]
+    timeline = []
+    for start in np.arange(0, duration, interval):
+        window = [r[2] for r in requests if start <= r[0] < start + interval]
+        memory = [m for t, m in recorder.memory if start <= t < start + interval]
+        timeline.append({
+            "t": round(float(start), 1),
+            "rps": round(len(window) / interval, 1),
+            "p95_ms": round(percentiles(window)[1], 1),
+            "rss_mb": round(max(memory), 1) if memory else None,
+        })
+    return {
+        "duration_s": round(duration, 1),
+        "requests": len(requests),
+        "throughput_rps": round(len(requests) / duration, 1),
+        "errors": len(recorder.errors),
+        "latency_ms": dict(
+            zip(
+                ("p50", "p95", "p99"),
+                percentiles([r[2] for r in requests]),
+                strict=True,
+            ),
+        ),
+        "callbacks": {
+            name: {
+                "calls": len(rows),
+                **dict(zip(("p50_ms", "p95_ms", "p99_ms"), percentiles([r[0] for r in rows]), strict=True)),  # noqa: E501
+                "mean_kb": mean(r[1] for r in rows) / 1024,
+            }
+            for name, rows in sorted(callbacks.items())
+        },
+        "clicks": {
+            action: dict(zip(("calls", "p50_ms", "p95_ms", "p99_ms"), (len(latencies), *percentiles(latencies)), strict=True))  # noqa: E501
+            for action, latencies in sorted(recorder.clicks.items())
+        },
+        "timeline": timeline,
+        "peak_rss_mb": round(max(m for _, m in recorder.memory), 1)
+        if recorder.memory
+        else None,
+    }
+
+
+def print_report(report: dict) -> None:
+    """Print a load test report as tables."""
+    print(
+        f"{report['requests']} requests in {report['duration_s']}s: "
+        f"{report['throughput_rps']} req/s, {report['errors']} errors, "
+        f"peak server RSS {report['peak_rss_mb']} MB",
+    )
+    print(f"\n{'callback':<60}{'calls':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'KB':>9}")
+    for name, row in report["callbacks"].items():
+        print(
+            f"{name[:59]:<60}{row['calls']:>7}{row['p50_ms']:>9.1f}"
+            f"{row['p95_ms']:>9.1f}{row['p99_ms']:>9.1f}{row['mean_kb']:>9.1f}",
+        )
+    print(f"\n{'click':<60}{'calls':>7}{'p50':>9}{'p95':>9}{'p99':>9}  (ms)")
+    for action, row in report["clicks"].items():
+        print(
+            f"{action:<60}{row['calls']:>7}{row['p50_ms']:>9.1f}"
+            f"{row['p95_ms']:>9.1f}{row['p99_ms']:>9.1f}",
+        )
+    print(f"\n{'t (s)':>8}{'req/s':>9}{'p95 ms':>9}{'RSS MB':>9}")
+    for row in report["timeline"]:
+        print(f"{row['t']:>8}{row['rps']:>9}{row['p95_ms']:>9}{row['rss_mb']!s:>9}")
+
+
+def run(  # noqa: PLR0913
+    url: str,
+    *,
+    users: int,
+    duration: float,
+    think: float,
+    ramp: float,
+    interval: float,
+    seed: int,
+) -> dict:
+    """Run simulated users against the dashboard, return the report.
+
+    :param url str: root URL of the dashboard
+    :param users int: concurrent users
+    :param duration float: seconds to run, ramp-up included
+    :param think float: mean seconds between two clicks of a user
+    :param ramp float: seconds over which the users arrive
+    :param interval float: seconds between two memory samples
+    :param seed int: seed of the clicks
+    """
+    session = Session()
+    layout = session.get(f"{url}/_dash-layout", timeout=TIMEOUT).json()
+    values = layout_values(layout, {})
+    dependencies = session.get(f"{url}/_dash-dependencies", timeout=TIMEOUT).json()
+    recorder = Recorder()
+    stop = Event()
+    threads = [Thread(target=sample_memory, args=(url, recorder, stop, interval))]
+    threads[0].start()
+    for index in range(users):
+        user = SimulatedUser(url, dependencies, values, recorder, seed + index)
+        thread = Thread(target=user.run, args=(stop, think), daemon=True)
+        thread.start()
+        threads.append(thread)
+        sleep(ramp / users)
+    sleep(max(0.0, duration - (perf_counter() - recorder.start)))
+    stop.set()
+    for thread in threads:
+        thread.join(TIMEOUT)
+    return summarize(recorder, perf_counter() - recorder.start, interval)
+
+
+def main(argv: list[str] | None = None) -> None:
+    """Command line entry point."""
+    parser = ArgumentParser(description="Load test of the dashboard callbacks.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    synthetic = commands.add_parser("generate", help="write a synthetic dataset")
+    synthetic.add_argument("--root", type=Path, default=Path())
+    synthetic.add_argument("--communes", type=int, default=5000)
+    synthetic.add_argument("--cameras", type=int, default=20_000)
+    synthetic.add_argument("--seed", type=int, default=2024)
+    load = commands.add_parser("run", help="run simulated users")
+    load.add_argument("--url", default="http://127.0.0.1:8050")
+    load.add_argument("--users", type=int, default=10)
+    load.add_argument("--duration", type=float, default=60.0)
+    load.add_argument("--think", type=float, default=2.0)
+    load.add_argument("--ramp", type=float, default=10.0)
+    load.add_argument("--interval", type=float, default=5.0)
+    load.add_argument("--seed", type=int, default=2024)
+    load.add_argument("--output", type=Path, help="write the report as JSON")
+    load.add_argument("--max-p95", type=float, help="fail above this p95 (ms)")
+    args = parser.parse_args(argv)
+    if args.command == "generate":
+        generate(args.root.resolve(), args.communes, args.cameras, args.seed)
+        return
+    report = run(
+        args.url.rstrip("/"),
+        users=args.users,
+        duration=args.duration,
+        think=args.think,
+        ramp=args.ramp,
+        interval=args.interval,
+        seed=args.seed,
+    )
+    print_report(report)
+    if args.output:
+        args.output.write_text(dumps(report, indent=2))
+    failed = report["errors"] > 0 or (
+        args.max_p95 is not None and report["latency_ms"]["p95"] > args.max_p95
+    )
+    if failed:
+        sys_exit(1)
+
+
+if __name__ == "__main__":
+    main()
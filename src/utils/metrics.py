@@ -0,0 +1,215 @@
+"""Runtime metrics for the dashboard, exposed in the Prometheus text format.
+
+Every process keeps its own registry, so each server worker serves its own
+figures on ``/metrics`` (Prometheus scrapes the workers individually).
+"""
+from __future__ import annotations
+
+from bisect import bisect_left
+from functools import wraps
+from os import sysconf
+from pathlib import Path
+from resource import RUSAGE_SELF, getrusage
+from threading import Lock
+from time import perf_counter
+from typing import TYPE_CHECKING, Any
+
+from flask import Response, g, has_request_context, request
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from flask import Flask
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 5e5, 1e6, 5e6, 1e7, 5e7)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """Cumulative histogram keyed by a single label."""
+
+    def __init__(self, name: str, doc: str, label: str, buckets: tuple) -> None:
+        """Create an empty histogram.
+
+        :param name str: metric name
+        :param doc str: HELP text
+        :param label str: name of the label distinguishing the series
+        :param buckets tuple: upper bounds of the buckets, sorted
+        """
+        self.name = name
+        self.doc = doc
+        self.label = label
+        self.buckets = buckets
+        self._series: dict[str, list] = {}
+        self._lock = Lock()
+
+    def observe(self, label_value: str, value: float) -> None:
+        """Add an observation to the series of label_value."""
+        with self._lock:
+            series = self._series.setdefault(
+                label_value, [[0] * (len(self.buckets) + 1), 0.0, 0],
+            )
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        """Render the histogram in the Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_value, (counts, total, count) in sorted(self._series.items()):
+                labels = f'{self.label}="{label_value}"'
+                cumulated = 0
+                for bound, bucket_count in zip(self.buckets, counts[:-1], strict=True):
+                    cumulated += bucket_count
+                    lines.append(
+                        f'{self.name}_bucket{{{labels},le="{bound:g}"}} {cumulated}',
+                    )
+                lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+                lines.append(f"{self.name}_sum{{{labels}}} {total}")
+                lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+
+CALLBACK_LATENCY = Histogram(
+    "dash_callback_duration_seconds",
+    "Time spent inside a Dash callback.",
+    "callback",
+    LATENCY_BUCKETS,
+)
+RESPONSE_SIZE = Histogram(
+    "dash_callback_response_bytes",
+    "Size of the serialized callback response.",
+    "callback",
+    SIZE_BUCKETS,
+)
+
+_counters: dict[tuple[str, tuple[tuple[str, str], ...]], float] = {}
+_gauges: dict[tuple[str, tuple[tuple[str, str], ...]], float] = {}
+_docs = {
+    "dash_callback_errors_total": ("counter", "Callbacks that raised."),
+    "dash_cache_requests_total": ("counter", "Cache lookups by cache and result."),
+    "process_resident_memory_bytes": ("gauge", "Resident set size of the process."),
+}
+_lock = Lock()
+
+
+def inc_counter(name: str, value: float = 1, **labels: str) -> None:
+    """Increment a counter.
+
+    :param name str: metric name
+    :param value float: increment
+    :param labels str: labels of the series
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name: str, value: float, **labels: str) -> None:
+    """Set a gauge to value.
+
+    :param name str: metric name
+    :param value float: new value
+    :param labels str: labels of the series
+    """
+    with _lock:
+        _gauges[(name, tuple(sorted(labels.items())))] = value
+
+
+def describe(name: str, kind: str, doc: str) -> None:
+    """Declare the TYPE and HELP lines of a counter or gauge."""
+    _docs[name] = (kind, doc)
+
+
+def record_cache(cache: str, *, hit: bool) -> None:
+    """Count a lookup in one of the application caches.
+
+    :param cache str: name of the cache
+    :param hit bool: whether the lookup was served from the cache
+    """
+    result = "hit" if hit else "miss"
+    inc_counter("dash_cache_requests_total", cache=cache, result=result)
+
+
+def process_rss_bytes() -> int:
+    """Return the resident set size of the current process in bytes."""
+    statm = Path("/proc/self/statm")
+    if statm.exists():
+        return int(statm.read_text().split()[1]) * sysconf("SC_PAGE_SIZE")
+    # ru_maxrss is the peak, in kilobytes, on platforms without procfs
+    return getrusage(RUSAGE_SELF).ru_maxrss * 1024
+
+
+def instrument_callback(func: Callable) -> Callable:
+    """Wrap a Dash callback to record its latency and errors.
+
+    The callback name is stored on flask.g so that the response size can be
+    attributed to it once Dash has serialized the output.
+
+    :param func Callable: the callback
+    """
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:  # noqa: ANN401
+        if has_request_context():
+            g.metrics_callback = name
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            inc_counter("dash_callback_errors_total", callback=name)
+            raise
+        finally:
+            CALLBACK_LATENCY.observe(name, perf_counter() - start)
+
+    return wrapper
+
+
+def _render_series(
+    series: dict[tuple[str, tuple[tuple[str, str], ...]], float],
+) -> list[str]:
+    lines = []
+    seen = set()
+    for (name, labels), value in sorted(series.items()):
+        if name not in seen:
+            seen.add(name)
+            kind, doc = _docs.get(name, ("untyped", name))
+            lines.extend((f"# HELP {name} {doc}", f"# TYPE {name} {kind}"))
+        label_str = ",".join(f'{key}="{val}"' for key, val in labels)
+        labelled = f"{name}{{{label_str}}}" if label_str else name
+        lines.append(f"{labelled} {value}")
+    return lines
+
+
+def render_metrics() -> str:
+    """Render every metric of the process in the Prometheus text format."""
+    set_gauge("process_resident_memory_bytes", process_rss_bytes())
+    lines = CALLBACK_LATENCY.render() + RESPONSE_SIZE.render()
+    with _lock:
+        lines += _render_series(_counters) + _render_series(_gauges)
+    return "\n".join(lines) + "\n"
+
+
+def _record_response_size(response: Response) -> Response:
+    name = g.get("metrics_callback")
+    if name and request.path.endswith("_dash-update-component"):
+        size = response.calculate_content_length()
+        if size is not None:
+            RESPONSE_SIZE.observe(name, size)
+    return response
+
+
+def register_metrics(server: Flask) -> None:
+    """Expose /metrics on the Flask server behind Dash.
+
+    :param server Flask: the Dash server (app.server)
+    """
+    server.after_request(_record_response_size)
+    server.add_url_rule(
+        "/metrics",
+        "metrics",
+        lambda: Response(render_metrics(), content_type=CONTENT_TYPE),
+    )
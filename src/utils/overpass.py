@@ -0,0 +1,241 @@
+"""Tiled harvesting of surveillance cameras from the Overpass API.
+
+A single France-wide query regularly times out, so France is split into
+bounding-box tiles that are queried concurrently. Each tile is streamed to
+its own file; tiles are kept until a harvest completes, so a failed run only
+fetches the missing tiles again. Tiles are then parsed incrementally, one
+element at a time, so that national-scale responses are never loaded whole.
+
+Overpass reports timeouts and memory exhaustion with a 200 status, truncated
+elements and a runtime remark; such responses are failed attempts.
+"""
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from json import JSONDecodeError, JSONDecoder
+from math import ceil
+from os import environ
+from pathlib import Path
+from re import compile as recompile
+from time import sleep
+from typing import TYPE_CHECKING
+
+from requests import RequestException
+
+from src.utils.http_cache import forget_response, http_session
+from src.utils.run_report import report_io
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+    from typing import TextIO
+
+TILES_PATH = Path("./", "data", "raw", "osm_tiles")
+METROPOLE_BBOX = (41.3, -5.2, 51.1, 9.6)  # south, west, north, east
+OVERSEAS_BBOXES = {
+    "guadeloupe": (15.8, -61.9, 16.55, -60.95),
+    "martinique": (14.35, -61.25, 14.9, -60.8),
+    "guyane": (2.1, -54.6, 5.8, -51.6),
+    "reunion": (-21.4, 55.2, -20.85, 55.85),
+    "mayotte": (-13.05, 45.0, -12.6, 45.3),
+}
+TILE_SIZE = 2.0  # degrees
+MAX_WORKERS = 2  # Overpass grants a couple of slots per client
+MAX_RETRIES = 4
+BACKOFF = 5.0  # seconds, doubled at each retry
+TIMEOUT = 180  # seconds, both server-side and client-side
+CHUNK_SIZE = 1024 * 1024
+ELEMENTS_START = recompile(r'"elements"\s*:\s*\[')
+RUNTIME_REMARK = recompile(r'"remark"\s*:\s*"(runtime (?:[^"\\]|\\.)*)"')
+REMARK_TAIL = 64 * 1024  # the remark follows the elements
+SEPARATORS = " \t\r\n,"
+
+QUERY = """
+[out:json][timeout:{timeout}];
+area[name="France"]->.searchArea;
+
+// Search for nodes, ways, or relations with camera-related tags
+(
+  node["man_made"="surveillance"](area.searchArea)({bbox});
+  node["surveillance"](area.searchArea)({bbox});
+  way["man_made"="surveillance"](area.searchArea)({bbox});
+  way["surveillance"](area.searchArea)({bbox});
+);
+
+// Output the results
+out body;
+>;
+out skel qt;
+"""
+
+
+class OverpassError(RuntimeError):
+    """Overpass answered with a runtime error: the elements are truncated."""
+
+
+def runtime_remark(path: Path) -> str | None:
+    """Return the runtime remark at the end of an Overpass response, if any.
+
+    :param path Path: a tile file
+    """
+    with path.open("rb") as f:
+        f.seek(max(path.stat().st_size - REMARK_TAIL, 0))
+        match = RUNTIME_REMARK.search(f.read().decode("utf-8", errors="replace"))
+    return match.group(1) if match else None
+
+
+def tile_bboxes(tile_size: float = TILE_SIZE) -> dict[str, tuple[float, ...]]:
+    """Split France into named bounding boxes.
+
+    :param tile_size float: side of the metropolitan tiles, in degrees
+    """
+    south, west, north, east = METROPOLE_BBOX
+    rows = ceil((north - south) / tile_size)
+    cols = ceil((east - west) / tile_size)
+    tiles = {
+        f"metropole_{row}_{col}": (
+            round(south + row * tile_size, 4),
+            round(west + col * tile_size, 4),
+            round(min(south + (row + 1) * tile_size, north), 4),
+            round(min(west + (col + 1) * tile_size, east), 4),
+        )
+        for row in range(rows)
+        for col in range(cols)
+    }
+    return tiles | OVERSEAS_BBOXES
+
+
+def _stream_tile(endpoint_url: str, query: str, tmp: Path) -> None:
+    with http_session().get(
+        endpoint_url,
+        params={"data": query},
+        stream=True,
+        timeout=TIMEOUT + 30,
+    ) as response:
+        response.raise_for_status()
+        with tmp.open("wb") as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+    remark = runtime_remark(tmp)
+    if remark:
+        forget_response(response.request)
+        raise OverpassError(remark)
+
+
+def fetch_tile(
+    endpoint_url: str,
+    name: str,
+    bbox: tuple[float, ...],
+    directory: Path = TILES_PATH,
+) -> Path | None:
+    """Stream the Overpass response of one tile to disk, with retries.
+
+    Returns the tile file, or None once every retry failed. A tile kept from
+    a previous run is fetched again if it holds a runtime remark.
+
+    :param endpoint_url str: Overpass interpreter URL
+    :param name str: name of the tile, used as file name
+    :param bbox tuple: south, west, north, east
+    :param directory Path: where tiles are written
+    """
+    dest = directory / f"{name}.json"
+    if dest.exists():
+        if runtime_remark(dest) is None:
+            return dest
+        dest.unlink()
+    query = QUERY.format(timeout=TIMEOUT, bbox=",".join(map(str, bbox)))
+    tmp = dest.with_suffix(".part")
+    for attempt in range(MAX_RETRIES):
+        try:
+            _stream_tile(endpoint_url, query, tmp)
+            tmp.replace(dest)
+        except (RequestException, OverpassError) as e:
+            print(f"Overpass tile {name} failed (attempt {attempt + 1}): {e}")
+            if attempt + 1 < MAX_RETRIES:
+                sleep(BACKOFF * 2**attempt)
+        else:
+            return dest
+    tmp.unlink(missing_ok=True)
+    return None
+
+
+def iter_elements(stream: TextIO, chunk_size: int = CHUNK_SIZE) -> Iterator[dict]:
+    """Yield the elements of an Overpass JSON response one at a time.
+
+    Only the element being decoded and one chunk are held in memory.
+
+    :param stream TextIO: the response, e.g. an open tile file
+    :param chunk_size int: characters read at a time
+    """
+    decoder = JSONDecoder()
+    buffer = ""
+    match = None
+    while match is None:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        buffer += chunk
+        match = ELEMENTS_START.search(buffer)
+    pos = match.end()
+    while True:
+        while pos < len(buffer) and buffer[pos] in SEPARATORS:
+            pos += 1
+        if buffer.startswith("]", pos):
+            return
+        try:
+            element, pos = decoder.raw_decode(buffer, pos)
+        except JSONDecodeError:
+            # The element is cut by the end of the buffer
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                raise
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        yield element
+
+
+def iter_tile_elements(paths: list[Path]) -> Iterator[dict]:
+    """Yield the elements of every tile, skipping unreadable tiles.
+
+    Elements shared by neighbouring tiles are yielded once per tile.
+
+    :param paths list[Path]: tile files
+    """
+    for path in paths:
+        with path.open(encoding="utf-8") as f:
+            try:
+                yield from iter_elements(f)
+            except JSONDecodeError as e:
+                print(f"Skipping the rest of unreadable tile {path.name}: {e}")
+
+
+def harvest_osm(
+    endpoint_url: str,
+    directory: Path = TILES_PATH,
+    tile_size: float = TILE_SIZE,
+) -> tuple[list[Path], bool]:
+    """Harvest every tile concurrently.
+
+    Returns the tile files and whether every tile succeeded.
+
+    :param endpoint_url str: Overpass interpreter URL
+    :param directory Path: where tiles are written
+    :param tile_size float: side of the metropolitan tiles, in degrees
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    tiles = tile_bboxes(tile_size)
+    workers = int(environ.get("OVERPASS_WORKERS", MAX_WORKERS))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(
+            pool.map(
+                lambda item: fetch_tile(endpoint_url, *item, directory),
+                tiles.items(),
+            ),
+        )
+    paths = [path for path in results if path is not None]
+    failed = len(tiles) - len(paths)
+    report_io(
+        bytes_in=sum(path.stat().st_size for path in paths),
+        error=f"{failed}/{len(tiles)} Overpass tiles failed" if failed else None,
+    )
+    return paths, not failed
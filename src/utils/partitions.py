@@ -0,0 +1,87 @@
+"""Low-memory processing, one département at a time.
+
+When MEMORY_BUDGET_MB is set, datasets too large for the budget are never
+loaded whole. The raw crimes CSV is read in chunks and split into one file
+per year and département; the GeoJSON of the communes is read in slices of features
+and split into one geometry partition per département. Each partition is
+then cleaned or aggregated on its own, a commune always belonging to a
+single département.
+"""
+from __future__ import annotations
+
+from os import environ
+from typing import TYPE_CHECKING
+
+from pandas import read_csv
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterator
+    from pathlib import Path
+
+    from pandas import DataFrame, Series
+
+MEGABYTE = 1024 * 1024
+BUDGET_SHARE = 4  # a chunk takes a quarter of the budget, copies included
+MIN_CHUNK_ROWS = 1000
+
+
+def memory_budget() -> int | None:
+    """Return the memory budget in bytes, None when MEMORY_BUDGET_MB is unset."""
+    budget = environ.get("MEMORY_BUDGET_MB")
+    return int(float(budget) * MEGABYTE) if budget else None
+
+
+def rows_per_chunk(budget: int, row_bytes: float) -> int:
+    """Return how many rows of row_bytes each fit in a chunk of the budget.
+
+    :param budget int: memory budget in bytes
+    :param row_bytes float: memory taken by a loaded row
+    """
+    return max(MIN_CHUNK_ROWS, int(budget / BUDGET_SHARE / row_bytes))
+
+
+def departement_codes(codes: Series) -> Series:
+    """Return the département of INSEE commune codes (97x overseas)."""
+    codes = codes.astype(str).str.zfill(5)
+    return codes.str[:2].where(~codes.str.startswith("97"), codes.str[:3])
+
+
+def split_csv(
+    file: Path,
+    directory: Path,
+    key: Callable[[DataFrame], Series],
+    chunk_rows: int,
+    **read_kwargs: object,
+) -> list[Path]:
+    """Split a CSV into one CSV per key value, reading chunk_rows at a time.
+
+    Returns the partitions, sorted by key. Partitions left by a previous
+    split are replaced.
+
+    :param file Path: CSV to split
+    :param directory Path: directory of the partitions
+    :param key Callable: partition key of the rows of a chunk
+    :param chunk_rows int: rows read at once
+    :param read_kwargs: arguments of read_csv
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    for stale in directory.glob("*.csv"):
+        stale.unlink()
+    for chunk in read_csv(file, chunksize=chunk_rows, **read_kwargs):
+        for value, part in chunk.groupby(key(chunk)):
+            path = directory / f"{value}.csv"
+            part.to_csv(path, mode="a", header=not path.exists(), index=False)
+    return sorted(directory.glob("*.csv"))
+
+
+def iter_partitions(
+    partitions: list[Path],
+    **read_kwargs: object,
+) -> Iterator[DataFrame]:
+    """Yield the partitions one at a time.
+
+    :param partitions list[Path]: CSV partitions, as returned by split_csv
+    :param read_kwargs: arguments of read_csv
+    """
+    for path in partitions:
+        yield read_csv(path, **read_kwargs)
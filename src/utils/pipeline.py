@@ -0,0 +1,297 @@
+"""Ingestion as a graph of stages, run in parallel as their inputs are ready.
+
+A stage declares the files it reads and writes and the stages whose results
+it takes as arguments (needs). It runs once those stages and the producers of
+its input files (the stages writing them, or a directory holding them) have
+succeeded. Network-bound stages run on a thread pool, CPU-bound cleaning on
+a process pool, so that the ingestion takes about as long as its critical
+path rather than the sum of its stages.
+
+Cached stages are skipped when the hash of their inputs (input files, files
+returned by the stages they need, other arguments, the environment variables
+they read and the source of the src package) matches their last run: their
+outputs are restored from data/cache/stages instead.
+
+A failed stage only stops the stages that depend on it; the others complete
+and the failure is raised once they are done. Pool sizes are set by
+INGEST_THREADS and INGEST_PROCESSES; under MEMORY_BUDGET_MB, a single process
+cleans at a time.
+"""
+from __future__ import annotations
+
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass, field
+from hashlib import sha256
+from inspect import getsourcefile
+from json import dumps, loads
+from multiprocessing import get_context
+from os import cpu_count, environ
+from pathlib import Path
+from shutil import copy2, copytree, rmtree
+from time import perf_counter
+from traceback import print_exc
+from typing import TYPE_CHECKING, Any
+
+from src.utils.partitions import memory_budget
+from src.utils.run_report import RunReport, StageRecord
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+STAGE_CACHE_PATH = Path("./", "data", "cache", "stages")
+# Any change to the code may change the outputs of a stage, or their format
+SOURCE_PATH = Path(__file__).resolve().parent.parent
+HASH_BLOCK = 1024 * 1024
+
+
+class PipelineError(RuntimeError):
+    """Stages failed or were skipped because a stage they need failed."""
+
+
+@dataclass(frozen=True)
+class Stage:
+    """A step of the ingestion.
+
+    func is called with the results of needs, in order, then args and kwargs.
+    Process stages must be module-level functions with picklable arguments.
+    A cached stage whose outputs are restored has no result (None); env names
+    the environment variables its outputs depend on.
+    """
+
+    name: str
+    func: Callable[..., Any]
+    args: tuple = ()
+    kwargs: dict = field(default_factory=dict)
+    needs: tuple[str, ...] = ()
+    inputs: tuple[Path, ...] = ()
+    outputs: tuple[Path, ...] = ()
+    pool: str = "thread"  # "thread" for network-bound stages, "process" for CPU
+    cached: bool = False
+    env: tuple[str, ...] = ()
+
+
+def _contains(directory: Path, path: Path) -> bool:
+    return path == directory or directory in path.parents
+
+
+def dependencies(stages: list[Stage]) -> dict[str, set[str]]:
+    """Return the stages each stage waits for, checking the graph is acyclic.
+
+    :param stages list[Stage]: stages of the pipeline
+    """
+    names = {stage.name for stage in stages}
+    graph = {}
+    for stage in stages:
+        unknown = set(stage.needs) - names
+        if unknown:
+            error_msg = f"Stage {stage.name} needs unknown stages {sorted(unknown)}"
+            raise ValueError(error_msg)
+        graph[stage.name] = set(stage.needs) | {
+            producer.name
+            for producer in stages
+            if producer is not stage
+            and any(
+                _contains(output, path)
+                for output in producer.outputs
+                for path in stage.inputs
+            )
+        }
+    done: set[str] = set()
+    while len(done) < len(graph):
+        ready = {name for name, deps in graph.items() if deps <= done} - done
+        if not ready:
+            error_msg = f"Cycle between stages {sorted(set(graph) - done)}"
+            raise ValueError(error_msg)
+        done |= ready
+    return graph
+
+
+def hash_path(path: Path, digest: Any) -> None:  # noqa: ANN401
+    """Add the content of a file, or of the files of a directory, to digest."""
+    if not path.exists():
+        digest.update(f"{path}:missing".encode())
+        return
+    files = [path]
+    if path.is_dir():
+        files = sorted(p for p in path.rglob("*") if p.is_file())
+    for file in files:
+        digest.update(str(file.relative_to(path.parent)).encode())
+        with file.open("rb") as f:
+            while block := f.read(HASH_BLOCK):
+                digest.update(block)
+
+
+def input_key(stage: Stage, arguments: tuple) -> str:
+    """Return the hash of everything a cached stage depends on.
+
+    :param stage Stage: the stage
+    :param arguments tuple: results of its needs, then its args
+    """
+    digest = sha256(stage.name.encode())
+    for path in [*stage.inputs, *(a for a in arguments if isinstance(a, Path))]:
+        hash_path(path, digest)
+    sources = set(SOURCE_PATH.rglob("*.py"))
+    source = getsourcefile(stage.func)
+    if source:
+        sources.add(Path(source).resolve())
+    for path in sorted(sources):
+        hash_path(path, digest)
+    others = [repr(a) for a in arguments if not isinstance(a, Path)]
+    env = {name: environ.get(name) for name in stage.env}
+    digest.update(
+        dumps([others, repr(sorted(stage.kwargs.items())), env]).encode(),
+    )
+    return digest.hexdigest()[:16]
+
+
+def _copy(source: Path, target: Path) -> None:
+    if target.is_dir():
+        rmtree(target)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    if source.is_dir():
+        copytree(source, target)
+    elif source.exists():
+        copy2(source, target)
+
+
+def restore_outputs(stage: Stage, key: str, directory: Path) -> bool:
+    """Copy the outputs cached under key back in place, return whether found.
+
+    :param stage Stage: a cached stage
+    :param key str: hash of its inputs
+    :param directory Path: root of the stage cache
+    """
+    entry = directory / stage.name
+    manifest = entry / "manifest.json"
+    if not manifest.exists() or loads(manifest.read_text())["key"] != key:
+        return False
+    for index, output in enumerate(stage.outputs):
+        _copy(entry / str(index), output)
+    return True
+
+
+def store_outputs(stage: Stage, key: str, directory: Path) -> None:
+    """Keep a copy of the outputs of a stage under the hash of its inputs.
+
+    Only the last run of each stage is kept.
+
+    :param stage Stage: a cached stage, just run
+    :param key str: hash of its inputs
+    :param directory Path: root of the stage cache
+    """
+    entry = directory / stage.name
+    rmtree(entry, ignore_errors=True)
+    for index, output in enumerate(stage.outputs):
+        _copy(output, entry / str(index))
+    (entry / "manifest.json").write_text(dumps({"key": key}))
+
+
+def execute(
+    stage: Stage,
+    arguments: tuple,
+    directory: Path = STAGE_CACHE_PATH,
+) -> tuple[Any, StageRecord, str | None]:
+    """Run a stage, or restore its outputs, in a worker thread or process.
+
+    Returns its result, its record and the error it failed with, if any.
+
+    :param stage Stage: the stage
+    :param arguments tuple: results of its needs, then its args
+    :param directory Path: root of the stage cache
+    """
+    report = RunReport()
+    inputs = [*stage.inputs, *(a for a in arguments if isinstance(a, Path))]
+    result = None
+    try:
+        # A process worker runs one stage at a time, thread stages run together
+        with report.stage(
+            stage.name,
+            inputs,
+            list(stage.outputs),
+            measure_memory=stage.pool == "process",
+        ) as record:
+            key = input_key(stage, arguments) if stage.cached else None
+            if key and restore_outputs(stage, key, directory):
+                record.cached = True
+            else:
+                result = stage.func(*arguments, **stage.kwargs)
+                if key:
+                    store_outputs(stage, key, directory)
+    except Exception as e:  # noqa: BLE001
+        # Only the stages depending on this one are stopped
+        print_exc()
+        return None, report.stages[-1], repr(e)
+    return result, report.stages[-1], None
+
+
+def pool_sizes() -> tuple[int, int]:
+    """Return the number of worker threads and processes."""
+    threads = int(environ.get("INGEST_THREADS", "8"))
+    processes = 1 if memory_budget() else min(4, cpu_count() or 1)
+    return threads, int(environ.get("INGEST_PROCESSES", str(processes)))
+
+
+def run_pipeline(stages: list[Stage], report: RunReport) -> dict[str, Any]:
+    """Run the stages as soon as what they wait for succeeded.
+
+    Returns the results of the stages. Raises PipelineError once every stage
+    that could run has run, if some failed.
+
+    :param stages list[Stage]: stages of the pipeline
+    :param report RunReport: receives the record of every stage
+    """
+    graph = dependencies(stages)
+    pending = {stage.name: stage for stage in stages}
+    results: dict[str, Any] = {}
+    failed: dict[str, str] = {}
+    running: dict[Future, str] = {}
+    threads, processes = pool_sizes()
+    start = perf_counter()
+    with (
+        ThreadPoolExecutor(threads) as thread_pool,
+        ProcessPoolExecutor(processes, mp_context=get_context("spawn")) as process_pool,
+    ):
+        pools = {"thread": thread_pool, "process": process_pool}
+        while pending or running:
+            for name, stage in list(pending.items()):
+                blocked = graph[name] & failed.keys()
+                if blocked:
+                    del pending[name]
+                    failed[name] = f"skipped, {sorted(blocked)} failed"
+                    report.stages.append(StageRecord(name, error=failed[name]))
+                elif graph[name] <= results.keys():
+                    del pending[name]
+                    arguments = (*(results[need] for need in stage.needs), *stage.args)
+                    future = pools[stage.pool].submit(execute, stage, arguments)
+                    running[future] = name
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    result, record, error = future.result()
+                except Exception as e:  # noqa: BLE001
+                    # e.g. arguments that cannot be sent to a process
+                    result, record, error = None, StageRecord(name), repr(e)
+                    record.error = error
+                report.stages.append(record)
+                if error:
+                    failed[name] = error
+                else:
+                    results[name] = result
+    busy = sum(record.wall_time for record in report.stages)
+    print(
+        f"Ingestion: {len(stages)} stages in {perf_counter() - start:.1f}s "
+        f"({busy:.1f}s of stage time)",
+    )
+    if failed:
+        error_msg = "; ".join(f"{name}: {error}" for name, error in failed.items())
+        raise PipelineError(error_msg)
+    return results
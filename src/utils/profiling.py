@@ -0,0 +1,184 @@
+"""Opt-in profiling of dashboard requests and ingestion stages.
+
+Profiling is configured through the environment:
+
+- ``PROFILING``: ``always`` profiles every callback request and ingestion stage,
+  ``header`` only profiles callback requests sent with an ``X-Profile`` header.
+  Unset (the default) disables profiling and installs nothing.
+- ``PROFILER``: ``sample`` (default) writes folded stacks (``.folded``) that
+  flamegraph.pl or speedscope read, ``cprofile`` writes ``.prof`` files.
+- ``PROFILE_DIR``: output directory, ``data/profiles`` by default.
+- ``PROFILE_KEEP``: number of profiles kept before the oldest are deleted.
+"""
+from __future__ import annotations
+
+import sys
+from collections import Counter
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from cProfile import Profile
+from os import environ
+from pathlib import Path
+from re import sub
+from threading import Event, Thread, get_ident
+from time import time_ns
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+    from types import FrameType
+
+    from flask import Flask, Response
+
+PROFILE_HEADER = "X-Profile"
+SAMPLE_INTERVAL = 0.005
+
+
+def profiling_mode() -> str:
+    """Return the profiling mode: "", "always" or "header"."""
+    mode = environ.get("PROFILING", "").lower()
+    if mode in {"1", "true", "always"}:
+        return "always"
+    return "header" if mode == "header" else ""
+
+
+class SamplingProfiler:
+    """Sample the stack of one thread at a fixed interval."""
+
+    def __init__(self, thread_id: int, interval: float = SAMPLE_INTERVAL) -> None:
+        """Prepare a sampler for thread_id.
+
+        :param thread_id int: identifier of the thread to sample
+        :param interval float: seconds between two samples
+        """
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)  # noqa: SLF001
+            if frame is not None:
+                self.stacks[_fold(frame)] += 1
+
+    def start(self) -> None:
+        """Start sampling."""
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop sampling and wait for the sampler thread."""
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, path: Path) -> None:
+        """Write the samples in the folded stack format."""
+        with path.open("w") as f:
+            for stack, count in self.stacks.items():
+                f.write(f"{stack} {count}\n")
+
+
+def _fold(frame: FrameType | None) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{Path(code.co_filename).stem}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class _Session:
+    """A running profiler, whatever its kind."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.kind = environ.get("PROFILER", "sample").lower()
+        if self.kind == "cprofile":
+            self.profiler = Profile()
+            self.profiler.enable()
+        else:
+            self.profiler = SamplingProfiler(get_ident())
+            self.profiler.start()
+
+    def finish(self) -> Path:
+        if isinstance(self.profiler, Profile):
+            self.profiler.disable()
+        else:
+            self.profiler.stop()
+        directory = Path(environ.get("PROFILE_DIR", "data/profiles"))
+        directory.mkdir(parents=True, exist_ok=True)
+        slug = sub(r"[^\w.-]+", "_", self.name).strip("_")[:80]
+        if isinstance(self.profiler, Profile):
+            path = directory / f"{time_ns()}-{slug}.prof"
+            self.profiler.dump_stats(path)
+        else:
+            path = directory / f"{time_ns()}-{slug}.folded"
+            self.profiler.dump(path)
+        rotate_profiles(directory, int(environ.get("PROFILE_KEEP", "100")))
+        return path
+
+
+def rotate_profiles(directory: Path, keep: int) -> None:
+    """Delete the oldest profiles of directory so that only keep remain.
+
+    :param directory Path: the profile directory
+    :param keep int: number of profiles to keep
+    """
+    profiles = sorted(
+        (p for p in directory.iterdir() if p.suffix in {".prof", ".folded"}),
+        key=lambda p: p.name,
+    )
+    for profile in profiles[:-keep] if keep > 0 else profiles:
+        profile.unlink(missing_ok=True)
+
+
+@contextmanager
+def _profiled(name: str) -> Iterator[None]:
+    session = _Session(name)
+    try:
+        yield
+    finally:
+        session.finish()
+
+
+def profile_stage(name: str) -> AbstractContextManager:
+    """Profile an ingestion stage when PROFILING is "always".
+
+    :param name str: name of the stage, used in the file name
+    """
+    return _profiled(f"stage-{name}") if profiling_mode() == "always" else nullcontext()
+
+
+def _start_request_profile() -> None:
+    # Flask is imported here so that ingestion, which imports profile_stage,
+    # does not load it
+    from flask import g, request  # noqa: PLC0415
+
+    if not request.path.endswith("_dash-update-component"):
+        return
+    if profiling_mode() == "header" and PROFILE_HEADER not in request.headers:
+        return
+    body = request.get_json(silent=True) or {}
+    g.profile_session = _Session(f"callback-{body.get('output', 'unknown')}")
+
+
+def _finish_request_profile(response: Response) -> Response:
+    from flask import g  # noqa: PLC0415
+
+    session = g.pop("profile_session", None)
+    if session is not None:
+        session.finish()
+    return response
+
+
+def register_profiling(server: Flask) -> None:
+    """Profile callback requests, serialization included, if PROFILING is set.
+
+    Nothing is registered when profiling is disabled.
+
+    :param server Flask: the Dash server (app.server)
+    """
+    if not profiling_mode():
+        return
+    server.before_request(_start_request_profile)
+    server.after_request(_finish_request_profile)
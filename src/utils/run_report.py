@@ -0,0 +1,237 @@
+"""Ingestion run reports: per-stage timings, volumes and memory.
+
+Every call to get_data writes a JSON manifest in data/runs. Two manifests can
+be compared from the command line::
+
+    python -m src.utils.run_report list
+    python -m src.utils.run_report compare [OLD] [NEW]
+"""
+from __future__ import annotations
+
+from argparse import ArgumentParser
+from contextlib import contextmanager, suppress
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from datetime import UTC, datetime
+from json import dumps, loads
+from os import getpid
+from pathlib import Path
+from resource import RUSAGE_SELF, getrusage
+from time import perf_counter
+from typing import TYPE_CHECKING
+
+from src.utils.profiling import profile_stage
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+RUNS_PATH = Path("./", "data", "runs")
+
+_current_stage: ContextVar[StageRecord | None] = ContextVar("stage", default=None)
+
+
+@dataclass
+class StageRecord:
+    """Measurements of one ingestion stage.
+
+    peak_rss is the peak memory of the process running the stage. It is None
+    for stages sharing their process with concurrent stages, such as thread
+    pool stages, whose peak would include the memory of their neighbours.
+    """
+
+    name: str
+    wall_time: float = 0.0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    rows_in: int | None = None
+    rows_out: int | None = None
+    rows_per_sec: float | None = None
+    peak_rss: int | None = None
+    fallback: bool = False
+    cached: bool = False
+    error: str | None = None
+    outputs: list[Path] = field(default_factory=list, repr=False)
+
+    def to_dict(self) -> dict:
+        """Return the JSON-serializable fields of the record."""
+        record = asdict(self)
+        record["outputs"] = [str(path) for path in self.outputs]
+        return record
+
+
+def report_io(
+    *,
+    bytes_in: int = 0,
+    rows_in: int | None = None,
+    rows_out: int | None = None,
+    fallback: bool = False,
+    error: str | None = None,
+) -> None:
+    """Add measurements to the stage running in the current context, if any.
+
+    :param bytes_in int: bytes read from the network or from disk
+    :param rows_in int: rows read by the stage
+    :param rows_out int: rows written by the stage
+    :param fallback bool: whether a fallback source was used
+    :param error str: error that the stage recovered from
+    """
+    record = _current_stage.get()
+    if record is None:
+        return
+    record.bytes_in += bytes_in
+    if rows_in is not None:
+        record.rows_in = (record.rows_in or 0) + rows_in
+    if rows_out is not None:
+        record.rows_out = (record.rows_out or 0) + rows_out
+    record.fallback = record.fallback or fallback
+    record.error = error or record.error
+
+
+def _reset_peak_rss() -> None:
+    # Writing 5 to clear_refs resets VmHWM on Linux
+    with suppress(OSError):
+        Path("/proc/self/clear_refs").write_text("5")
+
+
+def _peak_rss() -> int:
+    status = Path("/proc/self/status")
+    if status.exists():
+        for line in status.read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return getrusage(RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RunReport:
+    """Collects the stage records of one ingestion run."""
+
+    def __init__(self) -> None:
+        """Start a new run."""
+        self.started = datetime.now(UTC)
+        self.stages: list[StageRecord] = []
+
+    @contextmanager
+    def stage(
+        self,
+        name: str,
+        inputs: list[Path] | None = None,
+        outputs: list[Path] | None = None,
+        *,
+        measure_memory: bool = True,
+    ) -> Iterator[StageRecord]:
+        """Measure a stage; it is also profiled when profiling is enabled.
+
+        :param name str: name of the stage
+        :param inputs list[Path]: files read by the stage, measured before it runs
+        :param outputs list[Path]: files written by the stage, measured after it
+        :param measure_memory bool: whether the stage has the process to itself,
+            so that its peak memory can be measured
+        """
+        record = StageRecord(name, outputs=list(outputs or []))
+        record.bytes_in = sum(p.stat().st_size for p in inputs or [] if p.exists())
+        token = _current_stage.set(record)
+        if measure_memory:
+            _reset_peak_rss()
+        start = perf_counter()
+        try:
+            with profile_stage(name):
+                yield record
+        except Exception as e:
+            record.error = repr(e)
+            raise
+        finally:
+            record.wall_time = perf_counter() - start
+            if measure_memory:
+                record.peak_rss = _peak_rss()
+            _current_stage.reset(token)
+            record.bytes_out = sum(
+                p.stat().st_size for p in record.outputs if p.exists()
+            )
+            rows = record.rows_in if record.rows_in is not None else record.rows_out
+            if rows is not None and record.wall_time > 0:
+                record.rows_per_sec = rows / record.wall_time
+            self.stages.append(record)
+
+    def write(self, directory: Path = RUNS_PATH) -> Path:
+        """Write the manifest of the run and return its path.
+
+        :param directory Path: directory holding the manifests
+        """
+        directory.mkdir(parents=True, exist_ok=True)
+        finished = datetime.now(UTC)
+        manifest = {
+            "started": self.started.isoformat(),
+            "finished": finished.isoformat(),
+            "wall_time": (finished - self.started).total_seconds(),
+            "stages": [stage.to_dict() for stage in self.stages],
+        }
+        # Microseconds and pid keep runs started in the same second apart
+        path = directory / f"run-{self.started:%Y%m%dT%H%M%S.%f}-{getpid()}.json"
+        path.write_text(dumps(manifest, indent=2))
+        return path
+
+
+def list_runs(directory: Path = RUNS_PATH) -> list[Path]:
+    """Return the manifests of directory, oldest first."""
+    return sorted(directory.glob("run-*.json")) if directory.exists() else []
+
+
+def _delta(old: float | None, new: float | None) -> str:
+    if not old or new is None:
+        return ""
+    return f"{(new - old) / old:+.0%}"
+
+
+def compare_runs(old_path: Path, new_path: Path) -> str:
+    """Format a per-stage comparison of two run manifests.
+
+    :param old_path Path: manifest of the reference run
+    :param new_path Path: manifest of the run to compare
+    """
+    old = {s["name"]: s for s in loads(old_path.read_text())["stages"]}
+    new = {s["name"]: s for s in loads(new_path.read_text())["stages"]}
+    lines = [
+        f"{old_path.name} -> {new_path.name}",
+        f"{'stage':<24}{'wall (s)':>20}{'rows out':>26}{'bytes in':>30}  fallback",
+    ]
+    for name in [*old, *(n for n in new if n not in old)]:
+        o, n = old.get(name, {}), new.get(name, {})
+        wall = f"{o.get('wall_time', 0):.1f}>{n.get('wall_time', 0):.1f}"
+        rows = f"{o.get('rows_out')}>{n.get('rows_out')}"
+        size = f"{o.get('bytes_in')}>{n.get('bytes_in')}"
+        lines.append(
+            f"{name:<24}"
+            f"{wall:>14}{_delta(o.get('wall_time'), n.get('wall_time')):>6}"
+            f"{rows:>20}{_delta(o.get('rows_out'), n.get('rows_out')):>6}"
+            f"{size:>24}{_delta(o.get('bytes_in'), n.get('bytes_in')):>6}"
+            f"  {o.get('fallback', '-')}>{n.get('fallback', '-')}",
+        )
+    return "\n".join(lines)
+
+
+def main(argv: list[str] | None = None) -> None:
+    """Command line entry point."""
+    parser = ArgumentParser(description="Inspect ingestion run reports.")
+    parser.add_argument("--runs-dir", type=Path, default=RUNS_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="list the recorded runs")
+    compare = commands.add_parser("compare", help="compare two runs")
+    compare.add_argument(
+        "old", nargs="?", type=Path, help="defaults to the previous run",
+    )
+    compare.add_argument("new", nargs="?", type=Path, help="defaults to the latest run")
+    args = parser.parse_args(argv)
+
+    runs = list_runs(args.runs_dir)
+    if args.command == "list":
+        for run in runs:
+            manifest = loads(run.read_text())
+            print(f"{run.name}  {manifest['wall_time']:.1f}s")
+        return
+    if (args.old is None or args.new is None) and len(runs) < 2:  # noqa: PLR2004
+        parser.error("at least two runs are needed")
+    print(compare_runs(args.old or runs[-2], args.new or runs[-1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+"""Incremental harvesting of the Shodan camera banners.
+
+Banners are kept in a persistent store keyed by IP and port, next to the date
+up to which the search was harvested. A refresh only queries the days after
+that date. Time windows are split in halves, using the count endpoint which
+costs no query credit, until each one fits in the window limit, so that paging
+through a window never hits the limits of an API key.
+
+The dashboard only needs counts, so banners can also be skipped altogether:
+aggregate_shodan gets the city, region and organization counts of each year
+from the facets of the count endpoint, splitting a year by region when a
+facet is truncated. Past years are settled, so a refresh queries the current
+year only.
+"""
+from __future__ import annotations
+
+from collections import Counter
+from copy import copy
+from datetime import UTC, date, datetime, timedelta
+from json import dumps, loads
+from math import ceil
+from os import environ
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from pandas import DataFrame, concat, read_csv
+from shodan import APIError
+
+from src.utils.clean_data import clean_shodan_result
+from src.utils.run_report import report_io
+
+if TYPE_CHECKING:
+    from shodan import Shodan
+
+STORE_PATH = Path("./", "data", "store")
+QUERY = "camera country:fr"
+FIRST_DAY = date(2009, 1, 1)  # launch of Shodan
+RESULTS_LIMIT = 100  # results per page, each page costs one query credit
+WINDOW_LIMIT = 1000  # results of a window, i.e. 10 pages
+OVERLAP = timedelta(days=1)  # banners indexed late are caught by the next run
+FACETS = ("city", "region", "org")
+FACET_SIZE = 100  # values returned per facet
+KEY = ["IP", "Port"]
+COLUMNS = [
+    "IP",
+    "Port",
+    "City",
+    "Region",
+    "Latitude",
+    "Longitude",
+    "Timestamp",
+    "Org",
+    "Domains",
+]
+COUNT_COLUMNS = ["Year", "Facet", "Value", "Count"]
+
+
+def window_query(start: date | None, end: date) -> str:
+    """Return the search query of the banners seen from start to the eve of end.
+
+    :param start date | None: first day of the window, None for no lower bound
+    :param end date: day after the window
+    """
+    # after: and before: both exclude the given day
+    after = f" after:{start - timedelta(days=1):%Y-%m-%d}" if start else ""
+    return f"{QUERY}{after} before:{end:%Y-%m-%d}"
+
+
+def year_query(year: int) -> str:
+    """Return the search query of the banners seen during year."""
+    return window_query(date(year, 1, 1), date(year + 1, 1, 1))
+
+
+class ShodanStore:
+    """Persistent table of the harvested banners, one row per IP and port."""
+
+    def __init__(self, directory: Path = STORE_PATH) -> None:
+        """Load the store of directory, empty if it does not exist yet.
+
+        :param directory Path: directory holding the store
+        """
+        self.path = directory / "shodan_cameras.csv"
+        self.state_path = directory / "shodan_state.json"
+        self.banners = (
+            read_csv(self.path, dtype={"IP": "string"})
+            if self.path.exists()
+            else DataFrame(columns=COLUMNS)
+        )
+        state = loads(self.state_path.read_text()) if self.state_path.exists() else {}
+        until = state.get("harvested_until")
+        self.harvested_until = date.fromisoformat(until) if until else None
+
+    def merge(self, rows: list[dict]) -> int:
+        """Add rows to the store, the newest banner of each IP and port wins.
+
+        Returns the number of IP and port pairs that were not in the store.
+
+        :param rows list[dict]: cleaned banners
+        """
+        if not rows:
+            return 0
+        before = len(self.banners)
+        new = DataFrame(rows, columns=COLUMNS)
+        parts = [part for part in (self.banners, new) if len(part)]
+        self.banners = (
+            concat(parts, ignore_index=True)
+            .sort_values("Timestamp", kind="stable")
+            .drop_duplicates(subset=KEY, keep="last")
+            .reset_index(drop=True)
+        )
+        return len(self.banners) - before
+
+    def save(self) -> None:
+        """Write the banners and the harvest state."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.banners.to_csv(self.path, index=False)
+        newest = self.banners["Timestamp"].max() if len(self.banners) else None
+        until = self.harvested_until
+        state = {
+            "harvested_until": until.isoformat() if until else None,
+            "newest_timestamp": newest,
+            "banners": len(self.banners),
+        }
+        self.state_path.write_text(dumps(state, indent=2))
+
+
+class ShodanHarvester:
+    """Harvests time windows, moving to the next API key when one runs dry."""
+
+    def __init__(
+        self,
+        clients: list[Shodan],
+        window_limit: int = WINDOW_LIMIT,
+    ) -> None:
+        """Set up the harvester.
+
+        :param clients list[Shodan]: clients to be used, one api key per client
+        :param window_limit int: maximum number of results of a window
+        """
+        self.clients = clients
+        self.window_limit = window_limit
+        self.credits = 0
+
+    def _call(self, method: str, *args: str, **kwargs: int | list) -> dict:
+        while True:
+            try:
+                return getattr(self.clients[0], method)(*args, **kwargs)
+            except APIError as e:
+                if "query credits" in str(e).lower() and len(self.clients) > 1:
+                    self.clients.pop(0)
+                    continue
+                raise
+
+    def plan(self, start: date | None, end: date) -> list[tuple]:
+        """Split the days from start to end in windows under the window limit.
+
+        Returns the non-empty windows, oldest first, with their result count.
+
+        :param start date | None: first day to harvest, None for no lower bound
+        :param end date: day after the last day to harvest
+        """
+        windows = []
+        pending = [(start, end)]
+        while pending:
+            low, high = pending.pop()
+            total = self._call("count", window_query(low, high))["total"]
+            if not total:
+                continue
+            first = low or FIRST_DAY
+            if total <= self.window_limit or (high - first).days <= 1:
+                windows.append((low, high, total))
+                continue
+            middle = first + (high - first) / 2
+            pending.extend([(middle, high), (low, middle)])
+        return windows
+
+    def fetch(self, start: date | None, end: date, total: int) -> list[dict]:
+        """Return the cleaned banners of one window.
+
+        :param start date | None: first day of the window
+        :param end date: day after the window
+        :param total int: number of results of the window
+        """
+        rows = []
+        for page in range(1, ceil(total / RESULTS_LIMIT) + 1):
+            result = self._call("search", window_query(start, end), page=page)
+            self.credits += 1
+            if not result.get("matches"):
+                break
+            rows.extend(clean_shodan_result(result))
+        return rows
+
+    def facets(self, query: str) -> tuple[int, dict[str, Counter]]:
+        """Return the total and the facet counts of query.
+
+        When the city or organization facet is truncated, the counts are
+        summed over one query per region instead.
+
+        :param query str: search query
+        """
+        facets = [(name, FACET_SIZE) for name in FACETS]
+        result = self._call("count", query, facets=facets)
+        values = result.get("facets", {})
+        counts = {
+            name: Counter({f["value"]: f["count"] for f in values.get(name, [])})
+            for name in FACETS
+        }
+        truncated = any(len(counts[name]) >= FACET_SIZE for name in ("city", "org"))
+        if truncated and " region:" not in query:
+            split = {"city": Counter(), "org": Counter()}
+            for region in counts["region"]:
+                _, regional = self.facets(f'{query} region:"{region}"')
+                for name, counter in split.items():
+                    counter.update(regional[name])
+            counts.update(split)
+        return result["total"], counts
+
+
+def aggregate_shodan(clients: list[Shodan], directory: Path = STORE_PATH) -> DataFrame:
+    """Update the yearly facet counts of the store and return them.
+
+    Every queried year gets a total row, so empty years are not queried again.
+
+    :param clients list[Shodan]: clients to be used, one api key per client
+    :param directory Path: directory holding the store
+    """
+    path = directory / "shodan_counts.csv"
+    stored = (
+        read_csv(path, keep_default_na=False)
+        if path.exists()
+        else DataFrame(columns=COUNT_COLUMNS)
+    )
+    this_year = datetime.now(UTC).year
+    settled = set(stored.loc[stored["Year"] < this_year, "Year"])
+    harvester = ShodanHarvester(clients)
+    queried = []
+    rows = []
+    error = None
+    try:
+        for year in range(FIRST_DAY.year, this_year + 1):
+            if year in settled:
+                continue
+            total, counts = harvester.facets(year_query(year))
+            queried.append(year)
+            rows.append((year, "total", "", total))
+            rows.extend(
+                (year, name, value, count)
+                for name, counter in counts.items()
+                for value, count in counter.items()
+            )
+    except APIError as e:
+        error = str(e)
+        print(f"Shodan aggregation stopped before {year}: {e}")
+    counts = concat(
+        [
+            stored[~stored["Year"].isin(queried)],
+            DataFrame(rows, columns=COUNT_COLUMNS),
+        ],
+        ignore_index=True,
+    ).sort_values(["Year", "Facet", "Count"], ascending=[True, True, False])
+    directory.mkdir(parents=True, exist_ok=True)
+    counts.to_csv(path, index=False)
+    print(f"Shodan: facet counts of {len(queried)} years updated")
+    report_io(rows_in=len(rows), rows_out=len(counts), error=error)
+    return counts
+
+
+def harvest_shodan(
+    clients: list[Shodan],
+    *,
+    full: bool = False,
+    directory: Path = STORE_PATH,
+) -> ShodanStore:
+    """Bring the store up to yesterday and return it.
+
+    Windows are harvested oldest first; when every key is out of credits, the
+    store keeps what was harvested and the next run resumes from there. A full
+    harvest goes to a fresh store, which replaces the saved one only once the
+    harvest is complete; otherwise the saved store is kept and returned.
+
+    :param clients list[Shodan]: clients to be used, one api key per client
+    :param full bool: ignore the store and harvest every banner again
+    :param directory Path: directory holding the store
+    """
+    saved = ShodanStore(directory)
+    store = saved
+    if full:
+        store = copy(saved)
+        store.banners = DataFrame(columns=COLUMNS)
+        store.harvested_until = None
+    harvester = ShodanHarvester(
+        clients,
+        int(environ.get("SHODAN_WINDOW_LIMIT", WINDOW_LIMIT)),
+    )
+    start = store.harvested_until and store.harvested_until - OVERLAP
+    end = datetime.now(UTC).date()
+    fetched = added = 0
+    error = None
+    try:
+        for low, high, total in harvester.plan(start, end):
+            rows = harvester.fetch(low, high, total)
+            fetched += len(rows)
+            added += store.merge(rows)
+            store.harvested_until = high
+    except APIError as e:
+        error = str(e)
+        print(f"Shodan harvest stopped at {store.harvested_until}: {e}")
+    if error is None:
+        store.harvested_until = end
+    if full and error is not None:
+        print("Shodan: full harvest incomplete, the stored banners are kept")
+        store = saved
+    else:
+        store.save()
+    print(
+        f"Shodan: {fetched} banners fetched ({added} new) "
+        f"for {harvester.credits} query credits",
+    )
+    report_io(rows_in=fetched, rows_out=len(store.banners), error=error)
+    return store
@@ -6,6 +6,8 @@ from typing import Callable
 
 from pandas import DataFrame
 
+from src.utils.run_report import report_io
+
 
 def setup_directories() -> None:
     """Create required directories and deletes previous data."""
@@ -79,6 +81,7 @@ def fallback_to_json(callback: Callable) -> None:
                 cleaned_data,
                 columns=[
                     "IP",
+                    "Port",
                     "City",
                     "Region",
                     "Latitude",
@@ -92,5 +95,6 @@ def fallback_to_json(callback: Callable) -> None:
                 Path("./", "data", "cleaned", "shodan_camera_fr.csv"),
                 index=False,
             )
+            report_io(rows_in=len(lines), rows_out=len(shodan_df), fallback=True)
     except (JSONDecodeError, FileNotFoundError) as e:
         print(f"Failed to load fallback JSON: {e}")